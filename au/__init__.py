@@ -1,14 +1,17 @@
-
-
 class ActivationObserver(object):
+  """Consumes `au.fixtures.nnmodel.Activations` (e.g. as they stream out of
+  `FillActivationsTFDataset`); see `au.distributions` for impls."""
   
   def record(self, activations):
     pass
   
   def record_multiple(self, act_seq):
-    pass
+    for activations in act_seq:
+      self.record(activations)
 
 class ActivationDistribution(object):
+  """A (mergeable) distribution over activation values (numpy arrays) for
+  a single tensor; see `au.distributions` for impls."""
   
   def tally(self, activation):
     pass
@@ -22,6 +22,10 @@ AU_MODEL_CACHE = os.environ.get(
                     'AU_MODEL_CACHE',
                     os.path.join(AU_CACHE, 'models'))
 
+AU_NORMALIZED_CACHE = os.environ.get(
+                    'AU_NORMALIZED_CACHE',
+                    os.path.join(AU_CACHE, 'normalized'))
+
 AU_TENSORBOARD_DIR = os.environ.get(
                     'AU_TENSORBOARD_DIR',
                     os.path.join(AU_CACHE, 'tensorboard'))
@@ -0,0 +1,657 @@
+"""Streaming, mergeable summaries of activations.  Each summary is updated in
+vectorized blocks of [N, D] activations (N examples of D neurons) and
+supports `+=` with a summary of another shard (e.g. a Spark partition), in
+the way `util.ThruputObserver` does."""
+
+import au
+from au import util
+
+import numpy as np
+
+def _as_matrix(acts):
+  """Return `acts`, a batch of N activations of any shape, as an [N, D]
+  array"""
+  acts = np.asarray(acts)
+  return acts.reshape((acts.shape[0], -1)) if acts.ndim != 2 else acts
+
+class RunningMoments(object):
+  """Per-neuron count, mean, variance, min and max; we merge blocks using
+  Chan et al.'s parallel update so merged results match a single pass."""
+
+  def __init__(self):
+    self.n = 0
+    self.mean = None
+    self.m2 = None
+    self.min = None
+    self.max = None
+
+  def update(self, acts):
+    acts = _as_matrix(acts).astype(np.float64)
+    if not len(acts):
+      return
+    mean = acts.mean(axis=0)
+    m2 = np.square(acts - mean).sum(axis=0)
+    self._combine(len(acts), mean, m2, acts.min(axis=0), acts.max(axis=0))
+
+  def __iadd__(self, other):
+    if other.n:
+      self._combine(other.n, other.mean, other.m2, other.min, other.max)
+    return self
+
+  @property
+  def variance(self):
+    return self.m2 / self.n if self.n else None
+
+  @property
+  def std(self):
+    return np.sqrt(self.variance) if self.n else None
+
+  def _combine(self, n, mean, m2, min_, max_):
+    if not self.n:
+      self.n = n
+      self.mean, self.m2 = mean.copy(), m2.copy()
+      self.min, self.max = min_.copy(), max_.copy()
+      return
+    total = self.n + n
+    delta = mean - self.mean
+    self.mean = self.mean + delta * (float(n) / total)
+    self.m2 = self.m2 + m2 + np.square(delta) * (float(self.n) * n / total)
+    self.min = np.minimum(self.min, min_)
+    self.max = np.maximum(self.max, max_)
+    self.n = total
+
+class QuantileSketch(object):
+  """A mergeable per-neuron quantile sketch in the style of KLL (Karnin,
+  Lang & Liberty 2016).  Level h holds rows of weight 2^h; once a level has
+  `k` rows we sort each neuron's values and promote every other one (from a
+  random offset) to level h + 1.  All neurons share the row structure, so
+  updates and queries are whole-matrix NumPy ops.  Memory is about
+  k * log2(n / k) rows; rank error is roughly O(log2(n / k) / k)."""
+
+  DEFAULT_K = 128
+
+  def __init__(self, k=DEFAULT_K, seed=None):
+    self.k = k
+    self.n = 0
+    self.levels = [] # Level h -> [rows, D] array
+    self._rand = np.random.RandomState(seed)
+
+  def update(self, acts):
+    acts = _as_matrix(acts).astype(np.float32)
+    if len(acts):
+      self.n += len(acts)
+      self._add(0, acts)
+
+  def __iadd__(self, other):
+    assert self.k == other.k, "Can't merge sketches of different sizes"
+    self.n += other.n
+    for h, rows in enumerate(other.levels):
+      if len(rows):
+        self._add(h, rows)
+    return self
+
+  def quantiles(self, qs):
+    """Return a [len(qs), D] array of approximate quantiles (in [0, 1])"""
+    qs = np.atleast_1d(qs)
+    if not self.n:
+      return None
+    values = np.concatenate([rows for rows in self.levels if len(rows)])
+    weights = np.concatenate([
+      np.full(len(rows), 2 ** h, dtype=np.int64)
+      for h, rows in enumerate(self.levels) if len(rows)
+    ])
+    order = np.argsort(values, axis=0)
+    cum_weights = np.cumsum(weights[order], axis=0)
+    cols = np.arange(values.shape[1])
+    out = np.empty((len(qs), values.shape[1]), dtype=values.dtype)
+    for i, q in enumerate(qs):
+      # Take the first value whose cumulative weight covers rank q
+      idx = (cum_weights < q * cum_weights[-1]).sum(axis=0)
+      idx = np.minimum(idx, len(values) - 1)
+      out[i] = values[order[idx, cols], cols]
+    return out
+
+  def _add(self, h, rows):
+    while len(self.levels) <= h:
+      self.levels.append(np.empty((0, rows.shape[1]), dtype=np.float32))
+    self.levels[h] = np.concatenate([self.levels[h], rows])
+    while h < len(self.levels) and len(self.levels[h]) >= self.k:
+      level = self.levels[h]
+      # Keep one row behind if we have an odd number
+      n_keep = len(level) % 2
+      compact = np.sort(level[n_keep:], axis=0)
+      promoted = compact[self._rand.randint(2)::2]
+      self.levels[h] = level[:n_keep]
+      if len(self.levels) == h + 1:
+        self.levels.append(np.empty((0, rows.shape[1]), dtype=np.float32))
+      self.levels[h + 1] = np.concatenate([self.levels[h + 1], promoted])
+      h += 1
+
+class Histogram(object):
+  """Per-neuron counts over fixed, shared bin `edges`, plus one underflow
+  and one overflow bin.  The default edges span both signs on a log scale
+  (four bins per decade from 1e-3 to 1e3) since activation scales vary
+  widely across layers."""
+
+  DEFAULT_EDGES = np.concatenate([
+    -np.logspace(3, -3, 25), [0.], np.logspace(-3, 3, 25)])
+
+  def __init__(self, edges=None):
+    self.edges = np.asarray(
+      self.DEFAULT_EDGES if edges is None else edges, dtype=np.float64)
+    self.counts = None # [D, len(edges) + 1]
+
+  @property
+  def n_bins(self):
+    return len(self.edges) + 1
+
+  def update(self, acts):
+    acts = _as_matrix(acts)
+    if not len(acts):
+      return
+    n_neurons = acts.shape[1]
+    if self.counts is None:
+      self.counts = np.zeros((n_neurons, self.n_bins), dtype=np.int64)
+    idx = np.searchsorted(self.edges, acts, side='right')
+    idx += np.arange(n_neurons) * self.n_bins
+    self.counts += np.bincount(
+      idx.ravel(), minlength=self.counts.size).reshape(self.counts.shape)
+
+  def __iadd__(self, other):
+    assert np.array_equal(self.edges, other.edges), "Bins differ"
+    if other.counts is not None:
+      if self.counts is None:
+        self.counts = other.counts.copy()
+      else:
+        self.counts += other.counts
+    return self
+
+  def bin_log_probs(self, acts, alpha=1.):
+    """Return the [N, D] log (smoothed by `alpha`) probability mass of each
+    neuron's bin for a batch of activations `acts`; before any updates,
+    every bin is equally likely (as with zero counts)"""
+    acts = _as_matrix(acts)
+    if self.counts is None:
+      return np.full(acts.shape, -np.log(self.n_bins))
+    idx = np.searchsorted(self.edges, acts, side='right')
+    n = self.counts.sum(axis=1, keepdims=True)
+    log_probs = (
+      np.log(self.counts + alpha) - np.log(n + alpha * self.n_bins))
+    return log_probs[np.arange(acts.shape[1]), idx]
+
+class ActivationStats(au.ActivationDistribution):
+  """Running moments, quantile sketches and histograms for every neuron of
+  one tensor.  `compute_prob_of()` treats neurons as independent and uses
+  the histograms."""
+
+  def __init__(self, sketch_k=QuantileSketch.DEFAULT_K, hist_edges=None,
+               seed=None):
+    self.moments = RunningMoments()
+    self.sketch = QuantileSketch(k=sketch_k, seed=seed)
+    self.hist = Histogram(edges=hist_edges)
+    self.shape = None
+
+  @property
+  def n(self):
+    return self.moments.n
+
+  def tally(self, activation):
+    self.tally_batch(np.asarray(activation)[np.newaxis, ...])
+
+  def tally_batch(self, acts):
+    """Tally a batch (an array of N activations)"""
+    acts = np.asarray(acts)
+    if self.shape is None:
+      self.shape = acts.shape[1:]
+    assert acts.shape[1:] == self.shape, (acts.shape, self.shape)
+    acts = _as_matrix(acts)
+    self.moments.update(acts)
+    self.sketch.update(acts)
+    self.hist.update(acts)
+
+  def __iadd__(self, other):
+    if self.shape is None:
+      self.shape = other.shape
+    self.moments += other.moments
+    self.sketch += other.sketch
+    self.hist += other.hist
+    return self
+
+  def quantiles(self, qs):
+    """Return an array of shape [len(qs)] + shape of approximate
+    per-neuron quantiles"""
+    return self.sketch.quantiles(qs).reshape((-1,) + self.shape)
+
+  def compute_log_prob_of(self, acts):
+    """Return the log probabilities of a batch of activations `acts`"""
+    return self.hist.bin_log_probs(acts).sum(axis=1)
+
+  def compute_prob_of(self, act):
+    return np.exp(self.compute_log_prob_of(np.asarray(act)[np.newaxis])[0])
+
+class ActivationStatsObserver(au.ActivationObserver):
+  """Maintains `ActivationStats` for every (model name, tensor name) it
+  observes.  Activations are buffered and tallied in blocks of
+  `BLOCK_SIZE` so that updates vectorize.  Observers merge with `+=`, so
+  e.g. one per Spark partition can be reduced into one (see
+  `observe_rdd()`)."""
+
+  BLOCK_SIZE = 256
+
+  def __init__(self, **stats_kwargs):
+    self.stats_kwargs = stats_kwargs
+    self.stats = {} # (model name, tensor name) -> ActivationStats
+    self._buffers = {} # (model name, tensor name) -> [np.array]
+
+  def record(self, activations):
+    for tensor_name, value in activations.get_tensor_to_value().iteritems():
+      key = (activations.model_name, tensor_name)
+      buf = self._buffers.setdefault(key, [])
+      buf.append(value)
+      if len(buf) >= self.BLOCK_SIZE:
+        self._flush(key)
+
+  def observe_rows(self, imagerows):
+    """Record the activations of (and then pass through) `ImageRow`s in
+    `imagerows`, e.g. the output of `FillActivationsTFDataset`, so that we
+    build distributions in one pass without writing activations out."""
+    for row in imagerows:
+      if row.attrs is not '':
+        self.record_multiple(row.attrs.get('activations', []))
+      yield row
+    self.flush()
+
+  def get_stats(self, model_name, tensor_name):
+    self.flush()
+    return self.stats.get((model_name, tensor_name))
+
+  def flush(self):
+    for key in self._buffers.keys():
+      self._flush(key)
+
+  def __iadd__(self, other):
+    self.flush()
+    other.flush()
+    for key, stats in other.stats.iteritems():
+      if key in self.stats:
+        self.stats[key] += stats
+      else:
+        self.stats[key] = stats
+    return self
+
+  def __getstate__(self):
+    self.flush()
+    return self.__dict__
+
+  @classmethod
+  def observe_rdd(cls, imagerow_rdd, **stats_kwargs):
+    """Return an observer of all activations in `imagerow_rdd` built with
+    one pass over its partitions"""
+    def observe(imagerows):
+      observer = cls(**stats_kwargs)
+      for _ in observer.observe_rows(imagerows):
+        pass
+      yield observer
+    
+    def merge(o1, o2):
+      o1 += o2
+      return o1
+
+    return imagerow_rdd.mapPartitions(observe).treeReduce(merge)
+
+  def _flush(self, key):
+    buf = self._buffers.pop(key, None)
+    if not buf:
+      return
+    if key not in self.stats:
+      self.stats[key] = ActivationStats(**self.stats_kwargs)
+    self.stats[key].tally_batch(np.stack(buf))
+
+class RandomFerns(au.ActivationDistribution):
+  """A random ferns (Ozuysal et al. 2010) model of [N, D] activations, e.g.
+  MNIST's upper layer ('sequential/dense/Relu:0').  Each of `n_ferns` ferns
+  applies `depth` binary tests `x[i] > t` to an activation, and the results
+  index a cell of the fern's count table.  We keep counts per class (or
+  for a single class if `n_classes` is 1) as one dense integer array of
+  shape [n_ferns, n_classes, 2^depth], so tallying is one `np.bincount()`
+  and merging (e.g. across Spark partitions) is a sum.
+
+  Probabilities are semi-naive Bayes: a product over ferns of (smoothed)
+  cell frequencies.  Thresholds default to zero (i.e. "is the ReLU
+  active?"); use `from_stats()` to draw them from observed quantiles.
+  """
+
+  BLOCK_SIZE = 1024
+
+  def __init__(
+        self,
+        dim,
+        n_ferns=50,
+        depth=10,
+        n_classes=1,
+        thresholds=None,
+        alpha=1.,
+        seed=1337):
+    
+    self.dim = dim
+    self.n_ferns = n_ferns
+    self.depth = depth
+    self.n_classes = n_classes
+    self.alpha = alpha
+    
+    rand = np.random.RandomState(seed)
+    self.features = rand.randint(dim, size=(n_ferns, depth))
+    if thresholds is None:
+      thresholds = np.zeros((n_ferns, depth), dtype=np.float32)
+    self.thresholds = np.asarray(thresholds, dtype=np.float32)
+    assert self.thresholds.shape == self.features.shape
+    self.counts = np.zeros(
+      (n_ferns, n_classes, 2 ** depth), dtype=np.int64)
+
+  @classmethod
+  def from_stats(cls, stats, q_range=(0.1, 0.9), seed=1337, **kwargs):
+    """Create ferns whose tests use thresholds at random quantiles (in
+    `q_range`) of each tested neuron, given `ActivationStats` `stats`
+    (e.g. from a first pass with an `ActivationStatsObserver`)"""
+    dim = int(np.prod(stats.shape))
+    ferns = cls(dim, seed=seed, **kwargs)
+    rand = np.random.RandomState(seed + 1)
+    qs = np.linspace(q_range[0], q_range[1], 9)
+    quantiles = stats.sketch.quantiles(qs) # [len(qs), D]
+    q_idx = rand.randint(len(qs), size=ferns.features.shape)
+    ferns.thresholds = quantiles[q_idx, ferns.features].astype(np.float32)
+    return ferns
+
+  @property
+  def n(self):
+    return self.counts[0].sum()
+
+  def cells(self, acts):
+    """Return the [N, n_ferns] cell index of each activation in each fern"""
+    acts = _as_matrix(acts)
+    bits = acts[:, self.features] > self.thresholds # [N, n_ferns, depth]
+    weights = 1 << np.arange(self.depth)
+    return bits.dot(weights)
+
+  def tally(self, activation, label=0):
+    self.tally_batch(np.asarray(activation)[np.newaxis], labels=[label])
+
+  def tally_batch(self, acts, labels=None):
+    """Tally a batch of activations with (integer) class `labels`, if any"""
+    cells = self.cells(acts)
+    n_cells = 2 ** self.depth
+    if labels is None:
+      labels = np.zeros(len(cells), dtype=np.int64)
+    labels = np.asarray(labels)
+    assert np.all(labels < self.n_classes), "Label out of range"
+    idx = (
+      (np.arange(self.n_ferns) * self.n_classes)[np.newaxis, :] +
+      labels[:, np.newaxis]) * n_cells + cells
+    self.counts += np.bincount(
+      idx.ravel(), minlength=self.counts.size).reshape(self.counts.shape)
+
+  def __iadd__(self, other):
+    assert np.array_equal(self.features, other.features), "Ferns differ"
+    assert np.array_equal(self.thresholds, other.thresholds), "Ferns differ"
+    self.counts += other.counts
+    return self
+
+  def class_log_likelihoods(self, acts):
+    """Return [N, n_classes] log P(acts | class)"""
+    cells = self.cells(acts)
+    n_cells = 2 ** self.depth
+    class_n = self.counts.sum(axis=2) # [n_ferns, n_classes]
+    log_freqs = (
+      np.log(self.counts + self.alpha) -
+      np.log(class_n + self.alpha * n_cells)[..., np.newaxis])
+    # [N, n_ferns, n_classes]
+    fern_lls = log_freqs[np.arange(self.n_ferns)[np.newaxis, :], :, cells]
+    return fern_lls.sum(axis=1)
+
+  def class_log_priors(self):
+    class_n = self.counts[0].sum(axis=1).astype(np.float64)
+    return np.log(class_n + self.alpha) - np.log(
+                  class_n.sum() + self.alpha * self.n_classes)
+
+  def predict_log_proba(self, acts):
+    """Return [N, n_classes] log P(class | acts)"""
+    joint = self.class_log_likelihoods(acts) + self.class_log_priors()
+    return joint - _logsumexp(joint, axis=1)[:, np.newaxis]
+
+  def predict(self, acts):
+    return np.argmax(self.predict_log_proba(acts), axis=1)
+
+  def compute_log_prob_of(self, acts):
+    """Return the (marginal over classes) log probabilities of a batch of
+    activations `acts`; low values suggest out-of-distribution inputs"""
+    joint = self.class_log_likelihoods(acts) + self.class_log_priors()
+    return _logsumexp(joint, axis=1)
+
+  def compute_prob_of(self, act):
+    return np.exp(self.compute_log_prob_of(np.asarray(act)[np.newaxis])[0])
+
+  def tally_rdd(self, tensor_rdd):
+    """Tally RDD `tensor_rdd` of (uri, numpy array) or (uri, numpy array,
+    integer label) tuples (e.g. from `ActivationsTable.as_tensor_rdd()`) in
+    one pass: each partition tallies blocks of `BLOCK_SIZE` activations
+    into its own count table, and we sum the tables."""
+    import copy
+    empty = copy.copy(self)
+    empty.counts = np.zeros_like(self.counts)
+
+    def tally_partition(rows):
+      ferns = copy.deepcopy(empty)
+      for block in util.ichunked(rows, self.BLOCK_SIZE):
+        acts = np.stack([np.asarray(r[1]).ravel() for r in block])
+        labels = [r[2] for r in block] if len(block[0]) > 2 else None
+        ferns.tally_batch(acts, labels=labels)
+      yield ferns.counts
+    
+    self.counts += tensor_rdd.mapPartitions(tally_partition).treeReduce(
+                                                                  np.add)
+    return self
+
+class KernelDensity(au.ActivationDistribution):
+  """A Gaussian Parzen-window (kernel density) estimate over (a sample of)
+  all tallied activations.  To scale to millions of reference points:
+   * Subsampling: we keep a uniform sample of at most `max_points`
+       activations (the ones with the smallest keys, which are a seeded
+       hash of each activation, so the sample merges across shards and
+       doesn't depend on how activations were sharded).
+   * Coresets: optionally (`grid_width`), snap points to a grid and keep one
+       weighted centroid per occupied cell.
+   * Tree pruning: a kd-tree (median splits on the widest dimension) groups
+       the points into leaves of at most `leaf_size` points, each bounded
+       by a ball.  We skip leaves whose balls are more than `cutoff`
+       bandwidths from a query (each point there contributes less than
+       exp(-cutoff^2 / 2) of its weight).
+   * Blocked evaluation: we compare blocks of `query_block` queries with
+       each surviving leaf in single matrix products, and accumulate
+       densities in log space so they don't underflow in high dimensions.
+  """
+
+  DEFAULT_MAX_POINTS = int(1e6)
+
+  def __init__(
+        self,
+        bandwidth=None,
+        max_points=DEFAULT_MAX_POINTS,
+        grid_width=None,
+        leaf_size=256,
+        cutoff=4.,
+        query_block=1024,
+        seed=1337):
+
+    self.bandwidth = bandwidth
+    self.max_points = max_points
+    self.grid_width = grid_width
+    self.leaf_size = leaf_size
+    self.cutoff = cutoff
+    self.query_block = query_block
+    self.n = 0
+    self.seed = seed
+    self._points = None # [M, D] float32 sample
+    self._keys = None   # [M] sampling keys
+    self._tree = None
+    self._fitted_bandwidth = None # `bandwidth` or Scott's rule; see fit()
+
+  def tally(self, activation):
+    self.tally_batch(np.asarray(activation)[np.newaxis])
+
+  def tally_batch(self, acts):
+    acts = _as_matrix(acts).astype(np.float32)
+    self.n += len(acts)
+    self._add_sample(acts, _hash_rows(acts, self.seed or 0))
+
+  def __iadd__(self, other):
+    self.n += other.n
+    if other._points is not None:
+      self._add_sample(other._points, other._keys)
+    return self
+
+  def fit(self):
+    """Build the coreset and tree (we do so lazily on first query)"""
+    if self._points is None:
+      raise ValueError("Can't fit a KernelDensity with no activations")
+    points = self._points.astype(np.float64)
+    weights = np.ones(len(points))
+    if self.grid_width:
+      points, weights = self._grid_coreset(points, self.grid_width)
+    self._fitted_bandwidth = self.bandwidth
+    if self._fitted_bandwidth is None:
+      # Scott's rule (NB: refit as we tally more points)
+      self._fitted_bandwidth = float(
+        np.mean(points.std(axis=0)) *
+        len(points) ** (-1. / (points.shape[1] + 4)))
+    self._tree = _BallLeaves(points, weights, self.leaf_size)
+    return self
+
+  def compute_log_prob_of(self, acts):
+    """Return the log densities of a batch of activations `acts`"""
+    if self._tree is None:
+      self.fit()
+    acts = _as_matrix(acts).astype(np.float64)
+    return np.concatenate([
+      self._log_density(acts[start:start + self.query_block])
+      for start in range(0, len(acts), self.query_block)
+    ] or [np.zeros(0)])
+
+  def compute_prob_of(self, act):
+    return np.exp(self.compute_log_prob_of(np.asarray(act)[np.newaxis])[0])
+
+  def _add_sample(self, points, keys):
+    if self._points is not None:
+      points = np.concatenate([self._points, points])
+      keys = np.concatenate([self._keys, keys])
+    if len(points) > self.max_points:
+      keep = np.argpartition(keys, self.max_points)[:self.max_points]
+      points, keys = points[keep], keys[keep]
+    self._points, self._keys = points, keys
+    self._tree = None
+
+  @staticmethod
+  def _grid_coreset(points, grid_width):
+    """Return (centroids, counts) of the points in each occupied cell"""
+    cells = np.floor(points / grid_width).astype(np.int64)
+    _, inverse = np.unique(
+      cells.view([('', cells.dtype)] * cells.shape[1]), return_inverse=True)
+    inverse = inverse.ravel()
+    order = np.argsort(inverse, kind='mergesort')
+    counts = np.bincount(inverse)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    sums = np.add.reduceat(points[order], starts, axis=0)
+    return sums / counts[:, np.newaxis], counts.astype(np.float64)
+
+  def _log_density(self, queries):
+    tree = self._tree
+    h = self._fitted_bandwidth
+    dim = queries.shape[1]
+    
+    # Lower bounds on the distance from each query to each leaf
+    to_centers = np.sqrt(np.maximum(_sq_dists(queries, tree.centers), 0))
+    lower = np.maximum(to_centers - tree.radii, 0)
+    active = lower <= self.cutoff * h
+    
+    # Queries far from everything still get their nearest leaf
+    nearest = np.argmin(lower, axis=1)
+    active[np.arange(len(queries)), nearest] = True
+    
+    # Accumulate log sum_i w_i exp(-|q - p_i|^2 / 2h^2) as max + log(sum)
+    run_max = np.full(len(queries), -np.inf)
+    run_sum = np.zeros(len(queries))
+    for leaf in np.flatnonzero(active.any(axis=0)):
+      q_idx = np.flatnonzero(active[:, leaf])
+      lo, hi = tree.starts[leaf], tree.starts[leaf + 1]
+      log_k = (
+        -_sq_dists(queries[q_idx], tree.points[lo:hi]) / (2 * h * h) +
+        tree.log_weights[lo:hi])
+      leaf_max = log_k.max(axis=1)
+      new_max = np.maximum(run_max[q_idx], leaf_max)
+      run_sum[q_idx] = (
+        run_sum[q_idx] * np.exp(run_max[q_idx] - new_max) +
+        np.exp(log_k - new_max[:, np.newaxis]).sum(axis=1))
+      run_max[q_idx] = new_max
+    
+    log_norm = (
+      np.log(tree.total_weight) + 0.5 * dim * np.log(2 * np.pi * h * h))
+    return run_max + np.log(run_sum) - log_norm
+
+class _BallLeaves(object):
+  """The leaves of a kd-tree over weighted `points`: points are permuted so
+  that leaf i holds points[starts[i]:starts[i + 1]], which lie within
+  radii[i] of centers[i]"""
+
+  def __init__(self, points, weights, leaf_size):
+    perm = np.arange(len(points))
+    ranges = []
+    stack = [(0, len(points))]
+    while stack:
+      lo, hi = stack.pop()
+      if hi - lo <= leaf_size:
+        ranges.append((lo, hi))
+        continue
+      idx = perm[lo:hi]
+      axis = np.argmax(np.ptp(points[idx], axis=0))
+      mid = (hi - lo) // 2
+      split = np.argpartition(points[idx, axis], mid)
+      perm[lo:hi] = idx[split]
+      stack.append((lo + mid, hi))
+      stack.append((lo, lo + mid))
+    ranges.sort()
+
+    self.points = points[perm]
+    self.log_weights = np.log(weights[perm])
+    self.total_weight = weights.sum()
+    self.starts = np.array([lo for lo, _ in ranges] + [len(points)])
+    self.centers = np.array([
+      self.points[lo:hi].mean(axis=0) for lo, hi in ranges])
+    self.radii = np.array([
+      np.sqrt(_sq_dists(c[np.newaxis], self.points[lo:hi]).max())
+      for c, (lo, hi) in zip(self.centers, ranges)])
+
+def _sq_dists(a, b):
+  """Return the [len(a), len(b)] squared L2 distances between rows"""
+  d2 = (
+    np.square(a).sum(axis=1)[:, np.newaxis] +
+    np.square(b).sum(axis=1)[np.newaxis, :] -
+    2 * a.dot(b.T))
+  return np.maximum(d2, 0)
+
+def _hash_rows(rows, seed):
+  """Return a uint64 hash of each row of float32 matrix `rows`"""
+  bits = np.ascontiguousarray(rows, dtype=np.float32).view(np.uint32)
+  h = np.full(len(rows), seed, dtype=np.uint64)
+  for col in bits.T:
+    h = _mix64(h ^ col.astype(np.uint64))
+  return _mix64(h)
+
+def _mix64(h):
+  # NB: SplitMix64's finalizer; uint64 array arithmetic wraps around
+  h = (h ^ (h >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+  h = (h ^ (h >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+  return h ^ (h >> np.uint64(31))
+
+def _logsumexp(x, axis):
+  x_max = np.max(x, axis=axis, keepdims=True)
+  return np.log(np.exp(x - x_max).sum(axis=axis)) + np.squeeze(
+                                                      x_max, axis=axis)
@@ -1,5 +1,6 @@
 import io
 import os
+import threading
 from collections import OrderedDict
 
 import imageio
@@ -47,6 +48,12 @@ class ImageRow(object):
   DEFAULT_PQ_PARTITION_COLS = ['dataset', 'split']
     # NB: must be a list and not a tuple due to pyarrow c++ api
 
+  # Parquet columns, in order; see to_dict()
+  PQ_COLUMNS = ('dataset', 'split', 'uri', 'image_bytes', 'label', 'attrs')
+  
+  # Roll Parquet files (when writing without Spark) at about this size
+  DEFAULT_PQ_FILE_BYTES = int(256e6)
+
   # Old pickle API requires __{get,set}state__ for classes that define
   # __slots__.  Some part of Spark uses this API for serializatio, so we
   # provide an impl.
@@ -113,11 +120,20 @@ class ImageRow(object):
         attrs.append((k, v))
 
       elif k == '_image_bytes':
-        attrs.append(('image_bytes', bytearray(self.image_bytes)))
-          # NB: must be bytearray to support parquet / pyspark type inference
+        attrs.append(('image_bytes', self.image_bytes))
+          # NB: no copy; see to_spark_row() for Spark
 #       elif k == '_label_bytes':
 #         attrs.append(('label_bytes', self.label_bytes))
     return OrderedDict(attrs)
+
+  def to_spark_row(self):
+    from pyspark.sql import Row
+    d = self.to_dict()
+    d['image_bytes'] = bytearray(d['image_bytes'])
+      # NB: must be bytearray to support pyspark type inference (a python 2
+      # `str` would be a Spark string).  Costs a copy; prefer the Arrow path
+      # in write_to_parquet()
+    return Row(**d)
   
   def as_numpy(self):
     if self._cached_image_arr is '':
@@ -234,6 +250,54 @@ class ImageRow(object):
       row.update(**kwargs)
       yield ImageRow(**row)
 
+  @staticmethod
+  def to_arrow_batch(rows, columns=PQ_COLUMNS, schema=None):
+    """Build a `pyarrow.RecordBatch` of `columns` straight from the given
+    `ImageRow`s (no dicts or pandas in between).  The first batch of a
+    table should omit `schema`: string columns are fixed as `string`,
+    `image_bytes` as `binary`, and we infer `label` and `attrs`.  Pass that
+    batch's schema for subsequent batches so that they all agree.
+    """
+    import pyarrow as pa
+
+    FIXED_TYPES = {
+      'dataset': pa.string(),
+      'split': pa.string(),
+      'uri': pa.string(),
+      'image_bytes': pa.binary(),
+    }
+
+    def to_value(row, k):
+      v = getattr(row, k)
+      if isinstance(v, str) and k != 'image_bytes':
+        # pyarrow + python 2.7 -> str gets interpreted as binary; see to_dict()
+        v = v.decode('utf-8')
+      return v
+
+    arrays = []
+    for k in columns:
+      values = [to_value(row, k) for row in rows]
+      if schema is not None:
+        t = schema.field_by_name(k).type
+      else:
+        t = FIXED_TYPES.get(k)
+      arrays.append(pa.array(values, type=t))
+    return pa.RecordBatch.from_arrays(arrays, list(columns))
+
+  @staticmethod
+  def arrow_schema(label_type=None, attrs_type=None):
+    """The Arrow schema for `ImageRow`s whose `label`s and `attrs` have the
+    given Arrow types (by default, strings)"""
+    import pyarrow as pa
+    return pa.schema([
+      pa.field('dataset', pa.string()),
+      pa.field('split', pa.string()),
+      pa.field('uri', pa.string()),
+      pa.field('image_bytes', pa.binary()),
+      pa.field('label', label_type or pa.string()),
+      pa.field('attrs', attrs_type or pa.string()),
+    ])
+
   @staticmethod
   def write_to_parquet(
         rows,
@@ -241,7 +305,14 @@ class ImageRow(object):
         rows_per_file=-1,
         partition_cols=DEFAULT_PQ_PARTITION_COLS,
         compression='lz4',
-        spark=None):
+        spark=None,
+        target_file_bytes=DEFAULT_PQ_FILE_BYTES,
+        arrow_schema=None):
+    """Write `rows` (an iterable or RDD of `ImageRow`s, or a DataFrame) to
+    `dest_dir`.  To have Spark executors build Arrow batches of an RDD's
+    rows (if Arrow is enabled), pass their `arrow_schema` (e.g.
+    `ImageRow.arrow_schema()`); otherwise, Spark infers a schema from
+    pickled Rows."""
     
     is_rdd, is_pyspark_df = False, False
     try:
@@ -256,11 +327,12 @@ class ImageRow(object):
     
     if is_rdd:
       assert spark is not None
-      from pyspark.sql import Row
-
+      
       # RDD[ImageRow] -> DataFrame[ImageRow]
-      rows_rdd = rows.map(lambda r: Row(**r.to_dict()))
-      df = spark.createDataFrame(rows_rdd)
+      df = ImageRow._to_arrow_df(spark, rows, arrow_schema)
+      if df is None:
+        rows_rdd = rows.map(lambda r: r.to_spark_row())
+        df = spark.createDataFrame(rows_rdd)
       is_pyspark_df = True
     
     if is_pyspark_df:
@@ -275,43 +347,51 @@ class ImageRow(object):
     
     else:
 
-      # Use Pyarrow to write Parquet in this process
-
-      import pandas as pd
-      import pyarrow as pa
-      import pyarrow.parquet as pq
-      
-      log = create_log()
-      
-      if rows_per_file >= 1:
-        irows = util.ichunked(rows, rows_per_file)
-      else:
-        rows = list(rows)
-        if not rows:
-          return
-        irows = iter([rows])
-      
+      # Use Pyarrow to write Parquet in this process; we stream so that
+      # memory use is bounded no matter how many rows we get
       util.log.info("Writing parquet to %s ..." % dest_dir)
-      for row_chunk in irows:
-        r = row_chunk[0]
-        
-        # Pandas wants dicts
-        if isinstance(r, ImageRow):
-          row_chunk = [r.to_dict() for r in row_chunk]
-
-        df = pd.DataFrame(row_chunk)
-        table = pa.Table.from_pandas(df)
-        util.mkdir(dest_dir)
-        pq.write_to_dataset(
-              table,
-              dest_dir,
-              partition_cols=partition_cols,
-              preserve_index=False, # Don't care about pandas index
-              compression='snappy',
-                # NB: pyarrow lz4 is totes broken https://github.com/apache/arrow/issues/3491
-              flavor='spark')
-        util.log.info("... wrote %s rows ..." % len(row_chunk))
-      util.log.info("... done writing to %s ." % dest_dir)
+      writer = ImageRowPQWriter(
+                  dest_dir,
+                  partition_cols=partition_cols,
+                  rows_per_file=rows_per_file,
+                  target_file_bytes=target_file_bytes)
+      with writer:
+        for row in rows:
+          writer.write(row)
+      if not writer.n_rows:
+        return
+      util.log.info(
+        "... done writing %s rows to %s ." % (writer.n_rows, dest_dir))
+
+    URIIndex.update(dest_dir, spark=spark if is_pyspark_df else None)
+
+  @staticmethod
+  def _to_arrow_df(spark, rows_rdd, arrow_schema):
+    """Try to convert `rows_rdd` to a DataFrame with `arrow_schema` by
+    building Arrow record batches on the executors (no per-row pickling, no
+    copies of image bytes into bytearrays, and no schema inference pass).
+    Return None if Arrow is disabled, we have no `arrow_schema`, or Spark
+    can't represent it.
+    """
+    from au.spark import Spark
+    if not Spark.is_arrow_enabled(spark) or arrow_schema is None:
+      return None
+    
+    try:
+      from pyspark.sql.types import from_arrow_schema
+      from_arrow_schema(arrow_schema)
+    except Exception as e:
+      util.log.info(
+        "Can't use Arrow for ImageRows, falling back to pyspark Rows: %s" % e)
+      return None
+    
+    def to_arrow_batches(irows):
+      for chunk in util.ichunked(irows, ImageRowPQWriter.ROW_GROUP_ROWS):
+        batch = ImageRow.to_arrow_batch(chunk, schema=arrow_schema)
+        yield batch.serialize().to_pybytes()
+
+    batch_rdd = rows_rdd.mapPartitions(to_arrow_batches)
+    return Spark.df_from_arrow_batch_rdd(spark, batch_rdd, arrow_schema)
 
   @staticmethod
   def write_to_pngs(rows, dest_root=None):
@@ -335,7 +415,424 @@ class ImageRow(object):
       n += 1
       if n % 100 == 0:
         util.log.info("... write %s PNGs ..." % n)
-    util.log.info("... wrote %s total PNGs to %s ." % (n, dest_root))  
+    util.log.info("... wrote %s total PNGs to %s ." % (n, dest_root))
+
+  @staticmethod
+  def iter_pq_pieces(src_dir, uris=None, datasets=None, splits=None):
+    """Generate (path, row group index, partition values) tuples for the
+    Parquet files under `src_dir` that might contain rows matching the given
+    predicates.  We prune whole files using the `key=value` partition
+    directories and individual row groups using min / max column statistics
+    (when the writer recorded them).  Nothing is read but file footers.
+    """
+    import pyarrow.parquet as pq
+
+    preds = _pq_predicates(uris=uris, datasets=datasets, splits=splits)
+    for path in iter_pq_files(src_dir):
+      partition = pq_partition_values(src_dir, path)
+      if not all(
+          partition[k] in values
+          for k, values in preds.iteritems() if k in partition):
+        continue
+
+      meta = pq.ParquetFile(path).metadata
+      for rg in range(meta.num_row_groups):
+        if _pq_row_group_may_match(meta.row_group(rg), preds):
+          yield path, rg, partition
+
+  @staticmethod
+  def read_pq_piece(
+        path,
+        rg,
+        partition=None,
+        uris=None,
+        datasets=None,
+        splits=None,
+        columns=None):
+    """Read a single row group (see `iter_pq_pieces()`) and return a list of
+    the `ImageRow`s matching the given predicates.  Use `columns` to project
+    out (i.e. avoid reading) expensive columns like `image_bytes`."""
+    import pyarrow.parquet as pq
+
+    partition = partition or {}
+    preds = _pq_predicates(uris=uris, datasets=datasets, splits=splits)
+    if columns is not None:
+      columns = list(columns)
+      columns = [c for c in columns if c not in partition]
+      columns += [k for k in preds if k not in partition and k not in columns]
+
+    table = pq.ParquetFile(path).read_row_group(rg, columns=columns)
+    df = table.to_pandas()
+    for k, values in preds.iteritems():
+      if k in df.columns:
+        df = df[df[k].isin(values)]
+    return list(ImageRow.from_pandas(df, **partition))
+
+  @staticmethod
+  def iter_from_parquet(
+        src_dir,
+        uris=None,
+        datasets=None,
+        splits=None,
+        columns=None):
+    """Stream `ImageRow`s from the Parquet table at `src_dir` one row group
+    at a time; memory use is bounded by the largest row group rather than
+    the size of the table.  See `iter_pq_pieces()` for predicate pushdown.
+    """
+    pieces = ImageRow.iter_pq_pieces(
+                src_dir, uris=uris, datasets=datasets, splits=splits)
+    for path, rg, partition in pieces:
+      rows = ImageRow.read_pq_piece(
+                path,
+                rg,
+                partition=partition,
+                uris=uris,
+                datasets=datasets,
+                splits=splits,
+                columns=columns)
+      for row in rows:
+        yield row
+
+
+def _pq_predicates(uris=None, datasets=None, splits=None):
+  """Return a map of column -> set of allowed values; accepts scalars
+  or iterables for each predicate"""
+  def to_set(v):
+    if isinstance(v, basestring):
+      return set([v])
+    return set(v)
+
+  preds = {}
+  for k, v in (('uri', uris), ('dataset', datasets), ('split', splits)):
+    if v is not None:
+      preds[k] = to_set(v)
+  return preds
+
+def iter_pq_files(src_dir):
+  """Generate (sorted) paths to the Parquet data files under `src_dir`"""
+
+  # Skip Spark / pyarrow metadata and any private dirs (e.g. `_SUCCESS`,
+  # `.crc` files)
+  for path in sorted(util.all_files_recursive(src_dir)):
+    relpath = os.path.relpath(path, src_dir)
+    if any(tok.startswith(('_', '.')) for tok in relpath.split(os.path.sep)):
+      continue
+    if path.endswith('.parquet'):
+      yield path
+
+def pq_partition_values(src_dir, path):
+  """Given `path` of the form `src_dir/k1=v1/k2=v2/x.parquet`, return
+  {'k1': 'v1', 'k2': 'v2'}"""
+  import urllib
+
+  relpath = os.path.relpath(os.path.dirname(path), src_dir)
+  partition = {}
+  for tok in relpath.split(os.path.sep):
+    if '=' in tok:
+      # NB: Spark percent-encodes special characters (e.g. '/', ':', '=')
+      # in partition directory names
+      k, v = tok.split('=', 1)
+      partition[urllib.unquote(k)] = urllib.unquote(v)
+  return partition
+
+def _pq_row_group_may_match(rg_meta, preds):
+  for j in range(rg_meta.num_columns):
+    col = rg_meta.column(j)
+    values = preds.get(col.path_in_schema)
+    if not values:
+      continue
+    stats = col.statistics
+    if stats is None or not stats.has_min_max:
+      continue
+    if not any(stats.min <= v <= stats.max for v in values):
+      return False
+  return True
+
+class URIIndex(object):
+  """A sidecar index for a Parquet table of `ImageRow`s that maps each `uri`
+  to (file, row group, row offset).  Point lookups then read only the row
+  groups that hold the requested rows.  The index lives in a `_`-prefixed
+  directory under the table root, so Spark and pyarrow ignore it when
+  reading the table itself.
+  """
+
+  INDEX_DIRNAME = '_au_index'
+  INDEX_FNAME = 'uri_index.parquet'
+
+  _cache_lock = threading.Lock()
+  _cache = {} # index path -> (mtime, uri -> (relpath, row group, offset))
+
+  @classmethod
+  def index_path(cls, table_dir):
+    return os.path.join(table_dir, cls.INDEX_DIRNAME, cls.INDEX_FNAME)
+
+  @classmethod
+  def build(cls, table_dir, spark=None):
+    """(Re-)build the index for all files in `table_dir`"""
+    paths = iter_pq_files(table_dir)
+    cls._write(table_dir, cls._index_files(table_dir, paths, spark))
+
+  @classmethod
+  def update(cls, table_dir, spark=None):
+    """Index only the files in `table_dir` that are new (or changed) since
+    the last build or update and merge them into the existing index;
+    drop entries for files that no longer exist.  Use `spark` to index files
+    on executors."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    dest = cls.index_path(table_dir)
+    if not os.path.exists(dest):
+      cls.build(table_dir, spark=spark)
+      return
+
+    index_mtime = os.path.getmtime(dest)
+    paths = list(iter_pq_files(table_dir))
+    relpath_to_path = dict(
+      (os.path.relpath(path, table_dir), path) for path in paths)
+    
+    index = pq.read_table(dest)
+    indexed_relpaths = set(index.column(1).to_pylist())
+    to_index = [
+      path for relpath, path in sorted(relpath_to_path.iteritems())
+      if relpath not in indexed_relpaths or
+        os.path.getmtime(path) > index_mtime
+    ]
+    to_drop = set(os.path.relpath(p, table_dir) for p in to_index)
+    to_drop.update(indexed_relpaths - set(relpath_to_path.keys()))
+    if not (to_index or to_drop):
+      return
+    if to_drop:
+      df = index.to_pandas()
+      df = df[~df['path'].isin(to_drop)]
+      index = pa.Table.from_pandas(
+        df, schema=index.schema, preserve_index=False)
+    cls._write(
+      table_dir, cls._index_files(table_dir, to_index, spark), base=index)
+
+  @staticmethod
+  def _index_file(table_dir, path):
+    """Return (uri, relpath, row group, row offset) tuples for the rows of
+    Parquet file `path`; we read only the `uri` column."""
+    import pyarrow.parquet as pq
+    relpath = os.path.relpath(path, table_dir)
+    pf = pq.ParquetFile(path)
+    if 'uri' not in pf.schema.names:
+      return []
+    entries = []
+    for rg in range(pf.num_row_groups):
+      rg_uris = pf.read_row_group(rg, columns=['uri']).column(0).to_pylist()
+      entries.extend(
+        (uri, relpath, rg, offset) for offset, uri in enumerate(rg_uris))
+    return entries
+
+  @classmethod
+  def _index_files(cls, table_dir, paths, spark=None):
+    paths = list(paths)
+    util.log.info(
+      "Indexing URIs of %s files in %s ..." % (len(paths), table_dir))
+    if spark is not None and paths:
+      index_file = cls._index_file
+      path_rdd = spark.sparkContext.parallelize(paths, numSlices=len(paths))
+      return path_rdd.flatMap(lambda p: index_file(table_dir, p)).collect()
+    else:
+      return [e for path in paths for e in cls._index_file(table_dir, path)]
+
+  @classmethod
+  def _write(cls, table_dir, entries, base=None):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    cols = zip(*entries) if entries else ([], [], [], [])
+    table = pa.Table.from_arrays([
+        pa.array(list(cols[0]), type=pa.string()),
+        pa.array(list(cols[1]), type=pa.string()),
+        pa.array(list(cols[2]), type=pa.int32()),
+        pa.array(list(cols[3]), type=pa.int32()),
+      ],
+      names=['uri', 'path', 'row_group', 'row_offset'])
+    if base is not None:
+      table = pa.concat_tables([base, table])
+
+    # Write then rename so that readers never see a partial index
+    dest = cls.index_path(table_dir)
+    util.mkdir(os.path.dirname(dest))
+    tmp_dest = dest + '.tmp.' + str(os.getpid())
+    pq.write_table(table, tmp_dest, compression='snappy')
+    os.rename(tmp_dest, dest)
+    util.log.info("... indexed %s rows to %s ." % (table.num_rows, dest))
+
+  @classmethod
+  def is_fresh(cls, table_dir):
+    """Is there an index that is no older than every data file?"""
+    dest = cls.index_path(table_dir)
+    if not os.path.exists(dest):
+      return False
+    index_mtime = os.path.getmtime(dest)
+    return all(
+      os.path.getmtime(path) <= index_mtime
+      for path in iter_pq_files(table_dir))
+
+  @classmethod
+  def _get_uri_to_location(cls, table_dir):
+    import pyarrow.parquet as pq
+
+    dest = cls.index_path(table_dir)
+    mtime = os.path.getmtime(dest)
+    with cls._cache_lock:
+      cached = cls._cache.get(dest)
+      if cached is None or cached[0] != mtime:
+        cols = pq.read_table(dest).to_pydict()
+        uri_to_location = dict(
+          (uri, (relpath, rg, offset))
+          for uri, relpath, rg, offset in zip(
+            cols['uri'], cols['path'], cols['row_group'], cols['row_offset']))
+        cached = (mtime, uri_to_location)
+        cls._cache[dest] = cached
+      return cached[1]
+
+  @classmethod
+  def iter_rows_by_uris(cls, table_dir, uris, columns=None):
+    """Generate `ImageRow`s for `uris` (ignoring URIs not in the table) by
+    reading only the row groups that hold them."""
+    import pyarrow.parquet as pq
+
+    uri_to_location = cls._get_uri_to_location(table_dir)
+    piece_to_offsets = {}
+    for uri in set(uris):
+      if uri in uri_to_location:
+        relpath, rg, offset = uri_to_location[uri]
+        piece_to_offsets.setdefault((relpath, rg), []).append(offset)
+
+    for (relpath, rg), offsets in sorted(piece_to_offsets.iteritems()):
+      path = os.path.join(table_dir, relpath)
+      partition = pq_partition_values(table_dir, path)
+      piece_columns = None
+      if columns is not None:
+        piece_columns = [c for c in columns if c not in partition]
+        if 'uri' not in piece_columns:
+          piece_columns.append('uri')
+      table = pq.ParquetFile(path).read_row_group(rg, columns=piece_columns)
+      df = table.to_pandas().iloc[sorted(offsets)]
+      for row in ImageRow.from_pandas(df, **partition):
+        yield row
+
+class ImageRowPQWriter(object):
+  """Streams `ImageRow`s into a partitioned (Spark-style `k=v` directories)
+  Parquet table using one open `ParquetWriter` per partition.  Each partition
+  buffers at most one row group of rows; files roll after `rows_per_file`
+  rows (if positive) or about `target_file_bytes` bytes.  Thus peak memory
+  is bounded by the number of partitions rather than the number of rows.
+  Use as a context manager (or call `close()`) to flush.
+  """
+
+  ROW_GROUP_BYTES = int(32e6)
+  ROW_GROUP_ROWS = 1000
+
+  class _Partition(object):
+    __slots__ = ('dir', 'rows', 'n_buf_bytes', 'writer', 'n_file_rows',
+                 'n_file_bytes')
+
+    def __init__(self, dir):
+      self.dir = dir
+      self.rows = []
+      self.n_buf_bytes = 0
+      self.writer = None
+      self.n_file_rows = 0
+      self.n_file_bytes = 0
+
+  def __init__(
+        self,
+        dest_dir,
+        partition_cols=ImageRow.DEFAULT_PQ_PARTITION_COLS,
+        rows_per_file=-1,
+        target_file_bytes=ImageRow.DEFAULT_PQ_FILE_BYTES,
+        compression='snappy'):
+          # NB: pyarrow lz4 is totes broken https://github.com/apache/arrow/issues/3491
+
+    self.dest_dir = dest_dir
+    self.partition_cols = list(partition_cols or [])
+    self.columns = [
+      c for c in ImageRow.PQ_COLUMNS if c not in self.partition_cols]
+    self.rows_per_file = rows_per_file
+    self.target_file_bytes = target_file_bytes
+    self.compression = compression
+    self.schema = None
+    self.n_rows = 0
+    self._partitions = {}
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def write(self, row):
+    if not isinstance(row, ImageRow):
+      row = ImageRow(**row)
+
+    key = tuple(str(getattr(row, c)) for c in self.partition_cols)
+    if key not in self._partitions:
+      subdir = os.path.join(*(
+        ['%s=%s' % kv for kv in zip(self.partition_cols, key)] or ['']))
+      self._partitions[key] = self._Partition(
+                                  os.path.join(self.dest_dir, subdir))
+    p = self._partitions[key]
+
+    p.rows.append(row)
+    p.n_buf_bytes += len(row.image_bytes) + len(row.uri)
+    self.n_rows += 1
+
+    max_rows = self.ROW_GROUP_ROWS
+    if self.rows_per_file >= 1:
+      max_rows = min(max_rows, self.rows_per_file - p.n_file_rows)
+    if len(p.rows) >= max_rows or p.n_buf_bytes >= self.ROW_GROUP_BYTES:
+      self._flush(p)
+
+  def close(self):
+    for p in self._partitions.itervalues():
+      self._flush(p)
+      self._roll(p)
+    self._partitions = {}
+
+  def _flush(self, p):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if not p.rows:
+      return
+
+    batch = ImageRow.to_arrow_batch(
+                p.rows, columns=self.columns, schema=self.schema)
+    if self.schema is None:
+      self.schema = batch.schema
+
+    if p.writer is None:
+      import uuid
+      util.mkdir(p.dir)
+      path = os.path.join(p.dir, uuid.uuid4().hex + '.parquet')
+      p.writer = pq.ParquetWriter(
+                    path,
+                    self.schema,
+                    compression=self.compression,
+                    flavor='spark')
+    p.writer.write_table(pa.Table.from_batches([batch]))
+    p.n_file_rows += len(p.rows)
+    p.n_file_bytes += p.n_buf_bytes
+    p.rows = []
+    p.n_buf_bytes = 0
+
+    if ((self.rows_per_file >= 1 and p.n_file_rows >= self.rows_per_file) or
+        p.n_file_bytes >= self.target_file_bytes):
+      self._roll(p)
+
+  def _roll(self, p):
+    if p.writer is not None:
+      p.writer.close()
+      p.writer = None
+      p.n_file_rows = 0
+      p.n_file_bytes = 0
+
 
 
 
@@ -371,27 +868,342 @@ def _make_have_target_chan(img, nchan):
   else:
     raise ValueError("TODO idk yet %s %s" % (nchan, shape,))
 
+class ImageDecoder(object):
+  """Decodes batches of `ImageRow`s in a (per-process, shared) thread pool.
+  Both `cv2.imdecode()` and PIL release the GIL while decoding, so threads
+  give real parallelism without the pickling overhead of a process pool.
+  Optionally decodes JPEGs at reduced resolution (libjpeg DCT scaling via
+  PIL's `draft()`; `cv2.imdecode()` ignores the IMREAD_REDUCED_* flags in
+  the opencv we use) when the caller will resize down to `target_hw`
+  anyway.
+
+  NB: The 'cv2' and 'imageio' backends may disagree by +/- 1 on some
+  JPEG pixels; use 'imageio' for exact parity with `ImageRow.as_numpy()`.
+  """
+
+  BACKENDS = ('cv2', 'imageio')
+  N_THREADS = 8
+
+  _pool_lock = threading.Lock()
+  _pool = None
+
+  def __init__(
+        self,
+        backend='cv2',
+        target_hw=None,
+        target_nchan=None,
+        reduced_decode=False,
+        n_threads=None):
+
+    if backend not in self.BACKENDS:
+      raise ValueError("Unknown backend %s, try one of %s" % (
+                          backend, self.BACKENDS))
+    self.backend = backend
+    self.target_hw = target_hw
+    self.target_nchan = target_nchan
+    self.reduced_decode = bool(reduced_decode and target_hw is not None)
+    self.n_threads = n_threads or self.N_THREADS
+
+  @property
+  def variant(self):
+    """A name for the kind of images this decoder produces (e.g. for keying
+    a `NormalizedCache`)"""
+    return self.backend + ('-reduced' if self.reduced_decode else '')
+
+  @classmethod
+  def _pool_map(cls, n_threads, func, items):
+    """`map()` in the shared pool, which we replace with a bigger one if
+    it has fewer than `n_threads` threads"""
+    old_pool = None
+    with cls._pool_lock:
+      if cls._pool is None or cls._pool._processes < n_threads:
+        from multiprocessing.pool import ThreadPool
+        old_pool, cls._pool = cls._pool, ThreadPool(processes=n_threads)
+      # NB: Submit under the lock so that we never submit to a closed pool
+      result = cls._pool.map_async(func, items)
+    if old_pool is not None:
+      # Let the old pool finish any work it has, then reap its threads
+      old_pool.close()
+      old_pool.join()
+    return result.get()
+
+  def _decode_reduced(self, image_bytes):
+    """Try to decode a JPEG at the smallest DCT scale (1/2, 1/4 or 1/8)
+    that is still at least `target_hw`; return None for non-JPEGs."""
+    if image_bytes[:2] != b'\xff\xd8':
+      return None
+    from PIL import Image
+    img = Image.open(io.BytesIO(image_bytes))
+    full_size = img.size
+    h, w = self.target_hw
+    if self.target_nchan is None:
+      # Keep the source's channels, like a full decode
+      mode = 'L' if img.mode == 'L' else 'RGB'
+    else:
+      mode = 'L' if self.target_nchan == 1 else 'RGB'
+    img.draft(mode, (w, h))
+    if img.size == full_size:
+      return None
+    if img.mode != mode:
+      img = img.convert(mode)
+    return np.asarray(img)
+
+  def decode(self, image_bytes):
+    """Decode `image_bytes` and return `(arr, is_full_res)`, where `arr`
+    is an RGB(A) or greyscale image array."""
+    if self.reduced_decode:
+      img = self._decode_reduced(image_bytes)
+      if img is not None:
+        return img, False
+
+    if self.backend == 'imageio':
+      return imageio.imread(io.BytesIO(image_bytes)), True
+
+    buf = np.frombuffer(image_bytes, dtype=np.uint8)
+    img = cv2.imdecode(buf, cv2.IMREAD_UNCHANGED)
+    if img is None:
+      raise ValueError("cv2 could not decode %s bytes" % len(image_bytes))
+    if img.ndim == 3:
+      if img.shape[-1] == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+      elif img.shape[-1] == 4:
+        img = cv2.cvtColor(img, cv2.COLOR_BGRA2RGBA)
+    return img, True
+
+  def _decode_row(self, row):
+    if row._cached_image_arr is not '' or row._arr_factory is not '':
+      return row.as_numpy()
+    image_bytes = row.image_bytes
+    if image_bytes is '':
+      return np.array([])
+    img, is_full_res = self.decode(image_bytes)
+    if is_full_res:
+      row._cached_image_arr = img
+    return img
+
+  def decode_rows(self, rows):
+    """Decode `rows` in parallel and return a list of image arrays.  Full
+    resolution decodes are cached in the rows (see `ImageRow.as_numpy()`),
+    but reduced-resolution ones are not."""
+    rows = list(rows)
+    if len(rows) <= 1 or self.n_threads <= 1:
+      return [self._decode_row(row) for row in rows]
+    return self._pool_map(self.n_threads, self._decode_row, rows)
+
+  def decode_into(self, rows, out=None):
+    """Decode `rows` into a uint8 array of shape [N, ...], which must be
+    allocated by the caller (as `out`) or have uniform shape."""
+    imgs = self.decode_rows(rows)
+    if out is None:
+      shapes = set(img.shape for img in imgs)
+      if len(shapes) != 1:
+        raise ValueError(
+          "Images have non-uniform shapes %s; provide a target_hw" % (
+            sorted(shapes),))
+      out = np.empty((len(imgs),) + imgs[0].shape, dtype=np.uint8)
+    elif out.shape[0] < len(imgs):
+      raise ValueError(
+        "Output buffer holds %s images, need %s" % (out.shape[0], len(imgs)))
+    for i, img in enumerate(imgs):
+      out[i] = img
+    return out
+
+class NormalizedCache(object):
+  """A persistent cache of normalized (resized and channel-converted) images
+  stored as memory-mappable .npy files under `conf.AU_NORMALIZED_CACHE`.
+  Images are keyed by (dataset, uri), the normalized [h, w, c] shape and a
+  decoder `variant` (see `ImageDecoder.variant`), so e.g. all models with
+  224x224 RGB inputs share entries.  The cache holds uint8 images from
+  *before* any `FillNormalized.norm_func`, so it need not be keyed on
+  that function.
+
+  The cache is bounded to about `max_bytes` (over all shapes) by evicting
+  the least recently used files; hits bump file mtimes.  All processes
+  using the cache (e.g. Spark workers) share its total size through a file
+  in `root` guarded by `flock()`, so that each sees the others' writes.
+  """
+
+  DEFAULT_MAX_BYTES = int(20e9)
+
+  # Evict down to this fraction of `max_bytes` to amortize scans
+  EVICT_TO_FRACTION = 0.9
+
+  SIZE_FNAME = '.n_bytes'
+  LOCK_FNAME = '.lock'
+
+  def __init__(self, shape, variant='', root=None, max_bytes=None):
+    self.shape = tuple(shape)
+    self.root = root or conf.AU_NORMALIZED_CACHE
+    self.max_bytes = max_bytes or self.DEFAULT_MAX_BYTES
+    name = 'x'.join(str(d) for d in self.shape)
+    if variant:
+      name += '-' + variant
+    self.cache_dir = os.path.join(self.root, name)
+    self._lock = threading.Lock()
+    self._n_bytes = None # Last seen size of the cache; see put()
+
+  def _path(self, dataset, uri):
+    import hashlib
+    key = u'%s\0%s' % (dataset, uri)
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return os.path.join(self.cache_dir, digest[:2], digest + '.npy')
+
+  def get(self, row):
+    """Return a read-only memmap of the cached image for `row` or None"""
+    if not row.uri:
+      return None
+    path = self._path(row.dataset, row.uri)
+    try:
+      arr = np.load(path, mmap_mode='r')
+      os.utime(path, None)
+    except (IOError, OSError, ValueError):
+      # Missing, evicted out from under us, or partially written
+      return None
+    if arr.shape != self.shape:
+      return None
+    return arr
+
+  def put(self, row, arr):
+    if not row.uri or arr.shape != self.shape:
+      return
+    path = self._path(row.dataset, row.uri)
+    util.mkdir(os.path.dirname(path))
+    try:
+      # We might be replacing an entry
+      old_size = os.path.getsize(path)
+    except OSError:
+      old_size = 0
+    tmp_path = '%s.%s.%s.tmp' % (
+                  path, os.getpid(), threading.current_thread().ident)
+    with open(tmp_path, 'wb') as f:
+      np.save(f, np.ascontiguousarray(arr, dtype=np.uint8))
+    os.rename(tmp_path, path)
+      # NB: atomic, so readers in other processes never see partial files
+
+    self._add_bytes(os.path.getsize(path) - old_size)
+
+  def _add_bytes(self, delta):
+    """Add `delta` to the shared size of the cache and evict if the cache
+    is then too big"""
+    import fcntl
+    lock_path = os.path.join(self.root, self.LOCK_FNAME)
+    size_path = os.path.join(self.root, self.SIZE_FNAME)
+    with self._lock, open(lock_path, 'a') as lock_f:
+      fcntl.flock(lock_f, fcntl.LOCK_EX)
+        # NB: released when we close `lock_f`
+      try:
+        with open(size_path) as f:
+          n_bytes = int(f.read()) + delta
+      except (IOError, ValueError):
+        # Missing (e.g. a new cache) or corrupt; the scan includes `delta`
+        n_bytes = sum(st.st_size for _, st in self._iter_entries())
+      if n_bytes > self.max_bytes:
+        n_bytes = self._evict()
+      tmp_path = '%s.%s.tmp' % (size_path, os.getpid())
+      with open(tmp_path, 'w') as f:
+        f.write(str(n_bytes))
+      os.rename(tmp_path, size_path)
+      self._n_bytes = n_bytes
+
+  def _iter_entries(self):
+    for dirpath, _, fnames in os.walk(self.root):
+      for fname in fnames:
+        if fname.endswith('.npy'):
+          path = os.path.join(dirpath, fname)
+          try:
+            yield path, os.stat(path)
+          except OSError:
+            # Another process evicted it
+            continue
+
+  def _evict(self):
+    entries = sorted(self._iter_entries(), key=lambda e: e[1].st_mtime)
+    n_bytes = sum(st.st_size for _, st in entries)
+    target = int(self.EVICT_TO_FRACTION * self.max_bytes)
+    n_evicted = 0
+    for path, st in entries:
+      if n_bytes <= target:
+        break
+      try:
+        os.remove(path)
+      except OSError:
+        pass
+      n_bytes -= st.st_size
+      n_evicted += 1
+    util.log.info(
+      "Evicted %s normalized images from %s, now %s bytes" % (
+        n_evicted, self.root, n_bytes))
+    return n_bytes
+
 class FillNormalized(object):
-  def __init__(self, target_hw=None, target_nchan=None, norm_func=None):
+  def __init__(
+        self,
+        target_hw=None,
+        target_nchan=None,
+        norm_func=None,
+        cache_max_bytes=0):
+    """Set `cache_max_bytes` to use a `NormalizedCache` (requires both
+    `target_hw` and `target_nchan`)"""
     self.norm_func = norm_func
     self.target_hw = target_hw
     self.target_nchan = target_nchan
+    self.cache_max_bytes = cache_max_bytes
+    self._variant_to_cache = {}
     self.thruput = util.ThruputObserver(
                             name='FillNormalized',
                             log_on_del=True)
-  
+
+  def get_cache(self, variant='imageio'):
+    """Return the `NormalizedCache` for images from decoder `variant` (by
+    default `ImageRow.as_numpy()`), or None if not caching."""
+    if (not self.cache_max_bytes or
+        self.target_hw is None or self.target_nchan is None):
+      return None
+    if variant not in self._variant_to_cache:
+      h, w = self.target_hw
+      self._variant_to_cache[variant] = NormalizedCache(
+                            (h, w, self.target_nchan),
+                            variant=variant,
+                            max_bytes=self.cache_max_bytes)
+    return self._variant_to_cache[variant]
+
+  def __getstate__(self):
+    # Caches have locks; re-create them lazily after unpickling
+    d = dict(self.__dict__)
+    d['_variant_to_cache'] = {}
+    return d
+
+  def make_decoder(self, backend='cv2', reduced_decode=True, n_threads=None):
+    """Create an `ImageDecoder` suited to this op's target size, e.g. for
+    decoding a batch of rows before calling this op on each row."""
+    return ImageDecoder(
+              backend=backend,
+              target_hw=self.target_hw,
+              target_nchan=self.target_nchan,
+              reduced_decode=reduced_decode,
+              n_threads=n_threads)
+
   def __call__(self, row):
     self.thruput.start_block()
     
-    normalized = row.as_numpy()
-    bytes_in = normalized.nbytes
+    cache = self.get_cache()
+    cached = cache.get(row) if cache is not None else None
+    if cached is not None:
+      normalized = np.array(cached)
+      bytes_in = normalized.nbytes
+    else:
+      normalized = row.as_numpy()
+      bytes_in = normalized.nbytes
 
-    if self.target_hw is not None:
-      h, w = self.target_hw
-      normalized = cv2.resize(normalized, (w, h)) # Sneaky, opencv!
-    
-    if self.target_nchan is not None:
-      normalized = _make_have_target_chan(normalized, self.target_nchan)
+      if self.target_hw is not None:
+        h, w = self.target_hw
+        normalized = cv2.resize(normalized, (w, h)) # Sneaky, opencv!
+      
+      if self.target_nchan is not None:
+        normalized = _make_have_target_chan(normalized, self.target_nchan)
+      
+      if cache is not None:
+        cache.put(row, normalized)
     
     if self.norm_func is not None:
       normalized = self.norm_func(normalized)
@@ -405,6 +1217,121 @@ class FillNormalized(object):
     self.thruput.stop_block(n=1, num_bytes=bytes_in)
     return row
 
+  def batch_shape(self, n, img=None):
+    """Return the [n, h, w, c] shape of a normalized batch; use sample image
+    `img` for dimensions that this op leaves unspecified."""
+    if img is not None and img.ndim == 2:
+      img = np.expand_dims(img, axis=-1)
+    if self.target_hw is not None:
+      h, w = self.target_hw
+    elif img is not None:
+      h, w = img.shape[:2]
+    else:
+      raise ValueError("Need a sample image to size batches without target_hw")
+    if self.target_nchan is not None:
+      c = self.target_nchan
+    elif img is not None:
+      c = img.shape[-1]
+    else:
+      raise ValueError(
+        "Need a sample image to size batches without target_nchan")
+    return (n, h, w, c)
+
+  def fill_batch(self, rows, out=None, decoder=None):
+    """Normalize `rows` into a single uint8 [N, H, W, C] array (either `out`
+    or a new one) and return it.  Resizing and channel conversion write
+    directly into the output array rather than creating arrays per row.
+    Each row gets a view of its slice in `attrs['normalized']`.
+
+    Use `decoder` (e.g. from `make_decoder()`) to decode images in parallel.
+    Rows found in this op's `NormalizedCache` (if any) skip decoding.
+    Note that `norm_func` (if any) gets called on the whole batch.
+    """
+    self.thruput.start_block()
+    rows = list(rows)
+    cache = self.get_cache(
+              variant=decoder.variant if decoder is not None else 'imageio')
+    if cache is not None:
+      cached = [cache.get(row) for row in rows]
+    else:
+      cached = [None] * len(rows)
+    
+    misses = [row for row, c in zip(rows, cached) if c is None]
+    if decoder is not None:
+      imgs = iter(decoder.decode_rows(misses))
+    else:
+      imgs = (row.as_numpy() for row in misses)
+
+    if out is None:
+      sample = None
+      if misses:
+        imgs = list(imgs)
+        sample = imgs[0]
+        imgs = iter(imgs)
+      shape = self.batch_shape(len(rows), sample)
+      out = np.empty(shape, dtype=np.uint8)
+    elif out.shape[0] < len(rows):
+      raise ValueError(
+        "Output buffer holds %s images, need %s" % (out.shape[0], len(rows)))
+    out = out[:len(rows)]
+
+    bytes_in = 0
+    for row, c, dest in zip(rows, cached, out):
+      if c is not None:
+        dest[...] = c
+        bytes_in += c.nbytes
+      else:
+        img = next(imgs)
+        bytes_in += img.nbytes
+        self._normalize_into(img, dest)
+        if cache is not None:
+          cache.put(row, dest)
+      row.attrs = row.attrs or {}
+      row.attrs['normalized'] = dest
+
+    if self.norm_func is not None:
+      out = self.norm_func(out)
+      for i, row in enumerate(rows):
+        row.attrs['normalized'] = out[i]
+
+    self.thruput.stop_block(n=len(rows), num_bytes=bytes_in)
+    return out
+
+  def _normalize_into(self, img, dest):
+    """Resize and channel-convert `img` into `dest`, a [h, w, c] array"""
+    h, w, c = dest.shape
+    if img.ndim == 2:
+      img = np.expand_dims(img, axis=-1)
+    if img.ndim != 3:
+      raise ValueError("Hmm input image has shape: %s" % (img.shape,))
+    img_c = img.shape[-1]
+
+    need_resize = img.shape[:2] != (h, w)
+    if img_c == c:
+      if not need_resize:
+        dest[...] = img
+      else:
+        # NB: opencv drops singleton channel dims
+        src = img[..., 0] if c == 1 else img
+        dst = dest[..., 0] if c == 1 else dest
+        if src.dtype == dst.dtype and dst.flags.c_contiguous:
+          cv2.resize(src, (w, h), dst=dst)
+        else:
+          # opencv would silently allocate a new `dst`
+          dst[...] = cv2.resize(src, (w, h))
+    elif img_c == 1 and c == 3:
+      # Broadcast grey into all channels (no np.stack)
+      src = img[..., 0]
+      if need_resize:
+        src = cv2.resize(src, (w, h))
+      dest[...] = src[..., np.newaxis]
+    elif img_c == 3 and c == 1:
+      src = cv2.resize(img, (w, h)) if need_resize else img
+      dest[..., 0] = cv2.cvtColor(src, cv2.COLOR_RGB2GRAY)
+    else:
+      raise ValueError(
+        "TODO can't convert %s chan to %s chan" % (img_c, c))
+
 ##
 ## Tables of images
 ##
@@ -459,28 +1386,52 @@ class ImageTable(object):
 
   @classmethod
   def get_rows_by_uris(cls, uris):
-    import pandas as pd
-    import pyarrow.parquet as pq
-    
-    pa_table = pq.read_table(cls.table_root())
-    df = pa_table.to_pandas()
-    matching = df[df.uri.isin(uris)]
-    return list(ImageRow.from_pandas(matching))
+    if URIIndex.is_fresh(cls.table_root()):
+      return list(URIIndex.iter_rows_by_uris(cls.table_root(), uris))
+    else:
+      return list(cls.iter_rows(uris=uris))
 
   @classmethod
   def iter_all_rows(cls):
     """Convenience method (mainly for testing) using Pandas"""
-    import pandas as pd
-    import pyarrow.parquet as pq
-    
-    pa_table = pq.read_table(cls.table_root())
-    df = pa_table.to_pandas()
-    for row in ImageRow.from_pandas(df):
-      yield row
+    return cls.iter_rows()
+
+  @classmethod
+  def iter_rows(cls, uris=None, datasets=None, splits=None, columns=None):
+    """Stream `ImageRow`s from this table without Spark, reading only the
+    row groups that might match the given predicates and only the requested
+    `columns` (default all).  See `ImageRow.iter_from_parquet()`."""
+    return ImageRow.iter_from_parquet(
+                cls.table_root(),
+                uris=uris,
+                datasets=datasets,
+                splits=splits,
+                columns=columns)
   
   @classmethod
-  def as_imagerow_rdd(cls, spark):
-    df = spark.read.parquet(cls.table_root())
+  def as_imagerow_rdd(cls, spark, paths=None):
+    """Return an RDD of `ImageRow`s for this table; read only the Parquet
+    files `paths` (see `iter_pq_files()`) if given"""
+    from au.spark import Spark
+    if paths is None:
+      df = spark.read.parquet(cls.table_root())
+    else:
+      # NB: `basePath` keeps the partition columns (e.g. dataset, split)
+      df = spark.read.option('basePath', cls.table_root()).parquet(*paths)
+    if Spark.is_arrow_enabled(spark):
+      try:
+        batch_rdd, arrow_schema = Spark.df_to_arrow_batch_rdd(df)
+      except Exception as e:
+        util.log.info(
+          "Can't read %s via Arrow, falling back to pyspark Rows: %s" % (
+            cls.TABLE_NAME, e))
+      else:
+        def to_rows(msg):
+          import pyarrow as pa
+          batch = pa.read_record_batch(pa.py_buffer(msg), arrow_schema)
+          return ImageRow.from_pandas(batch.to_pandas())
+        return batch_rdd.flatMap(to_rows)
+
     row_rdd = df.rdd.map(lambda row: ImageRow(**row.asDict()))
     return row_rdd
   
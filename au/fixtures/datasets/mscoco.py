@@ -13,8 +13,10 @@ With differences:
 
 """
 
+import math
 import os
 import threading
+from collections import OrderedDict
 
 from au import conf
 from au import util
@@ -47,9 +49,128 @@ class BBox(object):
   def to_dict(self):
     return dict((k, getattr(self, k, None)) for k in self.__slots__)
 
+class RLE(object):
+  """NumPy versions of the COCO run-length encoding (RLE) utilities in
+  `pycocotools.mask`.  A mask of shape [h, w] is flattened in column-major
+  order and stored as alternating runs of 0s and 1s (starting with 0s); the
+  compact string form stores run lengths as (delta-coded) 5-bit groups."""
+
+  @staticmethod
+  def encode(mask_arr):
+    """Return compact string RLE for [h, w] `mask_arr`"""
+    import numpy as np
+    flat = np.asarray(mask_arr).ravel(order='F') != 0
+    if not flat.size:
+      return ''
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    counts = np.diff(np.concatenate([[0], changes, [flat.size]]))
+    if flat[0]:
+      counts = np.concatenate([[0], counts])
+    return RLE.compress(counts)
+
+  @staticmethod
+  def compress(counts):
+    """Return compact string RLE for run lengths `counts` (see
+    `rleToString()` in pycocotools' maskApi.c)"""
+    chars = []
+    counts = [int(c) for c in counts]
+    for i, x in enumerate(counts):
+      if i > 2:
+        x -= counts[i - 2]
+      more = True
+      while more:
+        c = x & 0x1f
+        x >>= 5
+        more = (x != -1) if (c & 0x10) else (x != 0)
+        if more:
+          c |= 0x20
+        chars.append(chr(c + 48))
+    return ''.join(chars)
+
+  @staticmethod
+  def decompress(rle_counts):
+    """Inverse of `compress()`; return a list of run lengths"""
+    counts = []
+    x, k = 0, 0
+    for ch in rle_counts:
+      c = ord(ch) - 48
+      x |= (c & 0x1f) << (5 * k)
+      k += 1
+      if not (c & 0x20):
+        if c & 0x10:
+          x |= -1 << (5 * k)
+        if len(counts) > 2:
+          x += counts[-2]
+        counts.append(x)
+        x, k = 0, 0
+    return counts
+
+  @staticmethod
+  def decode(rle_counts, height, width):
+    """Return the [height, width] uint8 mask for compact `rle_counts`"""
+    return RLE.decode_batch([rle_counts], height, width)[0]
+
+  @staticmethod
+  def decode_batch(rle_countss, height, width):
+    """Return [N, height, width] uint8 masks for a list of `N` compact RLEs
+    of the same size (e.g. all those of an image) in one pass"""
+    import numpy as np
+    size = height * width
+    all_counts = []
+    all_values = []
+    for rle_counts in rle_countss:
+      counts = np.array(RLE.decompress(rle_counts), dtype=np.int64)
+      total = counts.sum()
+      if total > size:
+        raise ValueError(
+          "RLE has %s pixels, expected %s x %s" % (total, height, width))
+      # NB: Pad short RLEs (e.g. truncated uncompressed ones) with 0s
+      pad = [size - total] if len(counts) % 2 == 0 else [0, size - total]
+      counts = np.append(counts, pad)
+      all_counts.append(counts)
+      all_values.append(np.arange(len(counts), dtype=np.uint8) % 2)
+    if not all_counts:
+      return np.zeros((0, height, width), dtype=np.uint8)
+    flat = np.repeat(np.concatenate(all_values), np.concatenate(all_counts))
+    return flat.reshape((len(all_counts), width, height)).transpose(0, 2, 1)
+
+  @staticmethod
+  def from_segmentation(segmentation, height, width):
+    """Return compact RLE for MSCOCO annotation `segmentation`: a list
+    of polygons (which we union), uncompressed RLE (`counts` is a list), or
+    compact RLE.  We use pycocotools if available and otherwise rasterize
+    polygons with OpenCV, which agrees to within boundary pixels."""
+    if isinstance(segmentation, dict):
+      counts = segmentation['counts']
+      if isinstance(counts, list):
+        return RLE.compress(counts)
+      else:
+        return str(counts)
+
+    try:
+      from pycocotools import mask as cocomask
+    except ImportError:
+      cocomask = None
+    if cocomask is not None:
+      rles = cocomask.frPyObjects(segmentation, height, width)
+      return str(cocomask.merge(rles)['counts'])
+
+    import cv2
+    import numpy as np
+    mask_arr = np.zeros((height, width), dtype=np.uint8)
+    SHIFT = 3
+    for poly in segmentation:
+      pts = np.array(poly, dtype=np.float64).reshape((-1, 2))
+      pts = np.round(pts * (1 << SHIFT)).astype(np.int32)
+      cv2.fillPoly(mask_arr, [pts], 1, lineType=cv2.LINE_8, shift=SHIFT)
+    return RLE.encode(mask_arr)
+
 class Mask(object):
+  """An MSCOCO instance mask stored as compact COCO RLE; use `get_array()`
+  to decode (cached) or `decode_all()` for all masks of an image."""
+
   __slots__ = (
-    'png_bytes',
+    'rle_counts', # Compact string RLE; see `RLE`
     'im_width', 'im_height',
     'is_crowd',
     'category_id',
@@ -57,6 +178,12 @@ class Mask(object):
     'anno_index', # To link with bbox, if needed
   )
 
+  # Decoded masks are large (e.g. 300KB for 640x480), so cache only the
+  # most recently used
+  CACHE_SIZE = 128
+  _cache = OrderedDict() # (rle_counts, h, w) -> mask array
+  _cache_lock = threading.Lock()
+
   def __getstate__(self):
     return self.to_dict()
   
@@ -72,6 +199,38 @@ class Mask(object):
   def to_dict(self):
     return dict((k, getattr(self, k, None)) for k in self.__slots__)
 
+  def get_array(self):
+    """Return the (read-only) [im_height, im_width] uint8 mask"""
+    key = (self.rle_counts, self.im_height, self.im_width)
+    with Mask._cache_lock:
+      arr = Mask._cache.pop(key, None)
+      if arr is not None:
+        Mask._cache[key] = arr
+        return arr
+    arr = RLE.decode(self.rle_counts, self.im_height, self.im_width)
+    arr.setflags(write=False)
+    with Mask._cache_lock:
+      Mask._cache[key] = arr
+      while len(Mask._cache) > Mask.CACHE_SIZE:
+        Mask._cache.popitem(last=False)
+    return arr
+
+  @property
+  def png_bytes(self):
+    import io
+    import imageio
+    buf = io.BytesIO()
+    imageio.imwrite(buf, self.get_array(), format='png')
+    return buf.getvalue()
+
+  @staticmethod
+  def decode_all(masks):
+    """Return [len(masks), h, w] uint8 masks for `masks` of one image"""
+    if not masks:
+      return None
+    return RLE.decode_batch(
+      [m.rle_counts for m in masks], masks[0].im_height, masks[0].im_width)
+
 class Fixtures(object):
 
   BASE_ZIP_URL = "http://images.cocodataset.org/zips"
@@ -153,19 +312,335 @@ class Fixtures(object):
     cls.download_all()
     cls.create_test_fixtures()
 
+class ColumnarAnnotationsIndex(object):
+  """A read-only, columnar index of MSCOCO image infos and annotations in
+  directory `path`.  Every column is a flat array we memory-map, so opening
+  the index is cheap, lookups are binary searches (no unpickling), and
+  processes (e.g. Spark workers) share pages via the OS cache.  Columns:
+   * `image_id` (sorted) and parallel `image_width`, `image_height`,
+      `image_file_name` and `image_anno_offsets`, which (CSR-style) holds
+      the range of each image's annotations in ...
+   * ... `anno_id`, `anno_category_id`, `anno_iscrowd`, `anno_area`,
+      `anno_bbox` and `anno_segmentation` (JSON polygons or RLE)
+  String and blob columns (e.g. `image_file_name`) are a flat `.bin` byte
+  array plus an `.offsets.npy` array.  Categories are in `categories.json`.
+  See `AnnotationsIndexWriter` for creating an index.
+  """
+
+  # Bump when the layout changes; writers add a `FORMAT_FNAME` file last
+  FORMAT_VERSION = 1
+  FORMAT_FNAME = 'format.json'
+
+  COLUMNS = (
+    'image_id', 'image_width', 'image_height', 'image_anno_offsets',
+    'anno_id', 'anno_category_id', 'anno_iscrowd', 'anno_area', 'anno_bbox',
+  )
+  BLOB_COLUMNS = ('image_file_name', 'anno_segmentation')
+
+  def __init__(self, path):
+    import json
+    import numpy as np
+    self.path = path
+    for name in self.COLUMNS:
+      setattr(self, name, np.load(
+        os.path.join(path, name + '.npy'), mmap_mode='r'))
+    for name in self.BLOB_COLUMNS:
+      setattr(self, name, _BlobColumn(path, name))
+    with open(os.path.join(path, 'categories.json')) as f:
+      self.categories = dict(
+        (int(k), v) for k, v in json.load(f).iteritems())
+
+  @classmethod
+  def is_complete(cls, path):
+    """Is there a finished index of the current format at `path`?"""
+    import json
+    try:
+      with open(os.path.join(path, cls.FORMAT_FNAME)) as f:
+        return json.load(f).get('version') == cls.FORMAT_VERSION
+    except (IOError, ValueError):
+      return False
+
+  def __len__(self):
+    return len(self.image_id)
+
+  def find_image(self, image_id):
+    """Return the row of `image_id`, or None if we have no such image"""
+    import numpy as np
+    i = int(np.searchsorted(self.image_id, int(image_id)))
+    if i < len(self.image_id) and self.image_id[i] == int(image_id):
+      return i
+    return None
+
+  def get_image_info(self, image_id):
+    i = self.find_image(image_id)
+    if i is None:
+      return None
+    return {
+      'id': int(self.image_id[i]),
+      'width': int(self.image_width[i]),
+      'height': int(self.image_height[i]),
+      'file_name': self.image_file_name[i].decode('utf-8'),
+    }
+
+  def get_anno_counts(self, image_ids):
+    """Return an array of the number of annotations of each of `image_ids`
+    (0 for unknown images)"""
+    import numpy as np
+    image_ids = np.asarray(image_ids, dtype=self.image_id.dtype)
+    rows = np.searchsorted(self.image_id, image_ids)
+    rows = np.minimum(rows, max(0, len(self.image_id) - 1))
+    counts = np.zeros(len(image_ids), dtype=np.int64)
+    if len(self.image_id):
+      found = self.image_id[rows] == image_ids
+      counts[found] = (
+        self.image_anno_offsets[rows[found] + 1] -
+        self.image_anno_offsets[rows[found]])
+    return counts
+
+  def get_annos(self, image_id):
+    """Return a list of (COCO-style) annotation dicts for `image_id`"""
+    import json
+    i = self.find_image(image_id)
+    if i is None:
+      return []
+    start, end = self.image_anno_offsets[i:i + 2]
+    return [
+      {
+        'id': int(self.anno_id[a]),
+        'image_id': int(image_id),
+        'category_id': int(self.anno_category_id[a]),
+        'iscrowd': int(self.anno_iscrowd[a]),
+        'area': float(self.anno_area[a]),
+        'bbox': self.anno_bbox[a].tolist(),
+        'segmentation': json.loads(self.anno_segmentation[a]),
+      }
+      for a in range(start, end)
+    ]
+
+class _BlobColumn(object):
+  """A memory-mapped column of byte strings"""
+  
+  def __init__(self, path, name):
+    import numpy as np
+    self.offsets = np.load(
+      os.path.join(path, name + '.offsets.npy'), mmap_mode='r')
+    bin_path = os.path.join(path, name + '.bin')
+    if os.path.getsize(bin_path):
+      self.data = np.memmap(bin_path, dtype=np.uint8, mode='r')
+    else:
+      # NB: can't mmap empty files
+      self.data = np.zeros(0, dtype=np.uint8)
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  def __getitem__(self, i):
+    return self.data[self.offsets[i]:self.offsets[i + 1]].tobytes()
+
+class AnnotationsIndexWriter(object):
+  """Writes a `ColumnarAnnotationsIndex` to `dest_dir` in bounded memory.
+  We spool images and annotations (in any order) to temporary column files
+  `SPOOL_ROWS` at a time; `close()` then sorts the columns (by image id)
+  into place, copying blobs in chunks, and moves the finished index to
+  `dest_dir` atomically (unless another process finished one there first).
+  Annotations of unknown images are dropped.
+  """
+
+  SPOOL_ROWS = 10000
+
+  # Kind -> (column, dtype, shape of each entry)
+  FIXED_COLUMNS = {
+    'image': (
+      ('id', 'int64', ()),
+      ('width', 'int32', ()),
+      ('height', 'int32', ()),
+    ),
+    'anno': (
+      ('image_id', 'int64', ()),
+      ('id', 'int64', ()),
+      ('category_id', 'int32', ()),
+      ('iscrowd', 'uint8', ()),
+      ('area', 'float64', ()),
+      ('bbox', 'float64', (4,)),
+    ),
+  }
+  BLOB_COLUMNS = {
+    'image': ('file_name',),
+    'anno': ('segmentation',),
+  }
+
+  def __init__(self, dest_dir):
+    self.dest_dir = dest_dir
+    self.tmp_dir = '%s.%s.tmp' % (dest_dir.rstrip(os.path.sep), os.getpid())
+    self.spool_dir = os.path.join(self.tmp_dir, '_spool')
+    util.mkdir(self.spool_dir)
+    self.categories = {}
+    self.n = {'image': 0, 'anno': 0}
+    self._buffers = {'image': [], 'anno': []}
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, *args):
+    if exc_type is None:
+      self.close()
+    elif os.path.exists(self.tmp_dir):
+      util.rm_rf(self.tmp_dir)
+
+  def add_image(self, image):
+    self._add('image', (
+      image['id'],
+      image['width'],
+      image['height'],
+      image.get('file_name', '').encode('utf-8'),
+    ))
+
+  def add_anno(self, anno):
+    import json
+    self._add('anno', (
+      anno['image_id'],
+      anno['id'],
+      anno['category_id'],
+      anno.get('iscrowd', 0),
+      anno.get('area', 0.),
+      anno.get('bbox') or [0., 0., 0., 0.],
+      json.dumps(anno.get('segmentation', []), separators=(',', ':')),
+    ))
+
+  def add_category(self, category):
+    self.categories[str(category['id'])] = category
+
+  def close(self):
+    import json
+    import numpy as np
+
+    for kind in self._buffers:
+      self._flush(kind)
+    
+    image_ids = self._load_spooled('image', 'id')
+    image_order = np.argsort(image_ids, kind='mergesort')
+    image_ids = image_ids[image_order]
+    self._write_sorted('image', image_order)
+
+    # Keep annos in file order within each image
+    anno_image_ids = self._load_spooled('anno', 'image_id')
+    known = np.flatnonzero(np.in1d(anno_image_ids, image_ids))
+    if len(known) < len(anno_image_ids):
+      util.log.info(
+        "... dropping %s annos of unknown images ..." % (
+          len(anno_image_ids) - len(known)))
+    anno_order = known[
+      np.argsort(anno_image_ids[known], kind='mergesort')]
+    self._write_sorted('anno', anno_order)
+    
+    offsets = np.searchsorted(
+      anno_image_ids[anno_order], image_ids, side='left')
+    np.save(
+      os.path.join(self.tmp_dir, 'image_anno_offsets.npy'),
+      np.append(offsets, len(anno_order)).astype(np.int64))
+    
+    with open(os.path.join(self.tmp_dir, 'categories.json'), 'w') as f:
+      json.dump(self.categories, f)
+    format_path = os.path.join(
+      self.tmp_dir, ColumnarAnnotationsIndex.FORMAT_FNAME)
+    with open(format_path, 'w') as f:
+      json.dump({'version': ColumnarAnnotationsIndex.FORMAT_VERSION}, f)
+    
+    util.rm_rf(self.spool_dir)
+    try:
+      os.rename(self.tmp_dir, self.dest_dir)
+    except OSError:
+      # NB: `dest_dir` exists and isn't empty; another process (e.g. a
+      # Spark worker) may have built the same index concurrently
+      if not ColumnarAnnotationsIndex.is_complete(self.dest_dir):
+        raise
+      util.log.info(
+        "... another process already wrote %s, discarding ours ..." % (
+          self.dest_dir))
+      util.rm_rf(self.tmp_dir)
+      return
+    util.log.info(
+      "... wrote index of %s images and %s annos to %s ." % (
+        len(image_ids), len(anno_order), self.dest_dir))
+
+  def _add(self, kind, values):
+    self._buffers[kind].append(values)
+    self.n[kind] += 1
+    if len(self._buffers[kind]) >= self.SPOOL_ROWS:
+      self._flush(kind)
+
+  def _spool_path(self, kind, col):
+    return os.path.join(self.spool_dir, '%s_%s' % (kind, col))
+
+  def _flush(self, kind):
+    import numpy as np
+    rows = self._buffers[kind]
+    cols = self.FIXED_COLUMNS[kind]
+    for c, (col, dtype, _) in enumerate(cols):
+      with open(self._spool_path(kind, col), 'ab') as f:
+        f.write(np.array([r[c] for r in rows], dtype=dtype).tobytes())
+    for b, col in enumerate(self.BLOB_COLUMNS[kind]):
+      blobs = [r[len(cols) + b] for r in rows]
+      with open(self._spool_path(kind, col), 'ab') as f:
+        f.write(b''.join(blobs))
+      with open(self._spool_path(kind, col + '_len'), 'ab') as f:
+        f.write(np.array([len(v) for v in blobs], dtype=np.int64).tobytes())
+    self._buffers[kind] = []
+
+  def _load_spooled(self, kind, col, mmap=False):
+    import numpy as np
+    specs = dict((c, (d, s)) for c, d, s in self.FIXED_COLUMNS[kind])
+    dtype, shape = specs[col]
+    path = self._spool_path(kind, col)
+    if mmap and self.n[kind]:
+      return np.memmap(
+        path, dtype=dtype, mode='r', shape=(self.n[kind],) + shape)
+    return np.fromfile(path, dtype=dtype).reshape((-1,) + shape)
+
+  def _write_sorted(self, kind, order):
+    import numpy as np
+    
+    for col, _, _ in self.FIXED_COLUMNS[kind]:
+      name = 'image_' + col if kind == 'image' else 'anno_' + col
+      if col == 'image_id':
+        # Implied by `image_anno_offsets`
+        continue
+      arr = self._load_spooled(kind, col, mmap=True)[order]
+      np.save(os.path.join(self.tmp_dir, name + '.npy'), arr)
+
+    for col in self.BLOB_COLUMNS[kind]:
+      name = kind + '_' + col
+      lens = np.fromfile(self._spool_path(kind, col + '_len'), dtype=np.int64)
+      starts = np.concatenate([[0], np.cumsum(lens)])
+      offsets = np.concatenate([[0], np.cumsum(lens[order])])
+      np.save(os.path.join(self.tmp_dir, name + '.offsets.npy'), offsets)
+      
+      src_path = self._spool_path(kind, col)
+      with open(os.path.join(self.tmp_dir, name + '.bin'), 'wb') as f:
+        if not os.path.getsize(src_path):
+          continue
+        data = np.memmap(src_path, dtype=np.uint8, mode='r')
+        for chunk in util.ichunked(order, self.SPOOL_ROWS):
+          f.write(b''.join(
+            data[starts[i]:starts[i + 1]].tobytes() for i in chunk))
+
 class AnnotationsIndexBase(object):
   FIXTURES = Fixtures
   ZIP_FNAME = ''
   ANNO_FNAME = ''
 
+  # Read this many bytes of annotations JSON at a time
+  JSON_CHUNK_SIZE = 2**20
+
   _setup_lock = threading.Lock()
-  _image_to_annos = None
-  _image_id_to_image = None
-  _category_index = None
+  _index = None # A `ColumnarAnnotationsIndex`
 
   @classmethod
   def _index_file(cls, fname):
-    index_dir = cls.__name__
+    # NB: versioned, so we never mistake an older format (e.g. the shelve
+    # index that used to live in `cls.__name__`) for the current one
+    index_dir = '%s.columnar.v%s' % (
+      cls.__name__, ColumnarAnnotationsIndex.FORMAT_VERSION)
     return os.path.join(cls.FIXTURES.index_dir(), index_dir, fname)
 
   @classmethod
@@ -175,19 +650,15 @@ class AnnotationsIndexBase(object):
 
   @classmethod
   def _setup_indices(cls):
-    import shelve
-
-    if not os.path.exists(cls._index_file('')):
+    index_dir = cls._index_file('').rstrip(os.path.sep)
+    if not ColumnarAnnotationsIndex.is_complete(index_dir):
+      if os.path.exists(index_dir):
+        util.log.info("Removing incomplete index %s ..." % index_dir)
+        util.rm_rf(index_dir)
       
       ###
       ### Based upon _create_tf_record_from_coco_annotations()
       ###
-      
-      import json
-      import pprint
-
-      # From tensorflow/models
-      from object_detection.utils import label_map_util
 
       zip_path = cls.FIXTURES.zip_path(cls.ZIP_FNAME)
       util.log.info("Building annotations index for %s ..." % zip_path)
@@ -200,77 +671,51 @@ class AnnotationsIndexBase(object):
       assert anno_fw, \
         "Could not find entry for %s in %s" % (cls.ANNO_FNAME, zip_path)
 
-      util.log.info("... reading json ...")
-      anno_data = json.loads(anno_fw.data)
-      util.log.info("... json loaded ...")
-
-      images = anno_data['images']
-      category_index = label_map_util.create_category_index(
-                                        anno_data['categories'])
-      category_index = dict((str(k), v) for k, v in category_index.iteritems())
-      
-      util.log.info("Have annotations index for %s images." % len(images))
-      util.log.info("Category index: \n\n%s" % pprint.pformat(category_index))
-
-      image_to_annos = {}
-      if 'annotations' in anno_data:
-        util.log.info("... Building image ID -> Annos ...")
-        for anno in anno_data['annotations']:
-          # NB: we must string-ify keys for `shelve`
-          image_id = str(anno['image_id'])
-          image_to_annos.setdefault(image_id, [])
-          image_to_annos[image_id].append(anno)
-
-      missing_anno_count = sum(
-        1 for image in images
-        if str(image['id']) not in image_to_annos)
-      util.log.info("... %s images are missing annos ..." % missing_anno_count)
-
-      util.log.info("... finished index for %s ." % zip_path)
-
-      image_id_to_image = dict((str(image['id']), image) for image in images)
-
-      def dump_to_shelf(name, data):
-        dest = cls._index_file(name)
-        util.log.info("... saving %s to %s ..." % (name, dest))
-
-        import pickle
-        d = shelve.open(dest, protocol=pickle.HIGHEST_PROTOCOL)
-        d.update(data.iteritems())
-        d.close()
-
-      # Keeping the below data in memory will OOM almost any reasonable box,
-      # so we cache the data on disk.
-      util.mkdir(cls._index_file(''))
-      dump_to_shelf('image_id_to_image', image_id_to_image)
-      dump_to_shelf('category_index', category_index)
-      dump_to_shelf('image_to_annos', image_to_annos)
-
-    util.log.info("Using indices in %s" % cls._index_file(''))
-    cls._image_id_to_image = shelve.open(cls._index_file('image_id_to_image'))
-    cls._category_index = shelve.open(cls._index_file('category_index'))
-    cls._image_to_annos = shelve.open(cls._index_file('image_to_annos'))
+      # NB: The train JSON is about 450MB, and `json.loads()` needs several
+      # GB for it, so we stream items straight to the (spooling) writer.
+      util.log.info("... streaming json ...")
+      add_item = {
+        'categories': 'add_category',
+        'images': 'add_image',
+        'annotations': 'add_anno',
+      }
+      util.mkdir(os.path.dirname(index_dir))
+      with AnnotationsIndexWriter(index_dir) as writer:
+        f = anno_fw.open()
+        try:
+          items = util.iter_json_object_items(f, cls.JSON_CHUNK_SIZE)
+          for key, item in items:
+            if key in add_item:
+              getattr(writer, add_item[key])(item)
+        finally:
+          f.close()
+
+    if cls._index is None:
+      util.log.info("Using indices in %s" % index_dir)
+      cls._index = ColumnarAnnotationsIndex(index_dir)
 
   @classmethod
-  def get_annos_for_image(cls, image_id):
-    if not cls._image_to_annos:
+  def _get_index(cls):
+    if cls._index is None:
       with cls._setup_lock:
         cls._setup_indices()
-    return cls._image_to_annos.get(str(image_id), [])
+    return cls._index
+
+  @classmethod
+  def get_annos_for_image(cls, image_id):
+    return cls._get_index().get_annos(image_id)
   
   @classmethod
   def get_image_info(cls, image_id):
-    if not cls._image_id_to_image:
-      with cls._setup_lock:
-        cls._setup_indices()
-    return cls._image_id_to_image.get(str(image_id))
+    return cls._get_index().get_image_info(image_id)
+
+  @classmethod
+  def get_anno_counts(cls, image_ids):
+    return cls._get_index().get_anno_counts(image_ids)
   
   @classmethod
   def get_category_name_for_id(cls, category_id):
-    if not cls._category_index:
-      with cls._setup_lock:
-        cls._setup_indices()
-    row = cls._category_index.get(str(category_id))
+    row = cls._get_index().categories.get(int(category_id))
     if row:
       return row['name'].encode('utf8')
     else:
@@ -310,31 +755,29 @@ class AnnotationsIndexBase(object):
 
     for anno_index, anno in enumerate(annos):
       ## See Tensorflow/models create_coco_tf_record.py create_tf_example()
-      from pycocotools import mask as cocomask
-      import numpy as np
-      import io
-      import imageio
-      run_len_encoding = cocomask.frPyObjects(
-                                  anno['segmentation'],
-                                  image['height'],
-                                  image['width'])
-      mask_arr = cocomask.decode(run_len_encoding)
-      if not anno['iscrowd']:
-        mask_arr = np.amax(mask_arr, axis=2) # hmmm ?
-      buf = io.BytesIO()
-      imageio.imwrite(buf, mask_arr, format='png')
+      ## NB: We store compact RLE and only decode when a reader needs pixels
+      rle_counts = RLE.from_segmentation(
+                        anno['segmentation'],
+                        image['height'],
+                        image['width'])
       kwargs = {
-        'png_bytes': buf.getvalue(),
-        'im_width': image['height'],
-        'im_height': image['width'],
+        'im_width': image['width'],
+        'im_height': image['height'],
+        'is_crowd': anno['iscrowd'],
         'category_name': cls.get_category_name_for_id(anno['category_id']),
         'anno_index': anno_index,
       }
       kwargs.update(anno.iteritems())
+      kwargs['rle_counts'] = rle_counts
       mask = Mask(**kwargs)
       masks.append(mask)
     return masks
 
+  @classmethod
+  def get_mask_arrays_for_image(cls, image_id):
+    """Return [num annos, h, w] uint8 masks for `image_id` (or None)"""
+    return Mask.decode_all(cls.get_masks_for_image(image_id))
+
 class TrainAnnos(AnnotationsIndexBase):
   ZIP_FNAME = Fixtures.ANNOS_TRAIN_VAL_ZIP
   ANNO_FNAME = Fixtures.ANNOS_TRAIN_FNAME
@@ -343,6 +786,26 @@ class ValAnnos(AnnotationsIndexBase):
   ZIP_FNAME = Fixtures.ANNOS_TRAIN_VAL_ZIP
   ANNO_FNAME = Fixtures.ANNOS_VAL_FNAME
 
+def setup_annos_indices(annos_clss=(TrainAnnos, ValAnnos)):
+  """Build the indices for `annos_clss` concurrently, one process each
+  (index builds are single-threaded and bounded in memory), then open them
+  in this process."""
+  import multiprocessing
+  procs = [
+    multiprocessing.Process(target=annos_cls.setup)
+    for annos_cls in annos_clss
+  ]
+  for p in procs:
+    p.start()
+  for p in procs:
+    p.join()
+  for annos_cls, p in zip(annos_clss, procs):
+    if p.exitcode != 0:
+      raise RuntimeError(
+        "Failed to build index for %s (exit code %s)" % (
+          annos_cls.__name__, p.exitcode))
+    annos_cls.setup()
+
 
 
 class ImageURI(object):
@@ -386,8 +849,61 @@ class MSCOCOImageTableBase(dataset.ImageTable):
   RANDOM_SHUFFLE = True
   RANDOM_SHUFFLE_SEED = 7
   APPROX_MB_PER_SHARD = 1024.
+  MIN_SHARDS = 10
   # ROWS_PER_FILE ignored
 
+  # For shard sizing: approx. bytes of each bbox + RLE mask in a row, and of
+  # per-row overhead (uri, attrs, etc)
+  EST_BYTES_PER_ANNO = 300
+  EST_BYTES_PER_ROW = 500
+
+  @staticmethod
+  def _is_image_entry(name):
+    return '.jpg' in name or '.png' in name
+
+  @staticmethod
+  def _image_id_from_entry(name):
+    fname = os.path.split(name)[-1]
+    return int(fname.split('.')[0])
+
+  @classmethod
+  def _plan_shards(cls, fws):
+    """Bin-pack image flyweights `fws` into shards of about
+    `APPROX_MB_PER_SHARD` each and return a list of lists of flyweights
+    (each in `fws` order).  We size rows using only the zip central
+    directory and annotation counts from the index, so we decode no images
+    and build no rows."""
+    if not fws:
+      return []
+    zip_path = fws[0].archive.archive_path
+    zip_sizes = util.ArchiveFileFlyweight.sizes_from(zip_path)
+
+    est_row_bytes = [cls.EST_BYTES_PER_ROW] * len(fws)
+    if cls.IMAGES:
+      # NB: JPEGs are stored ~uncompressed; rows hold the raw bytes
+      for i, fw in enumerate(fws):
+        est_row_bytes[i] += zip_sizes[fw.name][1]
+    if cls.BBOXEN or cls.MASKS:
+      n_feats = int(cls.BBOXEN) + int(cls.MASKS)
+      anno_counts = cls.ANNOS_CLS.get_anno_counts(
+        [cls._image_id_from_entry(fw.name) for fw in fws])
+      for i, n_annos in enumerate(anno_counts):
+        est_row_bytes[i] += int(n_annos) * n_feats * cls.EST_BYTES_PER_ANNO
+
+    est_total_bytes = sum(est_row_bytes)
+    n_shards = int(math.ceil(est_total_bytes / (cls.APPROX_MB_PER_SHARD * 1e6)))
+    n_shards = min(len(fws), max(cls.MIN_SHARDS, n_shards))
+    bins = util.bin_pack(est_row_bytes, n_shards)
+    shard_mbs = [sum(est_row_bytes[i] for i in b) * 1e-6 for b in bins]
+    util.log.info(
+      "Planned %s shards for %s rows; est. %s MB total, %s - %s MB / shard" % (
+        n_shards,
+        len(fws),
+        est_total_bytes * 1e-6,
+        min(shard_mbs),
+        max(shard_mbs)))
+    return [[fws[i] for i in b] for b in bins]
+
   @classmethod
   def setup(cls, spark=None):
     spark = spark or Spark.getOrCreate()
@@ -406,17 +922,13 @@ class MSCOCOImageTableBase(dataset.ImageTable):
 
     def gen_rows(fws):
       for fw in fws:
-        if not ('.jpg' in fw.name or '.png' in fw.name):
-          continue
-        
         uri = ImageURI(zip_path=zip_path, image_fname=fw.name)
         image_bytes = ''
         if cls.IMAGES:
           image_bytes = bytes(fw.data)
           assert len(image_bytes) > 0, 'Sanity check'
 
-        fname = os.path.split(fw.name)[-1]
-        image_id = int(fname.split('.')[0])
+        image_id = cls._image_id_from_entry(fw.name)
         info = cls.ANNOS_CLS.get_image_info(image_id)
         if info:
           attrs = {
@@ -442,40 +954,22 @@ class MSCOCOImageTableBase(dataset.ImageTable):
         )
     
     zip_path = cls.FIXTURES.zip_path(cls.IMAGES_ZIP_FNAME)
-    fws = util.ArchiveFileFlyweight.fws_from(zip_path)
+    fws = [
+      fw for fw in util.ArchiveFileFlyweight.fws_from(zip_path)
+      if cls._is_image_entry(fw.name)
+    ]
     if cls.RANDOM_SHUFFLE:
       import random
       g = random.Random()
       g.seed(cls.RANDOM_SHUFFLE_SEED)
       random.shuffle(fws, random=g.random)
 
-    archive_rdd = spark.sparkContext.parallelize(fws, numSlices=len(fws))
-    row_rdd = archive_rdd.mapPartitions(gen_rows)
-
-    def estimate_bytes_per_row(rows):
-      COMPRESSION_FRAC = 0.6
-      import pickle
-      n_rows = len(rows)
-      assert all(r.image_bytes is not '' for r in rows), 'Sanity check'
-      n_bytes = sum(len(pickle.dumps(r)) for r in rows)
-      return COMPRESSION_FRAC * n_bytes / n_rows
-    
-    est_total_rows = archive_rdd.count()
-    est_bytes_per_row = estimate_bytes_per_row(row_rdd.take(10))
-    est_total_bytes = est_total_rows * est_bytes_per_row
-    n_shards = max(10, int(est_total_bytes / (cls.APPROX_MB_PER_SHARD * 1e6)))
-
-    util.log.info(
-      "Writing %s total rows in %s shards; est. %s MB (%s MB / row)" % (
-        est_total_rows,
-        n_shards,
-        est_total_bytes * 1e-6,
-        est_bytes_per_row * 1e-6))
-
-    # Partition the `archive_rdd` because partitioning `row_rdd` will cause
-    # Spark to compute all ImageRows, which, as written above, are not
-    # flyweights.
-    row_rdd = archive_rdd.repartition(n_shards).mapPartitions(gen_rows)
+    # Parallelize whole shards (one per partition) rather than flyweights
+    # so that Spark need not compute any rows to partition them
+    shards = cls._plan_shards(fws)
+    shard_rdd = spark.sparkContext.parallelize(shards, numSlices=len(shards))
+    row_rdd = shard_rdd.mapPartitions(
+      lambda shards: gen_rows(fw for shard in shards for fw in shard))
     dataset.ImageRow.write_to_parquet(row_rdd, cls.table_root(), spark=spark)
 
 class MSCOCOImageTableTrain(MSCOCOImageTableBase):
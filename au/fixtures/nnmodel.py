@@ -1,4 +1,5 @@
 import os
+import threading
 
 from au import conf
 from au import util
@@ -27,6 +28,26 @@ class INNModel(object):
       # For batching inference
       self.INFERENCE_BATCH_SIZE = 10
 
+      # Optionally cache normalized input images on disk (up to about this
+      # many bytes, e.g. `dataset.NormalizedCache.DEFAULT_MAX_BYTES`) so that
+      # other runs with the same input shape can skip decoding and resizing;
+      # see `dataset.NormalizedCache`.  Off (0) by default.
+      self.NORMALIZED_CACHE_MAX_BYTES = 0
+
+      # How to decode input images; see `dataset.ImageDecoder`.  'cv2' is
+      # faster but may differ from 'imageio' by +/- 1 per pixel.  Reduced
+      # JPEG decodes are faster still but change resize results.
+      self.DECODE_BACKEND = 'imageio'
+      self.REDUCED_JPEG_DECODE = False
+
+      # Lossily store activations as e.g. 'float16' or 'int8' to shrink
+      # tables; see `au.spark.NumpyArray`
+      self.ACTIVATIONS_QUANTIZE = None
+
+      # Reduce output tensors in-graph (before they reach Python) by output
+      # tensor name, e.g. {'foo:0': 'avg_pool'}; see `OutputReductions`
+      self.OUTPUT_REDUCTIONS = {}
+
 
   def __init__(self, params=None):
     self.params = params or INNModel.ParamsBase()
@@ -69,8 +90,16 @@ class TFInferenceGraphFactory(object):
     target_nchan = input_dims[3]
     return dataset.FillNormalized(
                         target_hw=target_hw,
-                        target_nchan=target_nchan)
+                        target_nchan=target_nchan,
+                        cache_max_bytes=self.params.NORMALIZED_CACHE_MAX_BYTES)
   
+  def make_decoder(self, normalize):
+    """Create an `ImageDecoder` for feeding `normalize` (the result of
+    `make_normalize_ftor()`)"""
+    return normalize.make_decoder(
+                        backend=self.params.DECODE_BACKEND,
+                        reduced_decode=self.params.REDUCED_JPEG_DECODE)
+
   @property
   def input_tensor_shape(self):
     return self.params.INPUT_TENSOR_SHAPE
@@ -82,12 +111,120 @@ class TFInferenceGraphFactory(object):
   @property
   def output_names(self):
     return tuple()
+
+  @property
+  def output_reductions(self):
+    return self.params.OUTPUT_REDUCTIONS
+
+  @property
+  def activation_names(self):
+    """The names of the activations we store, one per output tensor in
+    `output_names`; see `OutputReductions.activation_name()`"""
+    reductions = self.output_reductions
+    return tuple(
+      OutputReductions.activation_name(name, reductions.get(name))
+      for name in self.output_names)
   
   @property
   def model_name(self):
     return self.params.MODEL_NAME
 
 
+class OutputReductions(object):
+  """Summaries of output tensors computed inside the inference graph, so
+  that `sess.run()` returns (and tables store) e.g. a few channel values
+  per image rather than full feature maps.  Reductions:
+   * 'avg_pool', 'max_pool' - reduce over all but the batch and last
+       (channel) axes
+   * 'top_k:K' - int32 indices of the K largest channels (after 'avg_pool'
+       for tensors with spatial axes)
+   * 'random_projection:D' - project each (flattened) tensor onto D
+       dimensions using a fixed (seeded) Gaussian random matrix, which
+       approximately preserves distances between images
+  """
+
+  REDUCTIONS = ('avg_pool', 'max_pool', 'top_k', 'random_projection')
+
+  # Every process (and run) must use the same projection
+  PROJECTION_SEED = 1337
+
+  NAME_SCOPE = 'au_reduced_output'
+
+  @classmethod
+  def parse(cls, reduction):
+    """Return (reduction, integer argument or None) for `reduction`"""
+    op, _, arg = reduction.partition(':')
+    if op not in cls.REDUCTIONS:
+      raise ValueError(
+        "Unknown reduction %s, try one of %s" % (reduction, cls.REDUCTIONS))
+    if op in ('top_k', 'random_projection'):
+      if not arg.isdigit() or int(arg) < 1:
+        raise ValueError("Reduction %s needs a size, e.g. %s:10" % (op, op))
+      return op, int(arg)
+    return op, None
+
+  @staticmethod
+  def activation_name(tensor_name, reduction=None):
+    """E.g. 'foo:0/avg_pool' for `tensor_name` 'foo:0' reduced by
+    'avg_pool'"""
+    if not reduction:
+      return tensor_name
+    return tensor_name + '/' + reduction
+
+  @classmethod
+  def fetch_name(cls, i):
+    """The name of the graph tensor holding the reduced `i`th output"""
+    return '%s_%s:0' % (cls.NAME_SCOPE, i)
+
+  @classmethod
+  def add_to_graph(cls, graph, tigraph_factory):
+    """Add the reductions for `tigraph_factory` to `graph` and return the
+    names of the tensors to fetch, one per output tensor"""
+    import tensorflow as tf
+
+    reductions = tigraph_factory.output_reductions
+    fetch_names = []
+    with graph.as_default():
+      for i, name in enumerate(tigraph_factory.output_names):
+        if not reductions.get(name):
+          fetch_names.append(name)
+          continue
+        tensor = graph.get_tensor_by_name(name)
+        reduced = cls.reduce(tensor, reductions[name])
+        out = tf.identity(reduced, name=cls.fetch_name(i).split(':')[0])
+        fetch_names.append(out.name)
+    return fetch_names
+
+  @classmethod
+  def reduce(cls, tensor, reduction):
+    import numpy as np
+    import tensorflow as tf
+
+    op, arg = cls.parse(reduction)
+    rank = tensor.shape.ndims
+    if rank is None or rank < 2:
+      raise ValueError(
+        "Need a batch of tensors (of known rank) to reduce, got %s" % tensor)
+    spatial_axes = range(1, rank - 1)
+
+    if op == 'avg_pool':
+      return tf.reduce_mean(tensor, axis=spatial_axes)
+    elif op == 'max_pool':
+      return tf.reduce_max(tensor, axis=spatial_axes)
+    elif op == 'top_k':
+      pooled = tf.reduce_mean(tensor, axis=spatial_axes)
+      return tf.nn.top_k(pooled, k=arg, sorted=True).indices
+    else:
+      n_in = tensor.shape[1:].num_elements()
+      if n_in is None:
+        raise ValueError(
+          "Random projections need a static shape, got %s" % tensor)
+      rand = np.random.RandomState(cls.PROJECTION_SEED)
+      proj = rand.randn(n_in, arg).astype(np.float32) / np.sqrt(arg)
+      flat = tf.reshape(tf.cast(tensor, tf.float32), [-1, n_in])
+      return tf.matmul(flat, tf.constant(proj))
+
+
 ## Utils
 
 class FillActivationsBase(object):
@@ -121,7 +258,9 @@ class Activations(object):
     self.model_name = kwargs.get('model_name', '')
     self._tensor_to_value = {}
     if 'tensor_to_value' in kwargs:
-      self.tensor_to_value = kwargs['tensor_to_value']
+      self.set_tensor_to_value(
+        kwargs['tensor_to_value'],
+        quantize=kwargs.get('quantize'))
   
   def get_tensor_to_value(self):
     # Unpack numpy arrays
@@ -129,113 +268,227 @@ class Activations(object):
       return {}
     return dict((k, v.arr) for k, v in self._tensor_to_value.iteritems())
   
-  def set_tensor_to_value(self, tensor_to_value):
-    # Pack numpy arrays for Spark
+  def set_tensor_to_value(self, tensor_to_value, quantize=None):
+    # Pack numpy arrays for Spark; see NumpyArray for `quantize` options
     from au.spark import NumpyArray
     for k, v in tensor_to_value.iteritems():
-      self._tensor_to_value[k] = NumpyArray(v)
+      self._tensor_to_value[k] = NumpyArray(v, quantize=quantize)
   
   tensor_to_value = property(get_tensor_to_value, set_tensor_to_value)
 
+class TFInferenceSessionCache(object):
+  """A per-process cache of inference graphs and warm (CPU) sessions keyed
+  by model and output tensors.  Building a graph (e.g. restoring and freezing
+  a checkpoint) and opening a session can dominate runtime for small Spark
+  partitions, so later partitions handled by the same python worker reuse
+  them.  (Sessions are thread-safe, so entries can be shared).
+  """
+
+  INPUT_TENSOR_NAME = 'au_input_image'
+
+  _lock = threading.Lock()
+  _cache = {} # key -> _Entry
+
+  class _Entry(object):
+    __slots__ = ('graph', 'sess', 'input_name', 'fetch_names')
+    def __init__(self, graph, sess, input_name, fetch_names):
+      self.graph = graph
+      self.sess = sess
+      self.input_name = input_name
+      self.fetch_names = fetch_names
+
+  @staticmethod
+  def key_for(tigraph_factory):
+    clazz = tigraph_factory.__class__
+    return (
+      clazz.__module__ + '.' + clazz.__name__,
+      tigraph_factory.model_name,
+      tuple(tigraph_factory.output_names),
+      tuple(tigraph_factory.input_tensor_shape),
+      tuple(sorted(tigraph_factory.output_reductions.iteritems())),
+    )
+
+  @classmethod
+  def get(cls, tigraph_factory, graph_def_bytes=None):
+    """Return an entry with the inference `graph` for `tigraph_factory`, an
+    open `sess` for that graph, the name of the uint8 input tensor
+    (`input_name`) to feed and the (possibly reduced; see
+    `OutputReductions`) output tensors to fetch (`fetch_names`).  If given `graph_def_bytes` (see
+    `get_graph_def_bytes()`), import that graph rather than building one."""
+    key = cls.key_for(tigraph_factory)
+    with cls._lock:
+      # NB: Hold the lock while building so that concurrent callers don't
+      # build (and restore checkpoints for) the same graph twice
+      if key not in cls._cache:
+        if graph_def_bytes is not None:
+          cls._cache[key] = cls._import(tigraph_factory, graph_def_bytes)
+        else:
+          cls._cache[key] = cls._create(tigraph_factory)
+      return cls._cache[key]
+
+  @classmethod
+  def get_graph_def_bytes(cls, tigraph_factory):
+    """Build (or fetch) the inference graph for `tigraph_factory` and return
+    it as a serialized GraphDef, e.g. to freeze a model once on the Spark
+    driver and ship it to executors.  The graph must be self-contained
+    (i.e. frozen, without variables; see `util.give_me_frozen_graph()`)."""
+    entry = cls.get(tigraph_factory)
+    return entry.graph.as_graph_def().SerializeToString()
+
+  @classmethod
+  def clear(cls):
+    with cls._lock:
+      for entry in cls._cache.itervalues():
+        entry.sess.close()
+      cls._cache.clear()
+
+  @classmethod
+  def _create(cls, tigraph_factory):
+    import tensorflow as tf
+
+    graph = tf.Graph()
+    with graph.as_default():
+      shape = [None] + list(tigraph_factory.input_tensor_shape)[1:]
+      input_image = tf.placeholder(
+                      tf.uint8, shape, name=cls.INPUT_TENSOR_NAME)
+    
+    util.log.info(
+      "Creating inference graph for %s ..." % tigraph_factory.model_name)
+    final_graph = tigraph_factory.create_inference_graph(input_image, graph)
+    util.log.info("... done creating inference graph.")
+
+    fetch_names = OutputReductions.add_to_graph(final_graph, tigraph_factory)
+
+    # TODO: support using single GPUs; requires running in a subprocess
+    # due to Tensorflow memory madness :( 
+    with final_graph.as_default():
+      sess = util.tf_cpu_session()
+
+    # NB: `final_graph` may be a copy (e.g. a frozen graph), so feed by name
+    return cls._Entry(final_graph, sess, input_image.name, fetch_names)
+
+  @classmethod
+  def _import(cls, tigraph_factory, graph_def_bytes):
+    import tensorflow as tf
+
+    util.log.info(
+      "Importing inference graph for %s (%s bytes) ..." % (
+        tigraph_factory.model_name, len(graph_def_bytes)))
+    graph_def = tf.GraphDef()
+    graph_def.ParseFromString(graph_def_bytes)
+    graph = tf.Graph()
+    with graph.as_default():
+      tf.import_graph_def(graph_def, name='')
+      sess = util.tf_cpu_session()
+    util.log.info("... done importing inference graph.")
+
+    # Shipped graphs already include any reductions
+    reductions = tigraph_factory.output_reductions
+    fetch_names = [
+      OutputReductions.fetch_name(i) if reductions.get(name) else name
+      for i, name in enumerate(tigraph_factory.output_names)
+    ]
+    return cls._Entry(
+      graph, sess, cls.INPUT_TENSOR_NAME + ':0', fetch_names)
+
 class FillActivationsTFDataset(FillActivationsBase):
-  """A `FillActivationsBase` impl that leverages Tensorflow
-  tf.Dataset to feed data into a tf.Graph""" 
-  
+  """A `FillActivationsBase` impl that runs a tf.Graph over batches of
+  `ImageRow`s in a two-stage pipeline.  A background thread decodes and
+  normalizes batch N+1 (see `FillNormalized.fill_batch()`) while
+  `sess.run()`, which releases the GIL, computes batch N.  Rows travel
+  together with their input batch, so outputs always pair with the right
+  rows, and at most `MAX_QUEUED_BATCHES` batches wait in memory."""
+
+  MAX_QUEUED_BATCHES = 2
+
+  def __init__(self, tigraph_factory=None, model=None, graph_def=None):
+    """Optionally use serialized GraphDef `graph_def` (or a Spark broadcast
+    thereof; see `broadcast_graph_def()`) instead of building the graph."""
+    super(FillActivationsTFDataset, self).__init__(
+                tigraph_factory=tigraph_factory, model=model)
+    self.graph_def = graph_def
+
+  def broadcast_graph_def(self, spark):
+    """Build and freeze the inference graph once (here, on the driver) and
+    ship it to executors, which then skip e.g. checkpoint downloads and
+    restores."""
+    gdef_bytes = TFInferenceSessionCache.get_graph_def_bytes(
+                                                self.tigraph_factory)
+    self.graph_def = spark.sparkContext.broadcast(gdef_bytes)
+    util.log.info(
+      "Broadcasting %s bytes of graph for %s" % (
+        len(gdef_bytes), self.tigraph_factory.model_name))
+
+  def _get_graph_def_bytes(self):
+    if self.graph_def is None:
+      return None
+    elif hasattr(self.graph_def, 'value'):
+      # A Spark Broadcast
+      return self.graph_def.value
+    else:
+      return self.graph_def
+
+  def _iter_normalized_batches(self, iter_imagerows):
+    normalize = self.tigraph_factory.make_normalize_ftor()
+    decoder = self.tigraph_factory.make_decoder(normalize)
+    batch_size = self.tigraph_factory.batch_size
+    for rows in util.ichunked(iter_imagerows, batch_size):
+      # NB: Each batch gets a fresh buffer since rows keep views of it
+      arr = normalize.fill_batch(rows, decoder=decoder)
+      yield rows, arr
+
   def __call__(self, iter_imagerows):
     self.overall_thruput.start_block()
-    
-    import Queue
-    import tensorflow as tf
 
     util.log.info(
       "Filling activations for %s ..." % self.tigraph_factory.model_name)
     
-    graph = tf.Graph()
-    processed_rows = Queue.Queue()
-
-    def iter_normalized_np_images():
-      normalize = self.tigraph_factory.make_normalize_ftor()
-      for row in iter_imagerows:
-        row = normalize(row)        
-        processed_rows.put(row, block=True)
-        arr = row.attrs['normalized']
-        yield arr
-        
-        self.tf_thruput.update_tallies(num_bytes=arr.nbytes)
-        self.overall_thruput.update_tallies(num_bytes=arr.nbytes)
-    
-    # We'll use the tf.Dataset.from_generator facility to read ImageRows
-    # (which have the image bytes in Python memory) into the graph.  The use
-    # case we have in mind is via the pyspark Dataframe / RDD API, where
-    # the image bytes will need to be in Python memory anyways.  (If we want
-    # to try to DMA between the Spark JVM and Tensorflow, we need to use
-    # Databricks Tensorframes, which we'll consider implementing as an
-    # additional subclass).  Using tf.Dataset here should at least allow
-    # Tensorflow to push reading into a background thread so that Spark and/or
-    # Python execution won't block inference if inference dominates. To achieve
-    # multi-threaded I/O, we lean on Spark, which will typically run one
-    # instance of this functor per core (thus providing some
-    # cache-friendliness).
-    with graph.as_default():
-      # Hack: let us handle batch size here ...
-      input_shape = list(self.tigraph_factory.input_tensor_shape)
-      input_shape = input_shape[1:]
-      d = tf.data.Dataset.from_generator(
-                      iter_normalized_np_images,
-                      tf.uint8,
-                      input_shape)
-      d = d.batch(self.tigraph_factory.batch_size)
-      input_image = d.make_one_shot_iterator().get_next()
+    # We feed the graph from Python (rather than e.g. tf.data) because the
+    # use case we have in mind is via the pyspark Dataframe / RDD API, where
+    # the image bytes will be in Python memory anyways.  (If we want to try
+    # to DMA between the Spark JVM and Tensorflow, we need to use Databricks
+    # Tensorframes, which we'll consider implementing as an additional
+    # subclass).  To achieve multi-threaded I/O, we lean on Spark, which will
+    # typically run one instance of this functor per core (thus providing
+    # some cache-friendliness), as well as the `ImageDecoder` thread pool.
+    # Graphs and sessions outlive this call; see `TFInferenceSessionCache`.
+    entry = TFInferenceSessionCache.get(
+                  self.tigraph_factory,
+                  graph_def_bytes=self._get_graph_def_bytes())
+
+    tensors_to_eval = entry.fetch_names
+    activation_names = self.tigraph_factory.activation_names
+    assert tensors_to_eval
     
-    util.log.info("Creating inference graph ...")
-    final_graph = self.tigraph_factory.create_inference_graph(
-                                              input_image,
-                                              graph)
-    util.log.info("... done creating inference graph.")
+    batches = util.iter_prefetched(
+                  self._iter_normalized_batches(iter_imagerows),
+                  max_queued=self.MAX_QUEUED_BATCHES)
+    for rows, arr in batches:
+      self.tf_thruput.start_block()
+      result = entry.sess.run(
+                  tensors_to_eval, feed_dict={entry.input_name: arr})
+      self.tf_thruput.stop_block(n=len(rows), num_bytes=arr.nbytes)
+        # NB: If `overall_thruput` is much lower than `tf_thruput`, then
+        # decoding / normalization (not Tensorflow) is the bottleneck
+      
+      assert len(result) >= 1
+      assert result[0].shape[0] == len(rows)
+      for n, row in enumerate(rows):
+        tensor_to_value = dict(
+                    (name, result[i][n,...])
+                    for i, name in enumerate(activation_names))
 
-    with final_graph.as_default():
-      # TODO: support using single GPUs; requires running in a subprocess
-      # due to Tensorflow memory madness :( 
-      with util.tf_cpu_session() as sess:
-          
-        tensors_to_eval = self.tigraph_factory.output_names
-        assert tensors_to_eval
+        if 'activations' not in row.attrs:
+          row.attrs['activations'] = []  
         
-        while True:
-          try:
-            self.tf_thruput.start_block()
-            result = sess.run(tensors_to_eval)
-            self.tf_thruput.stop_block()
-                # NB: above will processes `batch_size` rows in one run()
-          except (tf.errors.OutOfRangeError, StopIteration):
-            # see MonitoredTrainingSession.StepContext
-            break
-          
-          assert len(result) >= 1
-          batch_size = result[0].shape[0]
-          for n in range(batch_size):
-            row = processed_rows.get(block=True)
-              # NB: we expect worker threads to spend most of their time
-              # blocking on the Tensorflow `sess.run()` call above, so
-              # this Queue::get() call should in practice block very rarely.
-              # Confirm using thruput stats (`overall_thruput` vs `tf_thruput`)
-
-            tensor_to_value = dict(
-                        (name, result[i][n,...])
-                        for i, name in enumerate(tensors_to_eval))
-
-            if 'activations' not in row.attrs:
-              row.attrs['activations'] = []  
-            
-            act = Activations(
-                      model_name=self.tigraph_factory.model_name,
-                      tensor_to_value=tensor_to_value)
-            row.attrs['activations'].append(act)
-            yield row
-    
-            self.tf_thruput.update_tallies(n=1)
-            self.overall_thruput.update_tallies(n=1)
-    tf.reset_default_graph()
+        act = Activations(
+                  model_name=self.tigraph_factory.model_name,
+                  tensor_to_value=tensor_to_value,
+                  quantize=self.tigraph_factory.params.ACTIVATIONS_QUANTIZE)
+        row.attrs['activations'].append(act)
+        yield row
+      
+      self.overall_thruput.update_tallies(n=len(rows), num_bytes=arr.nbytes)
     self.overall_thruput.stop_block()
 
 class ActivationsTable(object):
@@ -245,53 +498,730 @@ class ActivationsTable(object):
   MODEL_PARAMS = None
   IMAGE_TABLE_CLS = None
 
+  # How to store tensors:
+  #  * 'udt' - one row per (image, tensor); `tensor_value` is an opaque
+  #      `au.spark.NumpyArray`
+  #  * 'arrow' - one row per (image, tensor); `tensor_value` is a flat
+  #      (row-major) list<float32> and `tensor_shape` is its shape, so that
+  #      vectorized readers (e.g. pyarrow, Spark SQL) can use the values
+  #      directly.
+  #  * 'wide' - one row per image with a list<float32> column (and a
+  #      `_shape` column) per tensor (see `tensor_column()`).  Readers can
+  #      project just the layers they need.
+  TENSOR_LAYOUT = 'udt'
+  TENSOR_LAYOUTS = ('udt', 'arrow', 'wide')
+
+  # NB: all layouts are partitioned by `model_name` first, so that a model
+  # can be rebuilt without touching other models' activations
+  PARTITION_COLS = ['model_name'] + dataset.ImageRow.DEFAULT_PQ_PARTITION_COLS
+
+  ARROW_BATCH_ROWS = 1000
+  
+  # ... and at most this many tensor values, so that list<float32> offsets
+  # (int32) can't overflow
+  ARROW_BATCH_MAX_VALUES = 2**28
+
+  # `setup()` computes and appends activations for this many image table
+  # (Parquet) files at a time; use a non-positive value to build in a single
+  # round
+  BUILD_ROUND_FILES = 100
+
+  # `iter_tensor_blocks()` evicts the least recently used decoded blocks
+  # once its cache holds more than this many bytes
+  TENSOR_BLOCK_CACHE_MAX_BYTES = int(20e9)
+
+  # `setup()` writes each round here (under `table_root()`) first; NB: Spark
+  # and `dataset.iter_pq_files()` skip paths starting with '_'
+  STAGING_DIRNAME = '_staging'
+
   @classmethod
   def table_root(cls):
     return os.path.join(conf.AU_TABLE_CACHE, cls.TABLE_NAME)
+
+  @staticmethod
+  def iter_activation_records(imagerows):
+    """Generate (`ImageRow`, model name, tensor name, `NumpyArray`) for all
+    activations in `imagerows`."""
+    for row in imagerows:
+      if row.attrs is '':
+        continue
+
+      activations = row.attrs.get('activations')
+      if not activations:
+        continue
+      
+      for act in activations:
+        for tensor_name, value in act._tensor_to_value.iteritems():
+          yield row, act.model_name, tensor_name, value
+
+  @staticmethod
+  def arrow_schema():
+    import pyarrow as pa
+    return pa.schema([
+      pa.field('model_name', pa.string()),
+      pa.field('tensor_name', pa.string()),
+      pa.field('tensor_shape', pa.list_(pa.int32())),
+      pa.field('tensor_value', pa.list_(pa.float32())),
+      pa.field('dataset', pa.string()),
+      pa.field('split', pa.string()),
+      pa.field('uri', pa.string()),
+    ])
+
+  @classmethod
+  def to_arrow_batch(cls, records):
+    """Build a `pyarrow.RecordBatch` (with `arrow_schema()`) from records
+    from `iter_activation_records()`, grouped by tensor.  Tensor values are
+    copied once (into one contiguous float32 buffer per batch)."""
+    import pyarrow as pa
+
+    # Group tensors so that readers can slice (rather than gather) them
+    records = sorted(records, key=lambda r: (r[1], r[2]))
+    cls._check_unquantized(value for _, _, _, value in records)
+    arrs = [value.arr for _, _, _, value in records]
+
+    arrays = [
+      _to_string_array(r[1] for r in records),
+      _to_string_array(r[2] for r in records),
+      _to_shape_list_array(arrs),
+      _to_value_list_array(arrs),
+      _to_string_array(r[0].dataset for r in records),
+      _to_string_array(r[0].split for r in records),
+      _to_string_array(r[0].uri for r in records),
+    ]
+    return pa.RecordBatch.from_arrays(arrays, cls.arrow_schema().names)
+
+  @classmethod
+  def _iter_arrow_chunks(cls, items, size_func):
+    """Generate lists of `items` with at most `ARROW_BATCH_ROWS` items and
+    (unless one item is bigger) `ARROW_BATCH_MAX_VALUES` total values
+    according to `size_func`"""
+    chunk, n_values = [], 0
+    for item in items:
+      size = size_func(item)
+      if chunk and (
+          len(chunk) >= cls.ARROW_BATCH_ROWS or
+          n_values + size > cls.ARROW_BATCH_MAX_VALUES):
+        yield chunk
+        chunk, n_values = [], 0
+      chunk.append(item)
+      n_values += size
+    if chunk:
+      yield chunk
+
+  @staticmethod
+  def _check_unquantized(values):
+    for value in values:
+      if getattr(value, 'quantize', None) is not None:
+        raise ValueError(
+          "The 'arrow' and 'wide' layouts store float32 values and can't "
+          "hold %s-quantized activations; use the 'udt' layout" % (
+            value.quantize,))
+
+  @staticmethod
+  def tensor_column(tensor_name):
+    """Return the name of the 'wide' layout column for `tensor_name`; the
+    tensor's shape is in column `tensor_column(tensor_name) + '_shape'`"""
+    import re
+    return 't_' + re.sub(r'[^0-9a-zA-Z_]', '_', tensor_name)
+
+  @classmethod
+  def wide_arrow_schema(cls, tensor_names):
+    import pyarrow as pa
+    fields = [
+      pa.field('model_name', pa.string()),
+      pa.field('dataset', pa.string()),
+      pa.field('split', pa.string()),
+      pa.field('uri', pa.string()),
+    ]
+    for tensor_name in tensor_names:
+      col = cls.tensor_column(tensor_name)
+      fields.append(pa.field(col, pa.list_(pa.float32())))
+      fields.append(pa.field(col + '_shape', pa.list_(pa.int32())))
+    return pa.schema(fields)
+
+  @classmethod
+  def to_wide_arrow_batch(cls, imagerows, model_name, tensor_names):
+    """Build a `pyarrow.RecordBatch` (with `wide_arrow_schema()`) holding
+    one row per `ImageRow` in `imagerows` with activations for model
+    `model_name`."""
+    import pyarrow as pa
+
+    rows = []
+    tensor_to_arrs = dict((t, []) for t in tensor_names)
+    for row in imagerows:
+      if row.attrs is '':
+        continue
+      acts = [
+        act for act in row.attrs.get('activations', [])
+        if act.model_name == model_name
+      ]
+      if not acts:
+        continue
+      rows.append(row)
+      t_to_v = acts[0]._tensor_to_value
+      cls._check_unquantized(t_to_v.itervalues())
+      for tensor_name in tensor_names:
+        tensor_to_arrs[tensor_name].append(t_to_v[tensor_name].arr)
+
+    arrays = [
+      _to_string_array(model_name for _ in rows),
+      _to_string_array(r.dataset for r in rows),
+      _to_string_array(r.split for r in rows),
+      _to_string_array(r.uri for r in rows),
+    ]
+    for tensor_name in tensor_names:
+      arrs = tensor_to_arrs[tensor_name]
+      arrays.append(_to_value_list_array(arrs))
+      arrays.append(_to_shape_list_array(arrs))
+    schema = cls.wide_arrow_schema(tensor_names)
+    return pa.RecordBatch.from_arrays(arrays, schema.names)
+
+  @staticmethod
+  def _list_offsets_and_values(list_array):
+    """Return the (rebased) offsets and flat values of pyarrow `ListArray`
+    `list_array` as numpy arrays (without copying)."""
+    import numpy as np
+    n = len(list_array)
+    # NB: flatten() ignores slicing in pyarrow 0.12, so use the offsets
+    offsets = np.frombuffer(list_array.buffers()[1], dtype=np.int32)
+    offsets = offsets[list_array.offset:list_array.offset + n + 1]
+    values = list_array.flatten().to_numpy()[offsets[0]:offsets[-1]]
+    return offsets - offsets[0], values
+
+  @classmethod
+  def tensor_column_to_numpy(cls, list_array, shape, idx=None):
+    """Return the values of pyarrow `ListArray` `list_array` (or only the
+    entries at sorted indices `idx`), all of which hold a tensor of the
+    given `shape`, as a numpy array of shape [N] + `shape`.  Contiguous
+    entries need no copy."""
+    import numpy as np
+    offsets, values = cls._list_offsets_and_values(list_array)
+    if idx is None:
+      idx = np.arange(len(list_array))
+    size = int(np.prod(shape))
+    starts = offsets[idx]
+    if len(idx) and starts[-1] - starts[0] == size * (len(idx) - 1):
+      arr = values[starts[0]:starts[0] + size * len(idx)]
+    else:
+      arr = values[starts[:, np.newaxis] + np.arange(size)]
+    return arr.reshape([len(idx)] + list(shape))
+
+  @classmethod
+  def read_tensors(cls, tensor_name, table_root=None, model_name=None):
+    """Read all values of `tensor_name` from this table (or `table_root`)
+    and return a pair (uris, [N] + shape array of values) using pyarrow
+    alone; see `iter_tensor_blocks()`."""
+    import numpy as np
+    blocks = list(cls.iter_tensor_blocks(
+                    tensor_name,
+                    model_name=model_name,
+                    table_root=table_root,
+                    n_procs=0))
+    if not blocks:
+      return [], np.array([], dtype=np.float32)
+    uris = [uri for block in blocks for uri in block.uris.tolist()]
+    return uris, np.concatenate([block.values for block in blocks])
+
+  @classmethod
+  def iter_tensor_blocks(
+        cls,
+        tensor_name,
+        model_name=None,
+        table_root=None,
+        n_procs=None,
+        cache_dir=None):
+    """Generate a `TensorBlock` of the values of `tensor_name` (optionally
+    only those of model `model_name`) for each Parquet file (shard) of this
+    table (or `table_root`), without Spark or per-row Python objects.  For
+    'wide' tables, we read only the column for `tensor_name`.
+
+    A pool of `n_procs` processes (by default, one per CPU) decodes shards
+    into .npy files under `cache_dir` (by default in `conf.AU_CACHE_TMP`),
+    which we then memory-map, so blocks never get copied between processes
+    and later scans of unchanged shards skip decoding.  After each scan we
+    evict blocks to keep the cache under `TENSOR_BLOCK_CACHE_MAX_BYTES`.
+    Use `n_procs=0` to decode in this process instead."""
+    table_root = table_root or cls.table_root()
+    if not os.path.exists(table_root):
+      return
+    paths = list(dataset.iter_pq_files(table_root))
+    if model_name is not None:
+      # Skip other models' partitions
+      paths = [
+        path for path in paths
+        if dataset.pq_partition_values(table_root, path).get(
+                                    'model_name', model_name) == model_name
+      ]
+
+    if n_procs == 0:
+      for path in paths:
+        uris, values = _read_tensor_file(
+                  cls.TENSOR_LAYOUT, path, tensor_name, model_name)
+        if len(uris):
+          yield TensorBlock(
+            path,
+            dataset.pq_partition_values(table_root, path),
+            uris,
+            values)
+      return
+
+    import multiprocessing
+    import numpy as np
+    cache_dir = cache_dir or os.path.join(conf.AU_CACHE_TMP, 'tensor_blocks')
+    util.mkdir(cache_dir)
+    n_procs = n_procs or multiprocessing.cpu_count()
+    args = [
+      (cls.TENSOR_LAYOUT, path, tensor_name, model_name, cache_dir)
+      for path in paths
+    ]
+    pool = multiprocessing.Pool(processes=n_procs)
+    try:
+      for path, block_paths in zip(
+            paths, pool.imap(_cache_tensor_file, args)):
+        if block_paths is None:
+          continue
+        uris_path, values_path = block_paths
+        yield TensorBlock(
+          path,
+          dataset.pq_partition_values(table_root, path),
+          np.load(uris_path),
+          np.load(values_path, mmap_mode='r'))
+      pool.close()
+    finally:
+      pool.terminate()
+      # NB: evicting blocks that the caller still has mapped is safe
+      _evict_tensor_blocks(cache_dir, cls.TENSOR_BLOCK_CACHE_MAX_BYTES)
   
   @classmethod
-  def setup(cls, spark=None):
+  def as_tensor_rdd(cls, spark, tensor_name, model_name=None):
+    """Return an RDD of (uri, numpy array) for all values of `tensor_name`
+    (optionally only those of model `model_name`) in this table."""
+    df = spark.read.parquet(cls.table_root())
+    if model_name is not None:
+      df = df.where(df.model_name == model_name)
+    
+    if cls.TENSOR_LAYOUT == 'udt':
+      df = df.where(df.tensor_name == tensor_name)
+      return df.select('uri', 'tensor_value').rdd.map(
+                              lambda row: (row.uri, row.tensor_value.arr))
+    
+    if cls.TENSOR_LAYOUT == 'wide':
+      col = cls.tensor_column(tensor_name)
+      df = df.select('uri', col, col + '_shape')
+    else:
+      df = df.where(df.tensor_name == tensor_name)
+      df = df.select('uri', 'tensor_value', 'tensor_shape')
+    
+    def to_uri_arr(row):
+      import numpy as np
+      uri, values, shape = row
+      return uri, np.array(values, dtype=np.float32).reshape(shape)
+    return df.rdd.map(to_uri_arr)
+
+  @classmethod
+  def existing_uris(cls, model_name, table_root=None, tensor_names=None):
+    """Return the set of image URIs that already have activations for model
+    `model_name` in this table (or in `table_root`); if given, only those
+    that have all of `tensor_names`, so that images a crashed build left
+    with only some of their tensors get recomputed.  Reads only the `uri`
+    (and `model_name` and `tensor_name`) columns using pyarrow."""
+    import pyarrow.parquet as pq
+
+    table_root = table_root or cls.table_root()
+    if not os.path.exists(table_root):
+      return set()
+    
+    uri_to_tensors = {}
+    for path in dataset.iter_pq_files(table_root):
+      partition = dataset.pq_partition_values(table_root, path)
+      if partition.get('model_name', model_name) != model_name:
+        continue
+      pf = pq.ParquetFile(path)
+      names = pf.schema.to_arrow_schema().names
+      table = pf.read(columns=[
+        c for c in ('uri', 'model_name', 'tensor_name') if c in names])
+      def column(name):
+        return table.column(table.schema.get_field_index(name)).to_pylist()
+      
+      uris = column('uri')
+      model_names = [model_name] * len(uris)
+      if 'model_name' in table.schema.names:
+        model_names = column('model_name')
+      if 'tensor_name' in table.schema.names:
+        row_tensors = [(t,) for t in column('tensor_name')]
+      else:
+        # 'wide' rows have a column per tensor
+        present = tuple(
+          t for t in tensor_names or () if cls.tensor_column(t) in names)
+        row_tensors = [present] * len(uris)
+      for uri, name, tensors in zip(uris, model_names, row_tensors):
+        if name == model_name:
+          uri_to_tensors.setdefault(uri, set()).update(tensors)
+    
+    expected = set(tensor_names or ())
+    return set(
+      uri for uri, tensors in uri_to_tensors.iteritems()
+      if expected <= tensors)
+
+  @classmethod
+  def setup(cls, spark=None, incremental=True):
+    """Build the table.  If `incremental`, we only compute activations for
+    images that don't already have them (see `existing_uris()`); otherwise
+    we first drop the model's existing partition.  We read and process
+    `BUILD_ROUND_FILES` image table files per Spark job.  Each job writes
+    to a staging directory (see `_commit_round()`) that we move into the
+    table only once the job succeeds, so a crashed build resumes after the
+    last committed round."""
     log = util.create_log()
     log.info("Building table %s ..." % cls.TABLE_NAME)
+    if cls.TENSOR_LAYOUT not in cls.TENSOR_LAYOUTS:
+      raise ValueError("Unknown layout %s, try one of %s" % (
+                          cls.TENSOR_LAYOUT, cls.TENSOR_LAYOUTS))
+
+    quantize = getattr(cls.MODEL_PARAMS, 'ACTIVATIONS_QUANTIZE', None)
+    if cls.TENSOR_LAYOUT != 'udt' and quantize is not None:
+      raise ValueError(
+        "ACTIVATIONS_QUANTIZE (%s) requires the 'udt' layout, not %s" % (
+          quantize, cls.TENSOR_LAYOUT))
 
     spark = spark or util.Spark.getOrCreate()
     
-    img_rdd = cls.IMAGE_TABLE_CLS.as_imagerow_rdd(spark)
-
     model = cls.NNMODEL_CLS.load_or_train(cls.MODEL_PARAMS)
+    model_name = model.params.MODEL_NAME
+    
+    table_root = cls.table_root()
+    stage_dir = os.path.join(table_root, cls.STAGING_DIRNAME)
+    if os.path.exists(stage_dir):
+      log.info("... dropping uncommitted round in %s ..." % stage_dir)
+      util.rm_rf(stage_dir)
+
+    if incremental:
+      done_uris = cls.existing_uris(
+        model_name,
+        tensor_names=model.get_inference_graph().activation_names)
+      log.info(
+        "... found %s images with existing activations ..." % len(done_uris))
+    else:
+      done_uris = set()
+      if os.path.exists(table_root):
+        unpartitioned = [
+          path for path in dataset.iter_pq_files(table_root)
+          if 'model_name' not in dataset.pq_partition_values(table_root, path)
+        ]
+        if unpartitioned:
+          raise ValueError(
+            "Table %s has files not partitioned by model_name (e.g. %s); "
+            "remove the table to rebuild it" % (
+              table_root, unpartitioned[0]))
+      model_root = os.path.join(table_root, 'model_name=' + model_name)
+      if os.path.exists(model_root):
+        log.info("... removing existing activations in %s ..." % model_root)
+        util.rm_rf(model_root)
+
     filler = FillActivationsTFDataset(model=model)
+    filler.broadcast_graph_def(spark)
+    done_uris_b = spark.sparkContext.broadcast(done_uris)
 
-    activated = img_rdd.mapPartitions(filler)
+    for img_rdd in cls._iter_image_rdd_rounds(spark):
+      img_rdd = img_rdd.filter(lambda row: row.uri not in done_uris_b.value)
+      activated = img_rdd.mapPartitions(filler)
+      df = cls._to_activations_df(spark, activated, model)
+      df.write.parquet(
+            path=stage_dir,
+            mode='overwrite',
+            compression='lz4',
+            partitionBy=cls.PARTITION_COLS)
+      cls._commit_round(stage_dir, table_root)
+    log.info("... wrote to %s ." % table_root)
 
-    def to_activation_rows(imagerows):
-      from pyspark.sql import Row
-      for row in imagerows:
-        if row.attrs is '':
-          continue
+  @classmethod
+  def _commit_round(cls, stage_dir, table_root):
+    """Move the Parquet files of a finished round from `stage_dir` into
+    their partitions under `table_root`.  NB: Spark writes all of an
+    image's activations in a single task, and a task writes one file per
+    partition (of `PARTITION_COLS`), so even if we crash part way, every
+    image in the table has all of its activations."""
+    for path in dataset.iter_pq_files(stage_dir):
+      dest = os.path.join(table_root, os.path.relpath(path, stage_dir))
+      util.mkdir(os.path.dirname(dest))
+      os.rename(path, dest)
+    util.rm_rf(stage_dir)
 
-        activations = row.attrs.get('activations')
-        if not activations:
-          continue
-        
-        for act in activations:
-          for tensor_name, value in act._tensor_to_value.iteritems():
-            yield Row(
-              model_name=model.params.MODEL_NAME,
-              tensor_name=tensor_name,
-              tensor_value=value,
-              
-              dataset=row.dataset,
-              split=row.split,
-              uri=row.uri,
-            )
+  @classmethod
+  def _iter_image_rdd_rounds(cls, spark):
+    """Generate an RDD of `ImageRow`s for each build round: one per
+    `BUILD_ROUND_FILES` Parquet files of `IMAGE_TABLE_CLS`, so that each
+    round reads only its own files.  Image tables not stored as Parquet
+    get built in a single round."""
+    log = util.create_log()
+    img_root = cls.IMAGE_TABLE_CLS.table_root()
+    paths = []
+    if os.path.exists(img_root):
+      paths = list(dataset.iter_pq_files(img_root))
+    round_files = cls.BUILD_ROUND_FILES
+    if not paths or round_files < 1:
+      yield cls.IMAGE_TABLE_CLS.as_imagerow_rdd(spark)
+      return
+    
+    for start in range(0, len(paths), round_files):
+      round_paths = paths[start:start + round_files]
+      log.info("... computing image files [%s, %s) of %s ..." % (
+                  start, start + len(round_paths), len(paths)))
+      yield cls.IMAGE_TABLE_CLS.as_imagerow_rdd(spark, paths=round_paths)
+
+  @classmethod
+  def _to_activations_df(cls, spark, activated, model):
+    """Return a DataFrame (in `TENSOR_LAYOUT`) of the activations in RDD
+    `activated` of `ImageRow`s"""
+    if cls.TENSOR_LAYOUT == 'wide':
+      from au.spark import Spark
+
+      model_name = model.params.MODEL_NAME
+      tensor_names = tuple(model.get_inference_graph().activation_names)
+      def row_size(row):
+        return sum(
+          value.arr.size
+          for act in (row.attrs or {}).get('activations', [])
+          for value in act._tensor_to_value.itervalues())
+      def to_wide_arrow_batches(imagerows):
+        for chunk in cls._iter_arrow_chunks(imagerows, row_size):
+          batch = cls.to_wide_arrow_batch(chunk, model_name, tensor_names)
+          yield batch.serialize().to_pybytes()
+
+      batch_rdd = activated.mapPartitions(to_wide_arrow_batches)
+      df = Spark.df_from_arrow_batch_rdd(
+                        spark, batch_rdd, cls.wide_arrow_schema(tensor_names))
+    
+    elif cls.TENSOR_LAYOUT == 'arrow':
+      from au.spark import Spark
+
+      def to_arrow_batches(imagerows):
+        records = cls.iter_activation_records(imagerows)
+        chunks = cls._iter_arrow_chunks(records, lambda r: r[3].arr.size)
+        for chunk in chunks:
+          yield cls.to_arrow_batch(chunk).serialize().to_pybytes()
+
+      batch_rdd = activated.mapPartitions(to_arrow_batches)
+      df = Spark.df_from_arrow_batch_rdd(
+                        spark, batch_rdd, cls.arrow_schema())
     
-    activation_row_rdd = activated.mapPartitions(to_activation_rows)
-
-    df = spark.createDataFrame(activation_row_rdd)
-    df.show()
-    writer = df.write.parquet(
-                path=cls.table_root(),
-                mode='overwrite',
-                compression='lz4',
-                partitionBy=dataset.ImageRow.DEFAULT_PQ_PARTITION_COLS)
-    log.info("... wrote to %s ." % cls.table_root())
+    else:
+      from au.spark import NumpyArrayUDT
+      from pyspark.sql import types
+
+      # NB: we need an explicit schema since a round may have no rows
+      schema = types.StructType([
+        types.StructField('model_name', types.StringType()),
+        types.StructField('tensor_name', types.StringType()),
+        types.StructField('tensor_value', NumpyArrayUDT()),
+        types.StructField('dataset', types.StringType()),
+        types.StructField('split', types.StringType()),
+        types.StructField('uri', types.StringType()),
+      ])
+      def to_activation_rows(imagerows):
+        records = cls.iter_activation_records(imagerows)
+        for row, model_name, tensor_name, value in records:
+          yield (
+            model_name,
+            tensor_name,
+            value,
+            
+            row.dataset,
+            row.split,
+            row.uri,
+          )
+      
+      activation_row_rdd = activated.mapPartitions(to_activation_rows)
+      df = spark.createDataFrame(activation_row_rdd, schema=schema)
+    return df
+
+class TensorBlock(object):
+  """The values of one tensor in one shard (Parquet file at `path`) of an
+  `ActivationsTable`: `values` is an [N] + shape (perhaps memory-mapped)
+  array, `uris` a parallel array, and `partition` holds the shard's
+  partition values (e.g. dataset and split)"""
+
+  __slots__ = ('path', 'partition', 'uris', 'values')
+
+  def __init__(self, path, partition, uris, values):
+    self.path = path
+    self.partition = partition
+    self.uris = uris
+    self.values = values
+
+  def __len__(self):
+    return len(self.uris)
+
+def _read_tensor_file(layout, path, tensor_name, model_name=None):
+  """Return (uris, [N] + shape array) of the values of `tensor_name` in
+  `ActivationsTable` Parquet file `path` with tensor layout `layout`"""
+  import numpy as np
+  import pyarrow.parquet as pq
+
+  pf = pq.ParquetFile(path)
+  uris = []
+  arrs = []
+  if layout == 'wide':
+    col = ActivationsTable.tensor_column(tensor_name)
+    if col in pf.schema.to_arrow_schema().names:
+      # NB: `model_name` is a partition column
+      table = pf.read(columns=['uri', col, col + '_shape'])
+      for batch in table.to_batches():
+        if not batch.num_rows:
+          continue
+        shape = batch.column(2).slice(0, 1).to_pylist()[0]
+        arrs.append(
+          ActivationsTable.tensor_column_to_numpy(batch.column(1), shape))
+        uris.extend(batch.column(0).to_pylist())
+  else:
+    # NB: 'arrow' and 'udt' tables have the same row structure, and
+    # `model_name` is a partition column unless the file predates that
+    names = pf.schema.to_arrow_schema().names
+    is_arrow = 'tensor_shape' in names
+    value_cols = ['tensor_value']
+    if is_arrow:
+      value_cols = ['tensor_shape', 'tensor_value']
+    cols = ['tensor_name', 'uri'] + value_cols
+    if 'model_name' in names:
+      cols.append('model_name')
+    table = pf.read(columns=cols)
+    for batch in table.to_batches():
+      column = lambda name: batch.column(batch.schema.get_field_index(name))
+      selected = column('tensor_name').to_pandas() == tensor_name
+      if model_name is not None and 'model_name' in cols:
+        selected &= column('model_name').to_pandas() == model_name
+      idx = np.flatnonzero(selected)
+      if not len(idx):
+        continue
+      if is_arrow:
+        shape = column('tensor_shape').slice(int(idx[0]), 1).to_pylist()[0]
+        arrs.append(
+          ActivationsTable.tensor_column_to_numpy(
+                                column('tensor_value'), shape, idx=idx))
+      else:
+        from au.spark import NumpyArray
+        # `NumpyArrayUDT`s are structs of encoded bytes
+        np_bytes = column('tensor_value').field(0).to_pylist()
+        arrs.append(np.stack([
+          NumpyArray.from_bytes(np_bytes[i]).arr for i in idx]))
+      batch_uris = column('uri').to_pylist()
+      uris.extend(batch_uris[i] for i in idx)
+  
+  if not arrs:
+    return np.array([]), np.array([], dtype=np.float32)
+  return np.array(uris), np.concatenate(arrs)
+
+def _cache_tensor_file(args):
+  """Decode a shard (see `_read_tensor_file()`) into .npy files in
+  `cache_dir` (unless they exist) and return their paths (or None if the
+  shard has no values)"""
+  layout, path, tensor_name, model_name, cache_dir = args
+  
+  import hashlib
+  import numpy as np
+  st = os.stat(path)
+  key = hashlib.sha1('\0'.join(str(v) for v in (
+    layout, path, st.st_size, st.st_mtime, tensor_name, model_name,
+  ))).hexdigest()
+  uris_path = os.path.join(cache_dir, key + '.uris.npy')
+  values_path = os.path.join(cache_dir, key + '.values.npy')
+  empty_path = os.path.join(cache_dir, key + '.empty')
+  try:
+    # Bump mtimes of hits for `_evict_tensor_blocks()`
+    if os.path.exists(empty_path):
+      os.utime(empty_path, None)
+      return None
+    if os.path.exists(values_path):
+      os.utime(uris_path, None)
+      os.utime(values_path, None)
+      return uris_path, values_path
+  except OSError:
+    # Evicted out from under us; decode again
+    pass
+
+  uris, values = _read_tensor_file(layout, path, tensor_name, model_name)
+  if not len(uris):
+    open(empty_path, 'w').close()
+    return None
+  for dest, arr in ((uris_path, uris), (values_path, values)):
+    tmp_path = '%s.%s.tmp' % (dest, os.getpid())
+    with open(tmp_path, 'wb') as f:
+      np.save(f, arr)
+    os.rename(tmp_path, dest)
+      # NB: atomic, and we write the values last, so readers never see
+      # partial blocks
+  return uris_path, values_path
+
+def _evict_tensor_blocks(cache_dir, max_bytes):
+  """Remove the least recently used blocks (see `_cache_tensor_file()`) in
+  `cache_dir` until it holds at most `max_bytes`"""
+  key_to_files = {}
+  for fname in os.listdir(cache_dir):
+    if fname.endswith('.tmp'):
+      # Still being written
+      continue
+    path = os.path.join(cache_dir, fname)
+    try:
+      st = os.stat(path)
+    except OSError:
+      continue
+    key = fname.split('.', 1)[0]
+    key_to_files.setdefault(key, []).append((path, st))
+  
+  # Evict all files of a block together
+  blocks = sorted(
+    key_to_files.itervalues(),
+    key=lambda files: max(st.st_mtime for _, st in files))
+  n_bytes = sum(st.st_size for files in blocks for _, st in files)
+  n_evicted = 0
+  for files in blocks:
+    if n_bytes <= max_bytes:
+      break
+    # Remove values first, so readers never see values without uris
+    for path, st in sorted(files, key=lambda f: '.values.' not in f[0]):
+      try:
+        os.remove(path)
+      except OSError:
+        pass
+      n_bytes -= st.st_size
+    n_evicted += 1
+  if n_evicted:
+    util.log.info(
+      "Evicted %s tensor blocks from %s, now %s bytes" % (
+        n_evicted, cache_dir, n_bytes))
+
+def _to_string_array(strs):
+  import pyarrow as pa
+  # pyarrow + python 2.7 -> str gets interpreted as binary
+  return pa.array(
+    [s.decode('utf-8') if isinstance(s, str) else s for s in strs],
+    type=pa.string())
+
+def _to_value_list_array(arrs):
+  """Build a list<float32> `pyarrow.ListArray` of the flattened `arrs` (one
+  copy, into a single contiguous buffer)"""
+  import numpy as np
+  import pyarrow as pa
+  values = [np.asarray(arr, dtype=np.float32).ravel() for arr in arrs]
+  offsets = np.zeros(len(values) + 1, dtype=np.int64)
+  np.cumsum([len(v) for v in values], out=offsets[1:])
+  if offsets[-1] > np.iinfo(np.int32).max:
+    # NB: list<> offsets are int32
+    raise ValueError(
+      "Too many values (%s) for one list<float32> array; use smaller "
+      "batches" % offsets[-1])
+  offsets = offsets.astype(np.int32)
+  flat = np.concatenate(values) if values else np.array([], np.float32)
+  return pa.ListArray.from_arrays(
+            pa.array(offsets), pa.array(flat, type=pa.float32()))
+
+def _to_shape_list_array(arrs):
+  """Build a list<int32> `pyarrow.ListArray` of the shapes of `arrs`"""
+  import numpy as np
+  import pyarrow as pa
+  shapes = [np.shape(arr) for arr in arrs]
+  offsets = np.zeros(len(shapes) + 1, dtype=np.int32)
+  np.cumsum([len(shape) for shape in shapes], out=offsets[1:])
+  flat = np.array([d for shape in shapes for d in shape], dtype=np.int32)
+  return pa.ListArray.from_arrays(
+            pa.array(offsets), pa.array(flat, type=pa.int32()))
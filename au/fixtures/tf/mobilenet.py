@@ -10,6 +10,7 @@ import tensorflow as tf
 
 from au import conf
 from au import util
+from au.fixtures import dataset
 from au.fixtures import nnmodel
 
 class Mobilenet(nnmodel.INNModel):
@@ -25,6 +26,10 @@ class Mobilenet(nnmodel.INNModel):
       self.CHECKPOINT = mobilenet_version
       self.INPUT_TENSOR_SHAPE = [None, self.IMG_SIZE, self.IMG_SIZE, 3]
 
+      # The 224px models share normalized inputs, so repeat runs (and the
+      # other sizes) can skip decoding and resizing
+      self.NORMALIZED_CACHE_MAX_BYTES = dataset.NormalizedCache.DEFAULT_MAX_BYTES
+
   class Small(Params):
     CHECKPOINT_TARBALL_URI = \
       'https://storage.googleapis.com/mobilenet_v2/checkpoints/mobilenet_v2_0.35_96.tgz'
@@ -0,0 +1,246 @@
+"""Locality-sensitive hashing (LSH) indices over activations for approximate
+nearest-neighbor retrieval of (e.g. training) examples."""
+
+from au import util
+
+import json
+import os
+
+import numpy as np
+
+class LSHIndex(object):
+  """An LSH index of activation vectors that answers k-NN queries by
+  examining only the vectors that share a bucket with the query in some
+  table, rather than scanning every vector.  Hash families:
+   * 'hyperplane' - each of `n_bits` bits is the sign of a random
+       projection (Charikar 2002); neighbors are ranked by cosine distance.
+   * 'pstable' - each of `n_bits` hashes is floor((a . v + b) / w) for
+       Gaussian `a` and bucket width w (Datar et al. 2004); neighbors are
+       ranked by L2 distance.
+  With `n_probes` > 0, queries also visit the buckets that differ from the
+  query's in the hash(es) the query is closest to flipping (Lv et al. 2007's
+  multi-probe LSH), which achieves high recall with fewer tables.
+
+  For each table we store bucket codes as a sorted uint64 array plus the
+  permutation of vector ids that sorts them, so the index is a handful of
+  compact NumPy arrays (see `save()`), and lookups are binary searches.
+  """
+
+  FAMILIES = ('hyperplane', 'pstable')
+
+  PARAMS = ('dim', 'family', 'n_tables', 'n_bits', 'bucket_width', 'seed')
+  HASH_ARRAYS = ('projections', 'offsets', 'coeffs')
+  DATA_ARRAYS = ('vectors', 'uris', 'labels', 'sorted_codes', 'order')
+
+  def __init__(
+        self,
+        dim,
+        family='hyperplane',
+        n_tables=8,
+        n_bits=16,
+        bucket_width=4.,
+        seed=1337):
+
+    if family not in self.FAMILIES:
+      raise ValueError(
+        "Unknown family %s, try one of %s" % (family, self.FAMILIES))
+    if family == 'hyperplane' and n_bits > 63:
+      raise ValueError("Hyperplane codes have at most 63 bits")
+
+    self.dim = dim
+    self.family = family
+    self.n_tables = n_tables
+    self.n_bits = n_bits
+    self.bucket_width = bucket_width
+    self.seed = seed
+
+    rand = np.random.RandomState(seed)
+    self.projections = rand.randn(n_tables, dim, n_bits).astype(np.float32)
+    self.offsets = rand.uniform(
+      0, bucket_width, size=(n_tables, n_bits)).astype(np.float32)
+    # For 'pstable', codes are (wrapping) random linear combinations of the
+    # hashes, so a probe that moves one hash by +/- 1 just adds a coefficient
+    self.coeffs = rand.randint(
+      1, 2 ** 62, size=(n_tables, n_bits)).astype(np.uint64)
+
+    self.vectors = None       # [N, dim] float32
+    self.uris = None          # [N] str
+    self.labels = None        # Optional [N]
+    self.sorted_codes = None  # [n_tables, N] uint64
+    self.order = None         # [n_tables, N] vector ids sorting the codes
+
+  def __len__(self):
+    return 0 if self.vectors is None else len(self.vectors)
+
+  def fit(self, vectors, uris, labels=None):
+    """Index [N, dim] `vectors` (e.g. activations) with parallel arrays of
+    `uris` and (optionally) `labels` (e.g. classes)"""
+    vectors = self._as_vectors(vectors)
+    codes, _ = self.hash(vectors)
+    self._index(vectors, uris, labels, codes)
+    return self
+
+  def hash(self, vectors):
+    """Return ([N, n_tables] uint64 bucket codes, [N, n_tables, n_bits]
+    per-hash values used for probing) for [N, dim] `vectors`"""
+    vectors = self._as_vectors(vectors)
+    proj = np.tensordot(vectors, self.projections, axes=([1], [1]))
+    if self.family == 'hyperplane':
+      bits = (proj > 0).astype(np.uint64)
+      codes = (bits << np.arange(self.n_bits, dtype=np.uint64)).sum(
+                                                axis=2, dtype=np.uint64)
+      return codes, proj
+    else:
+      scaled = (proj + self.offsets) / self.bucket_width
+      h = np.floor(scaled)
+      codes = (h.astype(np.int64).astype(np.uint64) * self.coeffs).sum(
+                                                axis=2, dtype=np.uint64)
+      return codes, scaled - h
+
+  def probe_codes(self, codes, aux, n_probes=0):
+    """Return [N, n_tables, 1 + n_probes] codes to visit given the results
+    of `hash()`: first each query's own bucket, then those of the most
+    likely single-hash perturbations."""
+    probes = [codes[..., np.newaxis]]
+    if n_probes > 0:
+      if self.family == 'hyperplane':
+        # Flip the bits whose projections are closest to zero
+        n_probes = min(n_probes, self.n_bits)
+        idx = np.argsort(np.abs(aux), axis=2)[..., :n_probes]
+        flips = np.left_shift(np.uint64(1), idx.astype(np.uint64))
+        probes.append(codes[..., np.newaxis] ^ flips)
+      else:
+        # Move the hashes whose values are closest to a bucket boundary
+        n_probes = min(n_probes, 2 * self.n_bits)
+        costs = np.concatenate([aux, 1. - aux], axis=2)
+        idx = np.argsort(costs, axis=2)[..., :n_probes]
+        hash_idx = idx % self.n_bits
+        tables = np.arange(self.n_tables)[np.newaxis, :, np.newaxis]
+        deltas = self.coeffs[tables, hash_idx]
+        up = idx >= self.n_bits
+        base = codes[..., np.newaxis]
+        probes.append(np.where(up, base + deltas, base - deltas))
+    return np.concatenate(probes, axis=2)
+
+  def query(self, vectors, k=10, n_probes=0):
+    """Return ([Q, k] vector ids, [Q, k] distances) of the (approximate)
+    `k` nearest indexed neighbors of each of [Q, dim] `vectors`, nearest
+    first.  Use e.g. `uris[ids]` and `labels[ids]` for details.  Missing
+    neighbors have id -1 and distance inf."""
+    vectors = self._as_vectors(vectors)
+    codes, aux = self.hash(vectors)
+    probes = self.probe_codes(codes, aux, n_probes=n_probes)
+    n_q, _, n_p = probes.shape
+
+    # Bucket [lo, hi) ranges for every query and probe, a table at a time
+    ranges = []
+    for t in range(self.n_tables):
+      t_probes = probes[:, t, :].ravel()
+      lo = np.searchsorted(self.sorted_codes[t], t_probes, side='left')
+      hi = np.searchsorted(self.sorted_codes[t], t_probes, side='right')
+      ranges.append((lo.reshape(n_q, n_p), hi.reshape(n_q, n_p)))
+
+    ids = np.full((n_q, k), -1, dtype=np.int64)
+    dists = np.full((n_q, k), np.inf, dtype=np.float32)
+    for q in range(n_q):
+      cands = [
+        self.order[t, a:b]
+        for t, (lo, hi) in enumerate(ranges)
+        for a, b in zip(lo[q], hi[q]) if b > a
+      ]
+      if not cands:
+        continue
+      cands = np.unique(np.concatenate(cands))
+      cand_dists = self._distances(vectors[q], self.vectors[cands])
+      top = np.argsort(cand_dists)[:k]
+      ids[q, :len(top)] = cands[top]
+      dists[q, :len(top)] = cand_dists[top]
+    return ids, dists
+
+  def save(self, path):
+    """Save to directory `path` as one .npy file per array (so that `load()`
+    can memory-map them) plus parameters in JSON"""
+    util.mkdir(path)
+    with open(os.path.join(path, 'params.json'), 'w') as f:
+      json.dump(dict((k, getattr(self, k)) for k in self.PARAMS), f)
+    for name in self.HASH_ARRAYS + self.DATA_ARRAYS:
+      arr = getattr(self, name)
+      if arr is not None:
+        np.save(os.path.join(path, name + '.npy'), arr)
+    util.log.info("Saved LSH index of %s vectors to %s" % (len(self), path))
+
+  @classmethod
+  def load(cls, path, mmap_mode='r'):
+    with open(os.path.join(path, 'params.json')) as f:
+      params = json.load(f)
+    index = cls(**dict((str(k), v) for k, v in params.iteritems()))
+    for name in cls.HASH_ARRAYS + cls.DATA_ARRAYS:
+      arr_path = os.path.join(path, name + '.npy')
+      if os.path.exists(arr_path):
+        setattr(index, name, np.load(arr_path, mmap_mode=mmap_mode))
+    return index
+
+  @classmethod
+  def build_from_rdd(cls, tensor_rdd, **kwargs):
+    """Build an index of all vectors in RDD `tensor_rdd` of (uri, numpy
+    array) or (uri, numpy array, label) tuples (e.g. from
+    `ActivationsTable.as_tensor_rdd()`).  Executors hash their partitions
+    in parallel; the driver just sorts the codes."""
+    first = tensor_rdd.first()
+    index = cls(np.asarray(first[1]).size, **kwargs)
+    has_labels = len(first) > 2
+
+    def to_block(rows):
+      rows = list(rows)
+      if not rows:
+        return
+      vectors = index._as_vectors([r[1] for r in rows])
+      codes, _ = index.hash(vectors)
+      labels = [r[2] for r in rows] if has_labels else None
+      yield [r[0] for r in rows], labels, vectors, codes
+
+    util.log.info("Hashing vectors for LSH index ...")
+    blocks = tensor_rdd.mapPartitions(to_block).collect()
+    uris = [uri for block in blocks for uri in block[0]]
+    labels = None
+    if has_labels:
+      labels = [l for block in blocks for l in block[1]]
+    index._index(
+      np.concatenate([block[2] for block in blocks]),
+      uris,
+      labels,
+      np.concatenate([block[3] for block in blocks]))
+    util.log.info("... indexed %s vectors." % len(index))
+    return index
+
+  @classmethod
+  def build_from_table(
+        cls, spark, table_cls, tensor_name, model_name=None, **kwargs):
+    """Build an index of all values of `tensor_name` in `ActivationsTable`
+    `table_cls`"""
+    tensor_rdd = table_cls.as_tensor_rdd(
+                    spark, tensor_name, model_name=model_name)
+    return cls.build_from_rdd(tensor_rdd, **kwargs)
+
+  def _as_vectors(self, vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    vectors = vectors.reshape((len(vectors), -1))
+    assert vectors.shape[1] == self.dim, (vectors.shape, self.dim)
+    return vectors
+
+  def _index(self, vectors, uris, labels, codes):
+    self.vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    self.uris = np.array(uris)
+    self.labels = np.array(labels) if labels is not None else None
+    self.order = np.argsort(codes, axis=0, kind='mergesort').T
+    self.order = self.order.astype(
+      np.int32 if len(vectors) < 2 ** 31 else np.int64)
+    tables = np.arange(self.n_tables)[:, np.newaxis]
+    self.sorted_codes = codes.T[tables, self.order]
+
+  def _distances(self, vector, cands):
+    if self.family == 'hyperplane':
+      norms = np.linalg.norm(cands, axis=1) * np.linalg.norm(vector)
+      return 1. - cands.dot(vector) / np.maximum(norms, 1e-12)
+    else:
+      return np.linalg.norm(cands - vector, axis=1)
@@ -194,6 +194,51 @@ class Spark(object):
                 ThruputObsAccumulator())
 
 
+  ## Arrow Interop
+  # Spark uses Arrow internally to support `createDataFrame(pandas_df)` and
+  # `toPandas()`, but both of these conversions run on the driver.  Below we
+  # use the same (semi-private, Spark 2.4) JVM entry points so that *executors*
+  # can exchange Arrow record batches with the JVM directly.  This lets binary
+  # data (e.g. image bytes) skip pickling and pyspark type conversion.
+
+  @staticmethod
+  def is_arrow_enabled(spark):
+    enabled = spark.conf.get('spark.sql.execution.arrow.enabled', 'false')
+    return enabled.lower() == 'true'
+
+  @staticmethod
+  def df_from_arrow_batch_rdd(spark, batch_rdd, arrow_schema):
+    """Create a DataFrame from `batch_rdd`, an RDD of serialized Arrow record
+    batches (see `pyarrow.RecordBatch.serialize()`) that all have schema
+    `arrow_schema`."""
+    from pyspark.sql import DataFrame
+    from pyspark.sql.types import from_arrow_schema
+
+    schema = from_arrow_schema(arrow_schema)
+    batch_rdd._bypass_serializer = True
+      # NB: so that the JVM gets the raw batch bytes; see RDD.saveAsTextFile()
+    jdf = spark._jvm.PythonSQLUtils.toDataFrame(
+                          batch_rdd._jrdd,
+                          schema.json(),
+                          spark._wrapped._jsqlContext)
+    df = DataFrame(jdf, spark._wrapped)
+    df._schema = schema
+    return df
+
+  @staticmethod
+  def df_to_arrow_batch_rdd(df):
+    """Return a tuple of (RDD of serialized Arrow record batches, Arrow
+    schema) for DataFrame `df`; use `pyarrow.read_record_batch()` to decode
+    the batches."""
+    from pyspark.rdd import RDD
+    from pyspark.serializers import NoOpSerializer
+    from pyspark.sql.types import to_arrow_schema
+
+    arrow_schema = to_arrow_schema(df.schema)
+    jrdd = df._jdf.toArrowBatchRdd().toJavaRDD()
+    batch_rdd = RDD(jrdd, df.sql_ctx._sc, NoOpSerializer())
+    return batch_rdd, arrow_schema
+
   @staticmethod
   def num_executors(spark):
     # NB: Not a public API! But likely stable.
@@ -386,25 +431,114 @@ class NumpyArrayUDT(types.UserDefinedType):
     return "numpy.arr"
 
 class NumpyArray(object):
-  __slots__ = ('arr',)
+  """A wrapper for numpy arrays that Spark can (de)serialize via
+  `NumpyArrayUDT`.  Arrays are encoded as a small fixed header (see
+  `HEADER_FMT`) followed by the raw C-contiguous buffer, so decoding a
+  writable buffer (e.g. the bytearrays Spark gives us) is a zero-copy
+  `np.frombuffer()`; we copy read-only buffers (e.g. `str`s) so that decoded
+  arrays are always writable, as pickled ones were.  Optionally quantize (lossily) to 'float16'
+  or (per-array affine) 'int8' to shrink tables; decoding quantized arrays
+  restores the original dtype.  We can still decode older, pickled arrays.
+  """
+
+  __slots__ = ('arr', 'quantize')
   
   __UDT__ = NumpyArrayUDT()
 
-  def __init__(self, arr):
+  MAGIC = b'AUNP'
+  VERSION = 1
+
+  QUANTIZE_NONE = 0
+  QUANTIZE_FLOAT16 = 1
+  QUANTIZE_INT8 = 2
+  QUANTIZE_CODES = {
+    None: QUANTIZE_NONE,
+    'float16': QUANTIZE_FLOAT16,
+    'int8': QUANTIZE_INT8,
+  }
+
+  # magic, version, quantization, ndim, (unused), dtype str (e.g. '<f4'),
+  # then `ndim` int64 dims.  NB: all sizes are multiples of 8 bytes, so
+  # payloads stay aligned.
+  HEADER_FMT = '<4sBBBB8s'
+  DIM_FMT = '<q'
+  INT8_PARAMS_FMT = '<dd' # offset, scale
+
+  def __init__(self, arr, quantize=None):
+    if quantize not in self.QUANTIZE_CODES:
+      raise ValueError("Unknown quantization %s, try one of %s" % (
+                          quantize, self.QUANTIZE_CODES.keys()))
     self.arr = arr
+    self.quantize = quantize
 
   def get_bytes(self):
-    return pickle.dumps(self.arr)
-    # buf = io.BytesIO()
-    # np.save(buf, self.arr)
-    #   # NB: do NOT use savez / gzip b/c we'll let Snappy compress things.
-    # return buf.getvalue()
+    import struct
+    arr = np.asarray(self.arr)
+    if arr.dtype.hasobject or arr.dtype.fields is not None:
+      # Can't lay these out as raw bytes (or describe structured dtypes
+      # with `dtype.str`)
+      return pickle.dumps(arr, protocol=pickle.HIGHEST_PROTOCOL)
+    
+    quant = self.QUANTIZE_CODES[self.quantize]
+    if quant != self.QUANTIZE_NONE and arr.dtype.kind != 'f':
+      quant = self.QUANTIZE_NONE
+    
+    params = b''
+    if quant == self.QUANTIZE_FLOAT16:
+      payload = arr.astype(np.float16)
+    elif quant == self.QUANTIZE_INT8:
+      lo = float(arr.min()) if arr.size else 0.
+      hi = float(arr.max()) if arr.size else 0.
+      scale = (hi - lo) / 255. or 1.
+      payload = (np.round((arr - lo) / scale) - 128).astype(np.int8)
+      params = struct.pack(self.INT8_PARAMS_FMT, lo, scale)
+    else:
+      payload = arr
+
+    header = struct.pack(
+                self.HEADER_FMT,
+                self.MAGIC,
+                self.VERSION,
+                quant,
+                arr.ndim,
+                0,
+                arr.dtype.str)
+    dims = b''.join(struct.pack(self.DIM_FMT, d) for d in arr.shape)
+    return header + dims + params + np.ascontiguousarray(payload).tobytes()
 
-  @staticmethod
-  def from_bytes(b):
-    # arr = np.load(io.BytesIO(b), encoding='bytes')
-    arr = pickle.loads(b)
-    return NumpyArray(arr)
+  @classmethod
+  def from_bytes(cls, b):
+    import struct
+    if bytes(b[:len(cls.MAGIC)]) != cls.MAGIC:
+      # Legacy pickle encoding
+      return NumpyArray(pickle.loads(bytes(b)))
+    
+    _, version, quant, ndim, _, dtype_str = struct.unpack_from(
+                                                  cls.HEADER_FMT, b)
+    if version != cls.VERSION:
+      raise ValueError("Unsupported NumpyArray version %s" % version)
+    dtype = np.dtype(dtype_str.rstrip(b'\0'))
+    
+    offset = struct.calcsize(cls.HEADER_FMT)
+    dim_size = struct.calcsize(cls.DIM_FMT)
+    shape = tuple(
+      struct.unpack_from(cls.DIM_FMT, b, offset + i * dim_size)[0]
+      for i in range(ndim))
+    offset += ndim * dim_size
+
+    if quant == cls.QUANTIZE_FLOAT16:
+      arr = np.frombuffer(b, dtype=np.float16, offset=offset)
+      arr = arr.astype(dtype)
+    elif quant == cls.QUANTIZE_INT8:
+      lo, scale = struct.unpack_from(cls.INT8_PARAMS_FMT, b, offset)
+      offset += struct.calcsize(cls.INT8_PARAMS_FMT)
+      arr = np.frombuffer(b, dtype=np.int8, offset=offset)
+      arr = ((arr.astype(np.float64) + 128) * scale + lo).astype(dtype)
+    else:
+      arr = np.frombuffer(b, dtype=dtype, offset=offset)
+      if not arr.flags.writeable:
+        arr = arr.copy()
+    return NumpyArray(arr.reshape(shape))
 
   def __repr__(self):
     return "NumpyArray:" + self.arr.__repr__()
@@ -414,4 +548,3 @@ class NumpyArray(object):
 
   def __eq__(self, other):
     return isinstance(other, self.__class__) and other.arr == self.arr
-
@@ -114,4 +114,243 @@ class TestMSCOCOImageTable(unittest.TestCase):
       TestTable.setup(spark=spark)
 
       df = spark.read.parquet(TestTable.table_root()).show()
-      
\ No newline at end of file
+      
+
+## Annotations Index
+
+ANNOS_FIXTURE = {
+  'info': {'description': 'Test'},
+  'licenses': [{'id': 1, 'name': 'test'}],
+  'images': [
+    {'id': 30, 'width': 640, 'height': 480, 'file_name': '000000000030.jpg'},
+    {'id': 10, 'width': 64, 'height': 48, 'file_name': '000000000010.jpg'},
+    {'id': 20, 'width': 32, 'height': 16, 'file_name': '000000000020.jpg'},
+  ],
+  'annotations': [
+    {
+      'id': 1, 'image_id': 10, 'category_id': 1, 'iscrowd': 0,
+      'area': 100.5, 'bbox': [1., 2., 10., 20.],
+      'segmentation': [[1., 2., 11., 2., 11., 22., 1., 22.]],
+    },
+    {
+      'id': 2, 'image_id': 30, 'category_id': 2, 'iscrowd': 1,
+      'area': 7., 'bbox': [0., 0., 3., 4.],
+      'segmentation': {'size': [480, 640], 'counts': [0, 5, 475, 5]},
+    },
+    {
+      'id': 3, 'image_id': 10, 'category_id': 2, 'iscrowd': 0,
+      'area': 4., 'bbox': [5., 5., 2., 2.],
+      'segmentation': [[5., 5., 7., 5., 7., 7.]],
+    },
+    {
+      # Orphan
+      'id': 4, 'image_id': 99, 'category_id': 1, 'iscrowd': 0,
+      'area': 1., 'bbox': [0., 0., 1., 1.], 'segmentation': [],
+    },
+  ],
+  'categories': [
+    {'id': 1, 'name': 'person', 'supercategory': 'person'},
+    {'id': 2, 'name': 'bicycle', 'supercategory': 'vehicle'},
+  ],
+}
+
+def _create_annos_fixture(monkeypatch, name):
+  TEST_TEMPDIR = os.path.join(testconf.TEST_TEMPDIR_ROOT, name)
+  testconf.use_tempdir(monkeypatch, TEST_TEMPDIR)
+  util.cleandir(TEST_TEMPDIR)
+
+  class Fixtures(mscoco.Fixtures):
+    ROOT = TEST_TEMPDIR
+  
+  zip_path = Fixtures.zip_path(Fixtures.ANNOS_TRAIN_VAL_ZIP)
+  util.mkdir(os.path.dirname(zip_path))
+  import json
+  import zipfile
+  with zipfile.ZipFile(zip_path, mode='w') as z:
+    for fname in (Fixtures.ANNOS_TRAIN_FNAME, Fixtures.ANNOS_VAL_FNAME):
+      z.writestr('annotations/' + fname, json.dumps(ANNOS_FIXTURE, indent=2))
+
+  class Annos(mscoco.ValAnnos):
+    FIXTURES = Fixtures
+  return Annos
+
+def test_annotations_index(monkeypatch):
+  Annos = _create_annos_fixture(monkeypatch, 'test_mscoco_annos_index')
+  
+  # Exercise spooling and streaming
+  monkeypatch.setattr(mscoco.AnnotationsIndexWriter, 'SPOOL_ROWS', 2)
+  monkeypatch.setattr(Annos, 'JSON_CHUNK_SIZE', 5)
+  Annos.setup()
+
+  assert Annos.get_image_info(10) == {
+    'id': 10, 'width': 64, 'height': 48, 'file_name': '000000000010.jpg'}
+  assert Annos.get_image_info('30')['width'] == 640
+  assert Annos.get_image_info(99) is None
+  assert Annos.get_image_info(0) is None
+
+  # Annos keep their file order
+  annos = Annos.get_annos_for_image(10)
+  expected = [a for a in ANNOS_FIXTURE['annotations'] if a['image_id'] == 10]
+  assert annos == expected
+  assert Annos.get_annos_for_image(30)[0]['segmentation'] == \
+            {'size': [480, 640], 'counts': [0, 5, 475, 5]}
+  assert Annos.get_annos_for_image(20) == []
+  assert Annos.get_annos_for_image(99) == []
+
+  assert Annos.get_category_name_for_id(2) == 'bicycle'
+  assert Annos.get_category_name_for_id(3) == 'UNKNONW'
+
+  # Columns are memory-mapped
+  import numpy as np
+  index = Annos._get_index()
+  assert isinstance(index.anno_bbox, np.memmap)
+  assert list(index.image_id) == [10, 20, 30]
+  assert list(index.image_anno_offsets) == [0, 2, 2, 3]
+  
+  # A new process (e.g. a Spark worker) just opens the index
+  monkeypatch.setattr(Annos, '_index', None)
+  assert Annos.get_annos_for_image(10) == expected
+
+  # Older indices (e.g. shelve files) in the old location get ignored ...
+  index_dir = Annos._index_file('').rstrip(os.path.sep)
+  old_dir = os.path.join(os.path.dirname(index_dir), Annos.__name__)
+  util.mkdir(old_dir)
+  open(os.path.join(old_dir, 'image_id_to_annos'), 'w').close()
+  assert index_dir != old_dir
+  
+  # ... and incomplete ones get rebuilt
+  os.remove(os.path.join(
+    index_dir, mscoco.ColumnarAnnotationsIndex.FORMAT_FNAME))
+  monkeypatch.setattr(Annos, '_index', None)
+  Annos.setup()
+  assert mscoco.ColumnarAnnotationsIndex.is_complete(index_dir)
+  assert Annos.get_annos_for_image(10) == expected
+
+  # If another process finishes the index first, we use theirs
+  with mscoco.AnnotationsIndexWriter(index_dir) as writer:
+    writer.add_image(ANNOS_FIXTURE['images'][0])
+  assert not os.path.exists(writer.tmp_dir)
+  assert len(mscoco.ColumnarAnnotationsIndex(index_dir)) == 3
+
+def test_annotations_index_parallel_setup(monkeypatch):
+  Annos = _create_annos_fixture(
+    monkeypatch, 'test_mscoco_annos_index_parallel')
+  
+  class TrainAnnos(mscoco.TrainAnnos):
+    FIXTURES = Annos.FIXTURES
+  class ValAnnos(mscoco.ValAnnos):
+    FIXTURES = Annos.FIXTURES
+
+  mscoco.setup_annos_indices((TrainAnnos, ValAnnos))
+  for annos_cls in (TrainAnnos, ValAnnos):
+    assert os.path.exists(annos_cls._index_file(''))
+    assert annos_cls.get_image_info(30)['width'] == 640
+    assert len(annos_cls.get_annos_for_image(10)) == 2
+
+def test_rle():
+  import numpy as np
+  rand = np.random.RandomState(1337)
+  for shape in ((1, 1), (5, 7), (48, 64), (480, 640)):
+    for p in (0., 0.01, 0.5, 1.):
+      arr = (rand.rand(*shape) < p).astype(np.uint8)
+      rle_counts = mscoco.RLE.encode(arr)
+      assert isinstance(rle_counts, str)
+      np.testing.assert_array_equal(
+        mscoco.RLE.decode(rle_counts, *shape), arr)
+
+  # Large and repeated runs exercise the delta coding
+  counts = [0, 5, 475, 5, 100000, 1, 1, 3, 3, 2**20]
+  assert mscoco.RLE.decompress(mscoco.RLE.compress(counts)) == counts
+
+  # Column-major, starting with 0s
+  arr = mscoco.RLE.decode(mscoco.RLE.compress([1, 2, 3]), 2, 3)
+  np.testing.assert_array_equal(arr, [[0, 1, 0], [1, 0, 0]])
+
+  with pytest.raises(ValueError):
+    mscoco.RLE.decode(mscoco.RLE.compress([3, 4]), 2, 3)
+
+def test_masks(monkeypatch):
+  import numpy as np
+  Annos = _create_annos_fixture(monkeypatch, 'test_mscoco_masks')
+  Annos.setup()
+
+  masks = Annos.get_masks_for_image(10)
+  assert [m.anno_index for m in masks] == [0, 1]
+  assert [m.category_name for m in masks] == ['person', 'bicycle']
+  assert all((m.im_height, m.im_width) == (48, 64) for m in masks)
+  
+  # Polygons: a 10 x 20 box at (1, 2) and a small triangle
+  arr = masks[0].get_array()
+  assert arr.shape == (48, 64)
+  assert abs(int(arr.sum()) - 10 * 20) <= (10 + 20) * 2
+  assert arr[12, 6] == 1 and arr[30, 30] == 0
+  assert 1 <= masks[1].get_array().sum() <= 9
+
+  # Decoded arrays are cached
+  assert masks[0].get_array() is arr
+  assert not arr.flags.writeable
+
+  # Batch decode agrees with single decode
+  arrs = Annos.get_mask_arrays_for_image(10)
+  assert arrs.shape == (2, 48, 64)
+  for mask, batch_arr in zip(masks, arrs):
+    np.testing.assert_array_equal(batch_arr, mask.get_array())
+  assert Annos.get_mask_arrays_for_image(20) is None
+
+  # Uncompressed (crowd) RLE
+  crowd_arr = Annos.get_masks_for_image(30)[0].get_array()
+  assert crowd_arr.sum() == 10
+  assert crowd_arr[:5, :2].all()
+
+  # Masks pickle (e.g. into table rows) compactly
+  import pickle
+  mask = pickle.loads(pickle.dumps(masks[0]))
+  assert len(mask.rle_counts) < 50
+  np.testing.assert_array_equal(mask.get_array(), arr)
+  assert mask.png_bytes.startswith('\x89PNG')
+
+def test_plan_shards(monkeypatch):
+  Annos = _create_annos_fixture(monkeypatch, 'test_mscoco_plan_shards')
+  
+  # Images of very different sizes
+  image_sizes = {10: 1000000, 20: 10, 30: 600000, 40: 500000, 50: 400000}
+  zip_path = Annos.FIXTURES.zip_path(Annos.FIXTURES.VAL_ZIP)
+  import zipfile
+  with zipfile.ZipFile(zip_path, mode='w') as z:
+    z.writestr('val2017/', '')
+    for image_id, size in sorted(image_sizes.iteritems()):
+      z.writestr('val2017/%012d.jpg' % image_id, 'x' * size)
+
+  class Table(mscoco.MSCOCOImageTableVal):
+    FIXTURES = Annos.FIXTURES
+    ANNOS_CLS = Annos
+    APPROX_MB_PER_SHARD = 1.
+    MIN_SHARDS = 1
+    EST_BYTES_PER_ANNO = 50000
+
+  fws = [
+    fw for fw in util.ArchiveFileFlyweight.fws_from(zip_path)
+    if Table._is_image_entry(fw.name)
+  ]
+  assert len(fws) == len(image_sizes)
+
+  sizes = util.ArchiveFileFlyweight.sizes_from(zip_path)
+  assert sizes['val2017/000000000010.jpg'] == (1000000, 1000000)
+
+  # Image 10 has two annos, so its row is ~1.2MB
+  assert list(Annos.get_anno_counts([10, 20, 30, 99])) == [2, 0, 1, 0]
+  
+  shards = Table._plan_shards(fws)
+  assert len(shards) == 3
+  names = lambda shard: [fw.name for fw in shard]
+  assert sorted(sum((names(s) for s in shards), [])) == \
+            sorted(fw.name for fw in fws)
+  assert ['val2017/000000000010.jpg'] in [names(s) for s in shards]
+  
+  # Shards keep the (e.g. shuffled) input order
+  shards = Table._plan_shards(fws[::-1])
+  for shard in shards:
+    assert names(shard) == sorted(names(shard), reverse=True)
+
+  Table.MIN_SHARDS = 10
+  assert len(Table._plan_shards(fws)) == len(fws)
@@ -1,14 +1,20 @@
+import io
 import os
 import unittest
 
 import imageio
 import numpy as np
+import pytest
 
 from au import conf
 from au import util
 from au.fixtures.dataset import FillNormalized
+from au.fixtures.dataset import ImageDecoder
 from au.fixtures.dataset import ImageRow
+from au.fixtures.dataset import ImageRowPQWriter
 from au.fixtures.dataset import ImageTable
+from au.fixtures.dataset import NormalizedCache
+from au.fixtures.dataset import URIIndex
 from au.test import testconf
 from au.test import testutils
 
@@ -55,6 +61,7 @@ def test_imagerow_demo(monkeypatch):
   assert row.dataset == 'test2'
   assert len(row.image_bytes) == 250
   assert row.as_numpy().shape == (28, 28)
+  assert row.to_dict()['image_bytes'] is row.image_bytes, "No copies"
 
   ## We can dump a row to disk for quick inspection
   with monkeypatch.context() as m: 
@@ -168,9 +175,204 @@ def test_imagetable_demo(monkeypatch):
     
     assert len(list(ImageTable.iter_all_rows())) == 6
 
-###
-### TODO: spark version of above
-###
+def test_imagerow_parquet_pushdown():
+  PQ_TEMPDIR = os.path.join(
+                  testconf.TEST_TEMPDIR_ROOT,
+                  'ImageRow_pq_pushdown')
+  util.cleandir(PQ_TEMPDIR)
+
+  rows = list(ImageRow.rows_from_images_dir(
+                  conf.AU_IMAGENET_SAMPLE_IMGS_DIR,
+                  dataset='d'))
+  for i, r in enumerate(rows):
+    r.split = 'train' if i % 2 else 'test'
+  ImageRow.write_to_parquet(rows, PQ_TEMPDIR, rows_per_file=2)
+
+  ## Partition pruning: we only touch files for the requested split
+  pieces = list(ImageRow.iter_pq_pieces(PQ_TEMPDIR, splits='train'))
+  assert pieces
+  assert all(p[2] == {'dataset': 'd', 'split': 'train'} for p in pieces)
+  train_rows = list(ImageRow.iter_from_parquet(PQ_TEMPDIR, splits='train'))
+  assert sorted(r.uri for r in train_rows) == \
+            sorted(r.uri for r in rows if r.split == 'train')
+  assert all(r.split == 'train' and r.dataset == 'd' for r in train_rows)
+
+  ## Row group statistics: a URI lookup skips row groups that can't match
+  target = rows[3]
+  all_pieces = list(ImageRow.iter_pq_pieces(PQ_TEMPDIR))
+  uri_pieces = list(ImageRow.iter_pq_pieces(PQ_TEMPDIR, uris=[target.uri]))
+  assert 1 <= len(uri_pieces) < len(all_pieces)
+  matching = list(ImageRow.iter_from_parquet(PQ_TEMPDIR, uris=[target.uri]))
+  assert len(matching) == 1
+  assert matching[0].image_bytes == target.image_bytes
+
+  ## Projection: we can skip reading image bytes entirely
+  light = list(ImageRow.iter_from_parquet(
+                  PQ_TEMPDIR, uris=[target.uri], columns=['label']))
+  assert len(light) == 1
+  assert light[0].uri == target.uri
+  assert light[0].image_bytes == ''
+
+  ## Partition values get unescaped the way Spark escapes them
+  from au.fixtures.dataset import pq_partition_values
+  assert pq_partition_values(
+    '/t', '/t/dataset=a%3Ab/split=x%2Fy%3Dz/part-0.parquet') == \
+      {'dataset': 'a:b', 'split': 'x/y=z'}
+
+def test_imagerow_pq_writer():
+  PQ_TEMPDIR = os.path.join(testconf.TEST_TEMPDIR_ROOT, 'ImageRow_pq_writer')
+  util.cleandir(PQ_TEMPDIR)
+
+  def gen_rows(n):
+    for i in range(n):
+      yield ImageRow(
+              dataset='d',
+              split='s%s' % (i % 2),
+              uri='uri_%s' % i,
+              image_bytes='x' * 100,
+              label=i)
+  
+  import pyarrow.parquet as pq
+  def get_files(split):
+    d = os.path.join(PQ_TEMPDIR, 'dataset=d', 'split=%s' % split)
+    return [os.path.join(d, f) for f in os.listdir(d)]
+
+  ## Roll files by row count; rows are streamed from a generator
+  with ImageRowPQWriter(PQ_TEMPDIR, rows_per_file=3) as writer:
+    for row in gen_rows(10):
+      writer.write(row)
+  assert writer.n_rows == 10
+  paths = get_files('s0')
+  assert sorted(pq.ParquetFile(p).metadata.num_rows for p in paths) == [2, 3]
+  
+  # Labels and image bytes survive the trip
+  rows = sorted(ImageRow.iter_from_parquet(PQ_TEMPDIR))
+  assert len(rows) == 10
+  assert sorted(r.label for r in rows) == range(10)
+  assert all(r.image_bytes == 'x' * 100 for r in rows)
+  
+  ## Roll files by size
+  util.cleandir(PQ_TEMPDIR)
+  writer = ImageRowPQWriter(PQ_TEMPDIR, target_file_bytes=250)
+  writer.ROW_GROUP_BYTES = 100
+  with writer:
+    for row in gen_rows(10):
+      writer.write(row)
+  for split in ('s0', 's1'):
+    paths = get_files(split)
+    assert sorted(pq.ParquetFile(p).metadata.num_rows for p in paths) == \
+            [2, 3]
+    assert all(
+      pq.ParquetFile(p).metadata.num_row_groups ==
+        pq.ParquetFile(p).metadata.num_rows
+      for p in paths)
+
+def test_uri_index(monkeypatch):
+  PQ_TEMPDIR = os.path.join(testconf.TEST_TEMPDIR_ROOT, 'ImageRow_uri_index')
+  util.cleandir(PQ_TEMPDIR)
+
+  rows = list(ImageRow.rows_from_images_dir(
+                  conf.AU_IMAGENET_SAMPLE_IMGS_DIR,
+                  dataset='d',
+                  split='s'))
+  ImageRow.write_to_parquet(rows[:3], PQ_TEMPDIR, rows_per_file=2)
+  ImageRow.write_to_parquet(rows[3:], PQ_TEMPDIR, rows_per_file=2)
+
+  # The index is a sidecar; readers of the table itself don't see it
+  assert os.path.exists(URIIndex.index_path(PQ_TEMPDIR))
+  assert URIIndex.is_fresh(PQ_TEMPDIR)
+  import pyarrow.parquet as pq
+  assert pq.read_table(PQ_TEMPDIR).num_rows == len(rows)
+
+  # Every row is reachable through the index
+  uris = [r.uri for r in rows] + ['not_in_table']
+  found = list(URIIndex.iter_rows_by_uris(PQ_TEMPDIR, uris))
+  assert sorted(r.uri for r in found) == sorted(r.uri for r in rows)
+  uri_to_bytes = dict((r.uri, r.image_bytes) for r in rows)
+  for r in found:
+    assert r.image_bytes == uri_to_bytes[r.uri]
+    assert (r.dataset, r.split) == ('d', 's')
+
+  # Projections work too
+  found = list(URIIndex.iter_rows_by_uris(
+                  PQ_TEMPDIR, [rows[4].uri], columns=['label']))
+  assert [r.uri for r in found] == [rows[4].uri]
+  assert found[0].image_bytes == ''
+
+  # Appends index only the new files
+  indexed = []
+  orig_index_file = URIIndex._index_file
+  def spy_index_file(table_dir, path):
+    indexed.append(path)
+    return orig_index_file(table_dir, path)
+  monkeypatch.setattr(URIIndex, '_index_file', staticmethod(spy_index_file))
+  ImageRow.write_to_parquet(rows[:1], PQ_TEMPDIR)
+  assert len(indexed) == 1
+  index_path = URIIndex.index_path(PQ_TEMPDIR)
+  assert pq.read_table(index_path).num_rows == len(rows) + 1
+  assert URIIndex.is_fresh(PQ_TEMPDIR)
+
+  # Removed files drop out of the index
+  os.remove(indexed[0])
+  URIIndex.update(PQ_TEMPDIR)
+  found = list(URIIndex.iter_rows_by_uris(PQ_TEMPDIR, uris))
+  assert sorted(r.uri for r in found) == sorted(r.uri for r in rows)
+
+@pytest.mark.slow
+def test_imagerow_arrow_spark_roundtrip(monkeypatch):
+  TEST_TEMPDIR = os.path.join(
+    testconf.TEST_TEMPDIR_ROOT, 'test_imagerow_arrow_spark_roundtrip')
+  testconf.use_tempdir(monkeypatch, TEST_TEMPDIR)
+
+  rows = list(ImageRow.rows_from_images_dir(
+                  conf.AU_IMAGENET_SAMPLE_IMGS_DIR,
+                  dataset='d',
+                  split='s'))
+  for i, row in enumerate(rows):
+    row.label = 'label_%s' % i
+  
+  class Table(ImageTable):
+    TABLE_NAME = 'test_imagerow_arrow_spark_roundtrip'
+
+  # Make sure we use the Arrow paths and don't fall back to pyspark Rows
+  from au.spark import Spark
+  calls = []
+  def spy(name):
+    orig = getattr(Spark, name)
+    def f(*args, **kwargs):
+      calls.append(name)
+      return orig(*args, **kwargs)
+    monkeypatch.setattr(Spark, name, staticmethod(f))
+  spy('df_from_arrow_batch_rdd')
+  spy('df_to_arrow_batch_rdd')
+
+  with testutils.LocalSpark.sess() as spark:
+    spark.conf.set('spark.sql.execution.arrow.enabled', 'true')
+    try:
+      rdd = spark.sparkContext.parallelize(rows, numSlices=3)
+      ImageRow.write_to_parquet(
+        rdd, Table.table_root(), spark=spark,
+        arrow_schema=ImageRow.arrow_schema())
+      assert calls == ['df_from_arrow_batch_rdd']
+      
+      actual = Table.as_imagerow_rdd(spark).collect()
+      assert calls == ['df_from_arrow_batch_rdd', 'df_to_arrow_batch_rdd']
+    finally:
+      spark.conf.set('spark.sql.execution.arrow.enabled', 'false')
+
+  assert len(actual) == len(rows)
+  uri_to_row = dict((r.uri, r) for r in rows)
+  for row in actual:
+    expected = uri_to_row[row.uri]
+    assert row.image_bytes == expected.image_bytes
+    assert row.label == expected.label
+    assert (row.dataset, row.split) == ('d', 's')
+  
+  # The URI index covers what Spark wrote
+  assert URIIndex.is_fresh(Table.table_root())
+  found = list(URIIndex.iter_rows_by_uris(Table.table_root(), [rows[0].uri]))
+  assert [r.image_bytes for r in found] == [rows[0].image_bytes]
+
 
 class TestFillNormalized(unittest.TestCase):
   def test_identity(self):
@@ -221,6 +423,180 @@ class TestFillNormalized(unittest.TestCase):
     row = f(row)
     assert row.attrs['normalized'].shape == (10, 10, 3)
 
+  def test_fill_batch(self):
+    def get_rows():
+      rows = list(ImageRow.rows_from_images_dir(
+                    conf.AU_IMAGENET_SAMPLE_IMGS_DIR))
+      rows.append(ImageRow.from_path(testconf.MNIST_TEST_IMG_PATH))
+      return rows
+
+    # Batches match the per-row op exactly
+    for nchan in (1, 3):
+      f = FillNormalized(target_hw=(50, 70), target_nchan=nchan)
+      expected = [f(row).attrs['normalized'] for row in get_rows()]
+
+      rows = get_rows()
+      out = np.zeros((10, 50, 70, nchan), dtype=np.uint8)
+      batch = f.fill_batch(rows, out=out)
+      assert batch.shape == (len(rows), 50, 70, nchan)
+      assert batch.base is out
+      for i, (row, exp) in enumerate(zip(rows, expected)):
+        exp = exp.reshape((50, 70, nchan))
+        np.testing.assert_array_equal(batch[i], exp)
+        assert row.attrs['normalized'].base is out
+
+    # We can allocate the batch for the caller, too
+    f = FillNormalized(norm_func=lambda x: x - 10)
+    rows = [ImageRow.from_path(testconf.MNIST_TEST_IMG_PATH)] * 3
+    batch = f.fill_batch(rows, decoder=f.make_decoder())
+    assert batch.shape == (3, 28, 28, 1)
+    expected = imageio.imread(testconf.MNIST_TEST_IMG_PATH) - 10
+    np.testing.assert_array_equal(batch[2, ..., 0], expected)
+
+def test_normalized_cache(monkeypatch):
+  TEST_TEMPDIR = os.path.join(testconf.TEST_TEMPDIR_ROOT, 'normalized_cache')
+  testconf.use_tempdir(monkeypatch, TEST_TEMPDIR)
+
+  def get_rows():
+    return list(ImageRow.rows_from_images_dir(
+                  conf.AU_IMAGENET_SAMPLE_IMGS_DIR, dataset='d'))
+
+  f = FillNormalized(target_hw=(20, 30), target_nchan=3, cache_max_bytes=1e9)
+  expected = f.fill_batch(get_rows()).copy()
+  cache = f.get_cache()
+  assert cache.cache_dir.startswith(conf.AU_NORMALIZED_CACHE)
+  assert all(cache.get(row) is not None for row in get_rows())
+
+  # Now hits skip decoding entirely
+  rows = get_rows()
+  for row in rows:
+    row._cached_image_fobj = ''
+  np.testing.assert_array_equal(f.fill_batch(rows), expected)
+  for i, row in enumerate(get_rows()):
+    np.testing.assert_array_equal(f(row).attrs['normalized'], expected[i])
+
+  # Other shapes, decoders and datasets get their own entries
+  f2 = FillNormalized(target_hw=(20, 30), target_nchan=1, cache_max_bytes=1e9)
+  assert all(f2.get_cache().get(row) is None for row in get_rows())
+  assert f.get_cache(variant='cv2').get(rows[0]) is None
+  assert cache.get(ImageRow(dataset='other', uri=rows[0].uri)) is None
+
+  # Replacing an entry doesn't count its bytes twice
+  entry_bytes = os.path.getsize(cache._path('d', rows[0].uri))
+  n_bytes = cache._n_bytes
+  cache.put(rows[0], expected[0])
+  assert cache._n_bytes == n_bytes
+
+  # Caches in other processes (here, another instance) see our writes
+  other = NormalizedCache((20, 30, 3), variant='other')
+  other.put(rows[0], expected[0])
+  assert other._n_bytes == n_bytes + entry_bytes
+  cache.put(rows[1], expected[1])
+  assert cache._n_bytes == n_bytes + entry_bytes
+
+  # Eviction is LRU
+  small = FillNormalized(
+            target_hw=(20, 30), target_nchan=3,
+            cache_max_bytes=3.5 * entry_bytes)
+  util.rm_rf(conf.AU_NORMALIZED_CACHE)
+  rows = get_rows()
+  for i, row in enumerate(rows):
+    small(row)
+    if i >= 1:
+      # Keep rows[0] hot
+      os.utime(small.get_cache()._path('d', rows[0].uri), (1e10, 1e10))
+  assert small.get_cache().get(rows[0]) is not None
+  n_cached = sum(small.get_cache().get(r) is not None for r in rows)
+  assert 1 <= n_cached <= 3
+
+class TestImageDecoder(unittest.TestCase):
+  def _rows(self):
+    return list(ImageRow.rows_from_images_dir(
+                  conf.AU_IMAGENET_SAMPLE_IMGS_DIR))
+
+  def test_matches_imageio(self):
+    rows = self._rows()
+    expected = [imageio.imread(io.BytesIO(r.image_bytes)) for r in rows]
+
+    imgs = ImageDecoder(backend='imageio').decode_rows(rows)
+    for img, exp in zip(imgs, expected):
+      np.testing.assert_array_equal(img, exp)
+
+    # cv2 may differ by at most 1 (IDCT rounding) but has the same layout
+    imgs = ImageDecoder(backend='cv2').decode_rows(self._rows())
+    for img, exp in zip(imgs, expected):
+      assert img.shape == exp.shape
+      assert img.dtype == exp.dtype
+      assert np.abs(img.astype(int) - exp.astype(int)).max() <= 1
+
+    # PNG decodes are exact
+    row = ImageRow.from_path(testconf.MNIST_TEST_IMG_PATH)
+    img, = ImageDecoder().decode_rows([row])
+    np.testing.assert_array_equal(
+      img, imageio.imread(testconf.MNIST_TEST_IMG_PATH))
+
+  def test_reduced_decode(self):
+    f = FillNormalized(target_hw=(90, 120))
+    decoder = f.make_decoder()
+    rows = self._rows()
+    imgs = decoder.decode_rows(rows)
+    for row, img in zip(rows, imgs):
+      assert img.shape[0] >= 90 and img.shape[1] >= 120
+      h, w = imageio.imread(io.BytesIO(row.image_bytes)).shape[:2]
+      assert img.shape[0] < h and img.shape[1] < w
+      # Reduced decodes must not poison the full-res cache
+      assert row._cached_image_arr is ''
+
+    f = FillNormalized(target_hw=(90, 120), target_nchan=1)
+    imgs = f.make_decoder().decode_rows(self._rows())
+    assert all(img.ndim == 2 for img in imgs)
+
+    # Non-JPEGs fall back to a full decode
+    row = ImageRow.from_path(testconf.MNIST_TEST_IMG_PATH)
+    img, = FillNormalized(target_hw=(7, 7)).make_decoder().decode_rows([row])
+    assert img.shape == (28, 28)
+
+    # Greyscale JPEGs stay greyscale unless the caller wants channels
+    from PIL import Image
+    buf = io.BytesIO()
+    grey = np.random.RandomState(0).randint(0, 255, size=(240, 320))
+    Image.fromarray(grey.astype(np.uint8), mode='L').save(buf, format='JPEG')
+    row = ImageRow(image_bytes=buf.getvalue())
+    img, = ImageDecoder(target_hw=(60, 80), reduced_decode=True).decode_rows(
+                                                                    [row])
+    assert img.shape == (60, 80)
+    img, = ImageDecoder(
+      target_hw=(60, 80), target_nchan=3, reduced_decode=True).decode_rows(
+                                                                    [row])
+    assert img.shape == (60, 80, 3)
+
+  def test_pool_resize(self):
+    import threading
+    rows = self._rows()
+    ImageDecoder(n_threads=2).decode_rows(rows)
+    n_threads = threading.active_count()
+    
+    # A bigger pool replaces the old one, whose threads exit
+    old_pool = ImageDecoder._pool
+    imgs = ImageDecoder(n_threads=old_pool._processes + 2).decode_rows(rows)
+    assert len(imgs) == len(rows)
+    assert ImageDecoder._pool is not old_pool
+    assert not any(t.is_alive() for t in old_pool._pool)
+    assert threading.active_count() <= n_threads + 2
+
+  def test_decode_into(self):
+    rows = [ImageRow.from_path(testconf.MNIST_TEST_IMG_PATH)
+            for _ in range(5)]
+    out = np.zeros((8, 28, 28), dtype=np.uint8)
+    res = ImageDecoder().decode_into(rows, out=out)
+    assert res is out
+    expected = imageio.imread(testconf.MNIST_TEST_IMG_PATH)
+    for i in range(5):
+      np.testing.assert_array_equal(out[i], expected)
+
+    with self.assertRaises(ValueError):
+      ImageDecoder().decode_into(self._rows())
+
 def test_create_video():
   v = testutils.VideoFixture()
   
@@ -122,7 +122,113 @@ def test_activations_sobel(monkeypatch):
 
   filled = list(fixture.filler(fixture.rows))
   _check_rows(fixture, filled)
+
+def test_inference_session_cache(monkeypatch):
+  fixture = _create_fixture(monkeypatch)
+  nnmodel.TFInferenceSessionCache.clear()
+
+  n_created = [0]
+  orig_create = Sobel.GraphFactory.create_inference_graph
+  def counting_create(self, input_image, base_graph):
+    n_created[0] += 1
+    return orig_create(self, input_image, base_graph)
+  monkeypatch.setattr(
+    Sobel.GraphFactory, 'create_inference_graph', counting_create)
+
+  # Later "partitions" reuse the graph and session of the first
+  for _ in range(3):
+    filler = nnmodel.FillActivationsTFDataset(model=fixture.model)
+    filled = list(filler(dataset.ImageTable.iter_all_rows()))
+    _check_rows(fixture, filled)
+  assert n_created[0] == 1
+
+  # Different inputs get their own graph
+  params = Sobel.Params()
+  params.INPUT_TENSOR_SHAPE = [None, 100, 150, 3]
+  filler = nnmodel.FillActivationsTFDataset(model=Sobel(params=params))
+  filled = list(filler(fixture.rows[:2]))
+  assert n_created[0] == 2
+  nnmodel.TFInferenceSessionCache.clear()
+
+def test_inference_graph_def(monkeypatch):
+  fixture = _create_fixture(monkeypatch)
+  nnmodel.TFInferenceSessionCache.clear()
+
+  # E.g. on the Spark driver
+  igraph = fixture.model.get_inference_graph()
+  gdef_bytes = nnmodel.TFInferenceSessionCache.get_graph_def_bytes(igraph)
+  assert gdef_bytes
+
+  # E.g. on an executor: we never build the graph
+  nnmodel.TFInferenceSessionCache.clear()
+  def fail_create(self, input_image, base_graph):
+    assert False, "Should have used the shipped graph"
+  monkeypatch.setattr(
+    Sobel.GraphFactory, 'create_inference_graph', fail_create)
+  filler = nnmodel.FillActivationsTFDataset(
+                      model=fixture.model, graph_def=gdef_bytes)
+  _check_rows(fixture, list(filler(fixture.rows)))
+  nnmodel.TFInferenceSessionCache.clear()
+
+def test_output_reductions(monkeypatch):
+  fixture = _create_fixture(monkeypatch)
+  nnmodel.TFInferenceSessionCache.clear()
+
+  import numpy as np
+
+  filled = list(fixture.filler(fixture.rows))
+  uri_to_full = dict(
+    (r.uri, r.attrs['activations'][0].tensor_to_value['sobel:0'])
+    for r in filled)
+
+  def fill_reduced(reduction, graph_def=None):
+    params = Sobel.Params()
+    params.OUTPUT_REDUCTIONS = {'sobel:0': reduction}
+    model = Sobel(params=params)
+    igraph = model.get_inference_graph()
+    assert igraph.activation_names == ('sobel:0/' + reduction,)
+    filler = nnmodel.FillActivationsTFDataset(
+                                  model=model, graph_def=graph_def)
+    filled = list(filler(dataset.ImageTable.iter_all_rows()))
+    assert len(filled) == len(fixture.rows)
+    return dict(
+      (r.uri, r.attrs['activations'][0].tensor_to_value[
+                                                'sobel:0/' + reduction])
+      for r in filled)
+
+  for uri, value in fill_reduced('avg_pool').iteritems():
+    assert value.shape == (2,)
+    np.testing.assert_allclose(
+      value, uri_to_full[uri].mean(axis=(0, 1, 2)), rtol=1e-3)
   
+  for uri, value in fill_reduced('max_pool').iteritems():
+    np.testing.assert_allclose(value, uri_to_full[uri].max(axis=(0, 1, 2)))
+  
+  for uri, value in fill_reduced('top_k:1').iteritems():
+    assert value.dtype == np.int32
+    expected = np.argmax(uri_to_full[uri].mean(axis=(0, 1, 2)))
+    assert value.tolist() == [expected]
+  
+  projected = fill_reduced('random_projection:8')
+  for value in projected.values():
+    assert value.shape == (8,)
+  
+  # Projections are the same in every process, e.g. after shipping graphs
+  params = Sobel.Params()
+  params.OUTPUT_REDUCTIONS = {'sobel:0': 'random_projection:8'}
+  gdef_bytes = nnmodel.TFInferenceSessionCache.get_graph_def_bytes(
+                                Sobel(params=params).get_inference_graph())
+  nnmodel.TFInferenceSessionCache.clear()
+  reprojected = fill_reduced('random_projection:8', graph_def=gdef_bytes)
+  for uri, value in reprojected.iteritems():
+    np.testing.assert_array_equal(value, projected[uri])
+
+  with pytest.raises(ValueError):
+    nnmodel.OutputReductions.parse('median')
+  with pytest.raises(ValueError):
+    nnmodel.OutputReductions.parse('top_k')
+  nnmodel.TFInferenceSessionCache.clear()
+
 @pytest.mark.slow
 def test_activations_sobel_spark(monkeypatch):
   fixture = _create_fixture(monkeypatch)
@@ -151,3 +257,334 @@ def test_fill_activations_table(monkeypatch):
     df.createOrReplaceTempView("sobel_activations")
     spark.sql("SELECT * FROM sobel_activations").show()
 
+
+def test_activations_arrow_layout(monkeypatch):
+  fixture = _create_fixture(monkeypatch)
+  filled = list(fixture.filler(fixture.rows))
+
+  import numpy as np
+  import pyarrow as pa
+  import pyarrow.parquet as pq
+
+  records = list(nnmodel.ActivationsTable.iter_activation_records(filled))
+  assert len(records) == len(filled)
+  batch = nnmodel.ActivationsTable.to_arrow_batch(records)
+  assert batch.schema.equals(nnmodel.ActivationsTable.arrow_schema())
+  
+  TABLE_DIR = os.path.join(
+                  testconf.TEST_TEMPDIR_ROOT, 'sobel_arrow_layout')
+  from au import util
+  util.cleandir(TABLE_DIR)
+  pq.write_table(
+    pa.Table.from_batches([batch]),
+    os.path.join(TABLE_DIR, 'part-0.parquet'))
+
+  tensor_name = fixture.model.get_inference_graph().output_names[0]
+  uris, values = nnmodel.ActivationsTable.read_tensors(
+                                  tensor_name, table_root=TABLE_DIR)
+  assert sorted(uris) == sorted(r.uri for r in filled)
+  assert values.shape == (len(filled), 200, 300, 3, 2)
+  assert values.dtype == np.float32
+  uri_to_row = dict((r.uri, r) for r in filled)
+  for uri, value in zip(uris, values):
+    expected = uri_to_row[uri].attrs['activations'][0].tensor_to_value
+    np.testing.assert_array_equal(value, expected[tensor_name])
+  
+  uris, values = nnmodel.ActivationsTable.read_tensors(
+                                  'not_a_tensor', table_root=TABLE_DIR)
+  assert uris == [] and values.size == 0
+
+  # Incremental builds skip images that already have activations
+  model_name = fixture.model.get_inference_graph().model_name
+  assert nnmodel.ActivationsTable.existing_uris(
+            model_name, table_root=TABLE_DIR) == set(r.uri for r in filled)
+  assert nnmodel.ActivationsTable.existing_uris(
+            'other_model', table_root=TABLE_DIR) == set()
+  assert nnmodel.ActivationsTable.existing_uris(
+            model_name, table_root=TABLE_DIR + '_missing') == set()
+
+  # Images missing some of their tensors (e.g. from a partial round) need
+  # to be recomputed
+  assert nnmodel.ActivationsTable.existing_uris(
+            model_name,
+            table_root=TABLE_DIR,
+            tensor_names=[tensor_name]) == set(r.uri for r in filled)
+  assert nnmodel.ActivationsTable.existing_uris(
+            model_name,
+            table_root=TABLE_DIR,
+            tensor_names=[tensor_name, 'partial:0']) == set()
+  partial = [
+    (row, name, 'partial:0', value)
+    for row, name, _, value in records[:1]
+  ]
+  pq.write_table(
+    pa.Table.from_batches([
+      nnmodel.ActivationsTable.to_arrow_batch(partial)]),
+    os.path.join(TABLE_DIR, 'part-1.parquet'))
+  assert nnmodel.ActivationsTable.existing_uris(
+            model_name,
+            table_root=TABLE_DIR,
+            tensor_names=[tensor_name, 'partial:0']) == set([records[0][0].uri])
+
+  # Tables that `setup()` writes have `model_name` as a partition column
+  util.cleandir(TABLE_DIR)
+  part_dir = os.path.join(TABLE_DIR, 'model_name=' + model_name)
+  util.mkdir(part_dir)
+  table = pa.Table.from_batches([batch])
+  assert table.schema.names[0] == 'model_name'
+  partitioned = table.remove_column(0)
+  pq.write_table(partitioned, os.path.join(part_dir, 'part-0.parquet'))
+  uris, values = nnmodel.ActivationsTable.read_tensors(
+                    tensor_name, table_root=TABLE_DIR, model_name=model_name)
+  assert sorted(uris) == sorted(r.uri for r in filled)
+  assert values.shape == (len(filled), 200, 300, 3, 2)
+  uris, values = nnmodel.ActivationsTable.read_tensors(
+                    tensor_name, table_root=TABLE_DIR, model_name='other')
+  assert uris == []
+
+  # Builds commit each round by moving its files out of a staging dir
+  stage_dir = os.path.join(TABLE_DIR, nnmodel.ActivationsTable.STAGING_DIRNAME)
+  stage_part_dir = os.path.join(stage_dir, 'model_name=other', 'split=x')
+  util.mkdir(stage_part_dir)
+  pq.write_table(
+    partitioned, os.path.join(stage_part_dir, 'part-1.parquet'))
+  open(os.path.join(stage_dir, '_SUCCESS'), 'w').close()
+  assert nnmodel.ActivationsTable.existing_uris(
+            'other', table_root=TABLE_DIR) == set()
+  nnmodel.ActivationsTable._commit_round(stage_dir, TABLE_DIR)
+  assert not os.path.exists(stage_dir)
+  assert os.path.exists(os.path.join(
+    TABLE_DIR, 'model_name=other', 'split=x', 'part-1.parquet'))
+  assert nnmodel.ActivationsTable.existing_uris(
+            'other', table_root=TABLE_DIR) == set(r.uri for r in filled)
+  assert nnmodel.ActivationsTable.existing_uris(
+            model_name, table_root=TABLE_DIR) == set(r.uri for r in filled)
+
+  # Entries for a tensor need not be adjacent
+  arr = pa.ListArray.from_arrays(
+          pa.array(np.array([0, 2, 5, 7], dtype=np.int32)),
+          pa.array(np.arange(7, dtype=np.float32)))
+  np.testing.assert_array_equal(
+    nnmodel.ActivationsTable.tensor_column_to_numpy(arr, [2], idx=[0, 2]),
+    [[0, 1], [5, 6]])
+  np.testing.assert_array_equal(
+    nnmodel.ActivationsTable.tensor_column_to_numpy(
+      arr.slice(1, 1), [3]),
+    [[2, 3, 4]])
+
+  # Batches are bounded in values, too, so list offsets can't overflow
+  class SmallBatchTable(nnmodel.ActivationsTable):
+    ARROW_BATCH_ROWS = 3
+    ARROW_BATCH_MAX_VALUES = 10
+  chunks = list(SmallBatchTable._iter_arrow_chunks(
+                  [4, 4, 1, 1, 1, 20, 1], lambda x: x))
+  assert chunks == [[4, 4, 1], [1, 1], [20], [1]]
+
+  # The arrow layout can't hold quantized values
+  from au.spark import NumpyArray
+  row, model_name, tensor_name, value = records[0]
+  quantized = (row, model_name, tensor_name, NumpyArray(value.arr, 'int8'))
+  with pytest.raises(ValueError):
+    nnmodel.ActivationsTable.to_arrow_batch([quantized])
+
+def test_activations_wide_layout(monkeypatch):
+  fixture = _create_fixture(monkeypatch)
+  filled = list(fixture.filler(fixture.rows))
+
+  import numpy as np
+  import pyarrow as pa
+  import pyarrow.parquet as pq
+
+  class WideTable(nnmodel.ActivationsTable):
+    TENSOR_LAYOUT = 'wide'
+
+  igraph = fixture.model.get_inference_graph()
+  tensor_names = igraph.output_names
+  batch = WideTable.to_wide_arrow_batch(
+                      filled, igraph.model_name, tensor_names)
+  
+  # One row per image, one column (plus shape) per tensor
+  assert batch.num_rows == len(filled)
+  col = WideTable.tensor_column('sobel:0')
+  assert col == 't_sobel_0'
+  assert batch.schema.names == [
+    'model_name', 'dataset', 'split', 'uri', col, col + '_shape']
+  assert batch.schema.equals(WideTable.wide_arrow_schema(tensor_names))
+
+  # Other models' rows get skipped
+  assert WideTable.to_wide_arrow_batch(
+            filled, 'other_model', tensor_names).num_rows == 0
+
+  TABLE_DIR = os.path.join(testconf.TEST_TEMPDIR_ROOT, 'sobel_wide_layout')
+  from au import util
+  util.cleandir(TABLE_DIR)
+  part_dir = os.path.join(TABLE_DIR, 'model_name=' + igraph.model_name)
+  util.mkdir(part_dir)
+  pq.write_table(
+    pa.Table.from_batches([batch]), os.path.join(part_dir, 'part-0.parquet'))
+
+  uris, values = WideTable.read_tensors(
+                    'sobel:0', table_root=TABLE_DIR,
+                    model_name=igraph.model_name)
+  assert uris == [r.uri for r in filled]
+  assert values.shape == (len(filled), 200, 300, 3, 2)
+  for row, value in zip(filled, values):
+    expected = row.attrs['activations'][0].tensor_to_value['sobel:0']
+    np.testing.assert_array_equal(value, expected)
+
+  uris, values = WideTable.read_tensors(
+                    'sobel:0', table_root=TABLE_DIR, model_name='other')
+  assert uris == []
+
+  assert WideTable.existing_uris(
+            igraph.model_name, table_root=TABLE_DIR) == \
+              set(r.uri for r in filled)
+  assert WideTable.existing_uris('other', table_root=TABLE_DIR) == set()
+  assert WideTable.existing_uris(
+            igraph.model_name,
+            table_root=TABLE_DIR,
+            tensor_names=['sobel:0']) == set(r.uri for r in filled)
+  assert WideTable.existing_uris(
+            igraph.model_name,
+            table_root=TABLE_DIR,
+            tensor_names=['sobel:0', 'partial:0']) == set()
+
+def test_activations_tensor_blocks(monkeypatch):
+  fixture = _create_fixture(monkeypatch)
+  filled = list(fixture.filler(fixture.rows))
+
+  import numpy as np
+  import pyarrow as pa
+  import pyarrow.parquet as pq
+  from au import util
+
+  records = list(nnmodel.ActivationsTable.iter_activation_records(filled))
+  batch = nnmodel.ActivationsTable.to_arrow_batch(records)
+
+  class ArrowTable(nnmodel.ActivationsTable):
+    TENSOR_LAYOUT = 'arrow'
+
+  TABLE_DIR = os.path.join(testconf.TEST_TEMPDIR_ROOT, 'sobel_tensor_blocks')
+  util.cleandir(TABLE_DIR)
+  
+  # Two shards
+  half = batch.num_rows // 2
+  for i, (start, n) in enumerate(((0, half), (half, batch.num_rows - half))):
+    part_dir = os.path.join(TABLE_DIR, 'split=%s' % i)
+    util.mkdir(part_dir)
+    pq.write_table(
+      pa.Table.from_batches([batch.slice(start, n)]),
+      os.path.join(part_dir, 'part-0.parquet'))
+  
+  igraph = fixture.model.get_inference_graph()
+  uri_to_row = dict((r.uri, r) for r in filled)
+  CACHE_DIR = os.path.join(TABLE_DIR, '_cache')
+  for n_procs in (0, 2, 2):
+    blocks = list(ArrowTable.iter_tensor_blocks(
+                        'sobel:0',
+                        model_name=igraph.model_name,
+                        table_root=TABLE_DIR,
+                        n_procs=n_procs,
+                        cache_dir=CACHE_DIR))
+    assert len(blocks) == 2
+    assert [b.partition for b in blocks] == [{'split': '0'}, {'split': '1'}]
+    if n_procs:
+      assert all(isinstance(b.values, np.memmap) for b in blocks)
+    
+    uris = [uri for b in blocks for uri in b.uris]
+    assert sorted(uris) == sorted(uri_to_row.keys())
+    for b in blocks:
+      assert b.values.shape == (len(b), 200, 300, 3, 2)
+      for uri, value in zip(b.uris, b.values):
+        expected = uri_to_row[uri].attrs['activations'][0].tensor_to_value
+        np.testing.assert_array_equal(value, expected['sobel:0'])
+  
+  # The second pooled scan reused the decoded blocks
+  assert len(os.listdir(CACHE_DIR)) == 4
+
+  # The cache evicts the least recently used blocks
+  old_values_path = blocks[0].values.filename
+  os.utime(old_values_path, (0, 0))
+  os.utime(old_values_path.replace('.values.', '.uris.'), (0, 0))
+  n_bytes = sum(
+    os.path.getsize(os.path.join(CACHE_DIR, fname))
+    for fname in os.listdir(CACHE_DIR))
+  nnmodel._evict_tensor_blocks(CACHE_DIR, n_bytes - 1)
+  assert sorted(os.listdir(CACHE_DIR)) == sorted(
+    os.path.basename(path) for path in (
+      blocks[1].values.filename,
+      blocks[1].values.filename.replace('.values.', '.uris.')))
+
+  class SmallCacheTable(ArrowTable):
+    TENSOR_BLOCK_CACHE_MAX_BYTES = 1
+  blocks = list(SmallCacheTable.iter_tensor_blocks(
+                      'sobel:0',
+                      model_name=igraph.model_name,
+                      table_root=TABLE_DIR,
+                      n_procs=2,
+                      cache_dir=CACHE_DIR))
+  assert os.listdir(CACHE_DIR) == []
+  
+  # ... but blocks already mapped stay readable
+  assert sum(len(b) for b in blocks) == len(filled)
+  assert all(np.isfinite(b.values).all() for b in blocks)
+
+  assert list(ArrowTable.iter_tensor_blocks(
+    'sobel:0', model_name='other', table_root=TABLE_DIR, n_procs=0)) == []
+
+@pytest.mark.slow
+def test_fill_activations_table_arrow(monkeypatch):
+  fixture = _create_fixture(monkeypatch)
+
+  class TestActivationsTable(nnmodel.ActivationsTable):
+    TABLE_NAME = 'sobel_fill_activations_arrow_test'
+    NNMODEL_CLS = Sobel
+    IMAGE_TABLE_CLS = dataset.ImageTable
+    TENSOR_LAYOUT = 'arrow'
+
+  with testutils.LocalSpark.sess() as spark:
+    TestActivationsTable.setup(spark=spark)
+
+    df = spark.read.parquet(TestActivationsTable.table_root())
+    df.createOrReplaceTempView("sobel_activations")
+    spark.sql(
+      "SELECT uri, size(tensor_value) FROM sobel_activations").show()
+    
+  uris, values = TestActivationsTable.read_tensors('sobel:0')
+  assert len(uris) == len(fixture.rows)
+
+  # Re-running the build is a no-op; a full rebuild replaces the table
+  with testutils.LocalSpark.sess() as spark:
+    TestActivationsTable.setup(spark=spark)
+    uris, values = TestActivationsTable.read_tensors('sobel:0')
+    assert len(uris) == len(fixture.rows)
+
+    # NB: a full rebuild only replaces the model's own partition
+    from au import util
+    other_path = os.path.join(
+      TestActivationsTable.table_root(), 'model_name=other', 'marker')
+    util.mkdir(os.path.dirname(other_path))
+    open(other_path, 'w').close()
+
+    TestActivationsTable.setup(spark=spark, incremental=False)
+    uris, values = TestActivationsTable.read_tensors('sobel:0')
+    assert len(uris) == len(fixture.rows)
+    assert os.path.exists(other_path)
+    assert not os.path.exists(os.path.join(
+      TestActivationsTable.table_root(),
+      TestActivationsTable.STAGING_DIRNAME))
+
+  class TestWideActivationsTable(TestActivationsTable):
+    TABLE_NAME = 'sobel_fill_activations_wide_test'
+    TENSOR_LAYOUT = 'wide'
+    BUILD_ROUND_FILES = 1
+
+  with testutils.LocalSpark.sess() as spark:
+    TestWideActivationsTable.setup(spark=spark)
+    df = spark.read.parquet(TestWideActivationsTable.table_root())
+    assert df.count() == len(fixture.rows)
+    assert 'model_name' in df.columns
+  
+  uris, values = TestWideActivationsTable.read_tensors(
+                                            'sobel:0', model_name='Sobel')
+  assert len(uris) == len(fixture.rows)
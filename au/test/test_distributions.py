@@ -0,0 +1,295 @@
+from au import distributions
+from au.test import testutils
+
+import numpy as np
+import pytest
+
+def _shards(seed=1337):
+  rand = np.random.RandomState(seed)
+  acts = np.concatenate([
+    rand.normal(size=(5000, 3, 2)),
+    rand.exponential(size=(5000, 3, 2)),
+  ])
+  rand.shuffle(acts)
+  return acts, np.array_split(acts, 7)
+
+def test_running_moments():
+  acts, shards = _shards()
+  flat = acts.reshape((len(acts), -1))
+
+  merged = distributions.RunningMoments()
+  for shard in shards:
+    m = distributions.RunningMoments()
+    m.update(shard)
+    merged += m
+  
+  assert merged.n == len(acts)
+  np.testing.assert_allclose(merged.mean, flat.mean(axis=0))
+  np.testing.assert_allclose(merged.variance, flat.var(axis=0))
+  np.testing.assert_array_equal(merged.min, flat.min(axis=0))
+  np.testing.assert_array_equal(merged.max, flat.max(axis=0))
+
+def test_quantile_sketch():
+  acts, shards = _shards()
+  flat = acts.reshape((len(acts), -1))
+
+  merged = distributions.QuantileSketch(k=128, seed=1)
+  for i, shard in enumerate(shards):
+    s = distributions.QuantileSketch(k=128, seed=i)
+    for block in np.array_split(shard, 5):
+      s.update(block)
+    merged += s
+  assert merged.n == len(acts)
+
+  # Memory stays sub-linear
+  assert sum(len(l) for l in merged.levels) < 0.2 * len(acts)
+
+  # Ranks of the estimates should be close to the targets
+  qs = [0.01, 0.1, 0.5, 0.9, 0.99]
+  est = merged.quantiles(qs)
+  assert est.shape == (len(qs), flat.shape[1])
+  for q, row in zip(qs, est):
+    ranks = (flat <= row).mean(axis=0)
+    assert np.all(np.abs(ranks - q) < 0.03), (q, ranks)
+
+def test_histogram():
+  acts, shards = _shards()
+  flat = acts.reshape((len(acts), -1))
+  
+  merged = distributions.Histogram()
+  for shard in shards:
+    h = distributions.Histogram()
+    h.update(shard)
+    merged += h
+  
+  assert merged.counts.shape == (flat.shape[1], merged.n_bins)
+  for d in range(flat.shape[1]):
+    expected = np.bincount(
+      np.searchsorted(merged.edges, flat[:, d], side='right'),
+      minlength=merged.n_bins)
+    np.testing.assert_array_equal(merged.counts[d], expected)
+
+  # Before any updates, bins are uniform (as with zero counts)
+  empty = distributions.Histogram()
+  np.testing.assert_allclose(
+    empty.bin_log_probs(flat[:3]), -np.log(empty.n_bins))
+  zeros = distributions.Histogram()
+  zeros.counts = np.zeros_like(merged.counts)
+  np.testing.assert_allclose(
+    empty.bin_log_probs(flat[:3]), zeros.bin_log_probs(flat[:3]))
+
+def test_activation_stats_observer():
+  from au.fixtures import dataset
+  from au.fixtures import nnmodel
+
+  acts, _ = _shards()
+  def iter_rows(acts):
+    for i, act in enumerate(acts):
+      row = dataset.ImageRow(uri='img_%s' % i)
+      row.attrs = {'activations': [
+        nnmodel.Activations(
+          model_name='m',
+          tensor_to_value={'t:0': act, 't:1': act[0]}),
+      ]}
+      yield row
+
+  # E.g. two Spark partitions
+  o1 = distributions.ActivationStatsObserver(seed=1)
+  o2 = distributions.ActivationStatsObserver(seed=2)
+  assert len(list(o1.observe_rows(iter_rows(acts[:3000])))) == 3000
+  assert len(list(o2.observe_rows(iter_rows(acts[3000:])))) == 7000
+  o1 += o2
+
+  stats = o1.get_stats('m', 't:0')
+  assert stats.n == len(acts)
+  assert stats.shape == (3, 2)
+  np.testing.assert_allclose(stats.moments.mean, acts.mean(axis=0).ravel())
+  assert o1.get_stats('m', 't:1').shape == (2,)
+  assert o1.get_stats('m', 'nope') is None
+
+  medians = stats.quantiles([0.5])
+  assert medians.shape == (1, 3, 2)
+  np.testing.assert_allclose(
+    medians[0], np.median(acts, axis=0), atol=0.1)
+
+  # Typical activations are more likely than outliers
+  assert stats.compute_prob_of(np.median(acts, axis=0)) > \
+            stats.compute_prob_of(np.full((3, 2), 100.))
+
+  # Observers survive pickling (e.g. Spark reductions)
+  import pickle
+  o3 = pickle.loads(pickle.dumps(o1))
+  assert o3.get_stats('m', 't:0').n == len(acts)
+
+@pytest.mark.slow
+def test_activation_stats_observer_spark():
+  from au.fixtures import dataset
+  from au.fixtures import nnmodel
+
+  acts, _ = _shards()
+  rows = []
+  for i, act in enumerate(acts):
+    row = dataset.ImageRow(uri='img_%s' % i)
+    row.attrs = {'activations': [
+      nnmodel.Activations(model_name='m', tensor_to_value={'t:0': act})]}
+    rows.append(row)
+
+  with testutils.LocalSpark.sess() as spark:
+    rdd = spark.sparkContext.parallelize(rows, numSlices=10)
+    observer = distributions.ActivationStatsObserver.observe_rdd(rdd)
+  stats = observer.get_stats('m', 't:0')
+  assert stats.n == len(acts)
+  np.testing.assert_allclose(stats.moments.mean, acts.mean(axis=0).ravel())
+
+def _ferns_fixture(n=6000, dim=64, n_classes=5, seed=1337):
+  rand = np.random.RandomState(seed)
+  centers = np.maximum(rand.normal(scale=3., size=(n_classes, dim)), 0)
+  labels = rand.randint(n_classes, size=n)
+  acts = np.maximum(centers[labels] + rand.normal(size=(n, dim)), 0)
+  return acts.astype(np.float32), labels
+
+def test_random_ferns():
+  acts, labels = _ferns_fixture()
+  train, test = acts[:5000], acts[5000:]
+  train_labels, test_labels = labels[:5000], labels[5000:]
+
+  # Fit in shards and merge
+  ferns = distributions.RandomFerns(
+              acts.shape[1], n_ferns=30, depth=8, n_classes=5)
+  for shard in np.array_split(np.arange(len(train)), 4):
+    shard_ferns = distributions.RandomFerns(
+              acts.shape[1], n_ferns=30, depth=8, n_classes=5)
+    shard_ferns.tally_batch(train[shard], labels=train_labels[shard])
+    ferns += shard_ferns
+  assert ferns.n == len(train)
+  assert ferns.counts.shape == (30, 5, 2 ** 8)
+
+  single = distributions.RandomFerns(
+              acts.shape[1], n_ferns=30, depth=8, n_classes=5)
+  single.tally_batch(train, labels=train_labels)
+  np.testing.assert_array_equal(ferns.counts, single.counts)
+
+  assert np.mean(ferns.predict(test) == test_labels) > 0.9
+  log_proba = ferns.predict_log_proba(test)
+  np.testing.assert_allclose(np.exp(log_proba).sum(axis=1), 1., rtol=1e-6)
+
+  # In-distribution activations are more likely than e.g. noise
+  noise = np.maximum(
+    np.random.RandomState(0).normal(scale=3., size=test.shape), 0)
+  assert np.median(ferns.compute_log_prob_of(test)) > \
+            np.max(ferns.compute_log_prob_of(noise))
+  assert ferns.compute_prob_of(test[0]) > 0
+
+  # Thresholds drawn from observed quantiles
+  stats = distributions.ActivationStats()
+  stats.tally_batch(train)
+  qferns = distributions.RandomFerns.from_stats(
+              stats, n_ferns=30, depth=8, n_classes=5)
+  assert np.any(qferns.thresholds > 0)
+  qferns.tally_batch(train, labels=train_labels)
+  assert np.mean(qferns.predict(test) == test_labels) > 0.9
+
+@pytest.mark.slow
+def test_random_ferns_spark():
+  acts, labels = _ferns_fixture(n=2000)
+  ferns = distributions.RandomFerns(acts.shape[1], n_classes=5)
+  with testutils.LocalSpark.sess() as spark:
+    rdd = spark.sparkContext.parallelize(
+      [('img_%s' % i, act, label)
+        for i, (act, label) in enumerate(zip(acts, labels))],
+      numSlices=10)
+    ferns.tally_rdd(rdd)
+  
+  local = distributions.RandomFerns(acts.shape[1], n_classes=5)
+  local.tally_batch(acts, labels=labels)
+  np.testing.assert_array_equal(ferns.counts, local.counts)
+
+def test_kernel_density():
+  rand = np.random.RandomState(1337)
+  dim = 6
+  centers = rand.normal(scale=5., size=(20, dim))
+  refs = centers[rand.randint(20, size=20000)] + rand.normal(size=(20000, dim))
+  queries = np.concatenate([
+    centers[rand.randint(20, size=500)] + rand.normal(size=(500, dim)),
+    rand.uniform(-20, 20, size=(500, dim)),
+  ])
+
+  kde = distributions.KernelDensity(bandwidth=0.5, query_block=256)
+  for shard in np.array_split(refs, 3):
+    part = distributions.KernelDensity(bandwidth=0.5, query_block=256)
+    part.tally_batch(shard)
+    kde += part
+  assert kde.n == len(refs)
+
+  def brute_force_log_density(refs, queries, h):
+    log_k = -distributions._sq_dists(queries, refs) / (2 * h * h)
+    return (
+      distributions._logsumexp(log_k, axis=1) - np.log(len(refs)) -
+      0.5 * dim * np.log(2 * np.pi * h * h))
+  
+  expected = brute_force_log_density(refs, queries, 0.5)
+  import time
+  start = time.time()
+  actual = kde.compute_log_prob_of(queries)
+  elapsed = time.time() - start
+  assert np.all(np.isfinite(actual))
+  
+  # Pruning only drops negligible mass near the data; far queries get a
+  # finite (lower bound) estimate from their nearest leaf
+  near = expected > -30
+  assert near[:500].all()
+  # (we store activations as float32)
+  np.testing.assert_allclose(actual[near], expected[near], atol=1e-4)
+  assert np.all(actual[~near] <= expected[~near] + 1e-4)
+  print("KDE: %s queries/sec" % (len(queries) / elapsed))
+
+  # In-distribution activations are more likely
+  assert np.min(actual[:500]) > np.median(actual[500:])
+  assert kde.compute_prob_of(queries[0]) > 0
+
+  # Subsampling approximates the full estimate
+  sub = distributions.KernelDensity(bandwidth=0.5, max_points=10000)
+  sub.tally_batch(refs)
+  assert sub._points.shape == (10000, dim)
+  sub_err = np.abs(sub.compute_log_prob_of(queries[:500]) - expected[:500])
+  assert np.median(sub_err) < 0.4
+
+  # Shards key their samples independently (by hashing the activations), so
+  # merged shards keep the same sample as a single pass
+  merged = distributions.KernelDensity(bandwidth=0.5, max_points=10000)
+  for shard in np.array_split(refs, 3):
+    part = distributions.KernelDensity(bandwidth=0.5, max_points=10000)
+    part.tally_batch(shard)
+    merged += part
+  np.testing.assert_array_equal(np.sort(merged._keys), np.sort(sub._keys))
+  first = distributions.KernelDensity(max_points=10000)
+  first.tally_batch(refs[:10000])
+  second = distributions.KernelDensity(max_points=10000)
+  second.tally_batch(refs[10000:])
+  assert not np.intersect1d(first._keys, second._keys).size
+
+  # Scott's rule bandwidths get refit as we tally more points
+  auto = distributions.KernelDensity()
+  auto.tally_batch(refs[:1000])
+  auto.fit()
+  small_h = auto._fitted_bandwidth
+  auto.tally_batch(refs[1000:])
+  auto.fit()
+  assert auto.bandwidth is None
+  assert auto._fitted_bandwidth < small_h
+
+  with pytest.raises(ValueError):
+    distributions.KernelDensity().compute_log_prob_of(queries)
+
+  # Grid coresets help for dense (e.g. low-dimensional) data
+  refs_2d = rand.normal(size=(20000, 2))
+  full = distributions.KernelDensity(bandwidth=0.5)
+  full.tally_batch(refs_2d)
+  grid = distributions.KernelDensity(bandwidth=0.5, grid_width=0.05)
+  grid.tally_batch(refs_2d)
+  grid.fit()
+  assert len(grid._tree.points) < 0.5 * len(refs_2d)
+  np.testing.assert_allclose(
+    grid.compute_log_prob_of(refs_2d[:500]),
+    full.compute_log_prob_of(refs_2d[:500]),
+    atol=1e-2)
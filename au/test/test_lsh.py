@@ -0,0 +1,104 @@
+from au import lsh
+from au.test import testconf
+from au.test import testutils
+
+import os
+
+import numpy as np
+import pytest
+
+def _clustered_fixture(n=5000, dim=32, n_clusters=50, seed=1337):
+  rand = np.random.RandomState(seed)
+  centers = rand.normal(scale=10., size=(n_clusters, dim))
+  labels = rand.randint(n_clusters, size=n)
+  vectors = centers[labels] + rand.normal(size=(n, dim))
+  queries = centers[labels[:100]] + rand.normal(size=(100, dim))
+  uris = ['img_%s' % i for i in range(n)]
+  return vectors.astype(np.float32), uris, labels, queries
+
+def _brute_force_knn(vectors, queries, k, family):
+  if family == 'hyperplane':
+    vn = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    qn = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    dists = 1. - qn.dot(vn.T)
+  else:
+    dists = np.linalg.norm(
+      queries[:, np.newaxis, :] - vectors[np.newaxis], axis=2)
+  return np.argsort(dists, axis=1)[:, :k]
+
+def _recall(ids, expected):
+  return np.mean([
+    len(set(a) & set(b)) / float(len(b)) for a, b in zip(ids, expected)])
+
+@pytest.mark.parametrize('family, n_bits', [('hyperplane', 12), ('pstable', 4)])
+def test_lsh_index(family, n_bits):
+  vectors, uris, labels, queries = _clustered_fixture()
+  index = lsh.LSHIndex(
+            vectors.shape[1], family=family, n_tables=6, n_bits=n_bits,
+            bucket_width=16.)
+  index.fit(vectors, uris, labels=labels)
+  assert len(index) == len(vectors)
+
+  K = 10
+  expected = _brute_force_knn(vectors, queries, K, family)
+  ids, dists = index.query(queries, k=K)
+  assert ids.shape == dists.shape == (len(queries), K)
+  assert np.all(np.isfinite(dists))
+  assert np.all(np.diff(dists, axis=1) >= 0)
+  recall = _recall(ids, expected)
+  assert recall > 0.5
+
+  # Multi-probe finds more of the true neighbors
+  probed_ids, _ = index.query(queries, k=K, n_probes=8)
+  probed_recall = _recall(probed_ids, expected)
+  assert probed_recall >= recall
+  assert probed_recall > 0.8
+
+  # Neighbors come from the query's cluster
+  assert np.mean(index.labels[probed_ids[:, 0]] == labels[:100]) > 0.95
+  
+  # Queries examine only a fraction of the index
+  codes, aux = index.hash(queries)
+  probes = index.probe_codes(codes, aux, n_probes=8)
+  n_cands = 0
+  for t in range(index.n_tables):
+    lo = np.searchsorted(index.sorted_codes[t], probes[:, t].ravel(), 'left')
+    hi = np.searchsorted(index.sorted_codes[t], probes[:, t].ravel(), 'right')
+    n_cands += (hi - lo).sum()
+  assert n_cands < 0.2 * len(queries) * len(vectors)
+
+  # Save / load
+  TEST_TEMPDIR = os.path.join(
+                      testconf.TEST_TEMPDIR_ROOT, 'test_lsh_index', family)
+  from au import util
+  util.cleandir(TEST_TEMPDIR)
+  index.save(TEST_TEMPDIR)
+  loaded = lsh.LSHIndex.load(TEST_TEMPDIR)
+  assert len(loaded) == len(index)
+  loaded_ids, loaded_dists = loaded.query(queries, k=K, n_probes=8)
+  np.testing.assert_array_equal(loaded_ids, probed_ids)
+  assert loaded.uris[loaded_ids[0, 0]] == uris[probed_ids[0, 0]]
+
+def test_lsh_index_no_neighbors():
+  index = lsh.LSHIndex(4, n_bits=32)
+  index.fit(np.ones((3, 4)), ['a', 'b', 'c'])
+  ids, dists = index.query(-np.ones((1, 4)), k=2)
+  assert ids.tolist() == [[-1, -1]]
+  assert np.all(np.isinf(dists))
+  
+  with pytest.raises(ValueError):
+    lsh.LSHIndex(4, family='minhash')
+
+@pytest.mark.slow
+def test_lsh_index_spark():
+  vectors, uris, labels, queries = _clustered_fixture(n=1000)
+  with testutils.LocalSpark.sess() as spark:
+    rdd = spark.sparkContext.parallelize(
+      zip(uris, vectors, labels), numSlices=10)
+    index = lsh.LSHIndex.build_from_rdd(rdd, n_tables=4, n_bits=10)
+  assert len(index) == len(vectors)
+  
+  local = lsh.LSHIndex(vectors.shape[1], n_tables=4, n_bits=10)
+  local.fit(vectors, uris, labels=labels)
+  np.testing.assert_array_equal(
+    index.query(queries)[0], local.query(queries)[0])
@@ -11,6 +11,116 @@ import pytest
 def test_spark_selftest():
   testutils.LocalSpark.selftest()
 
+def test_numpy_array_encoding():
+  import numpy as np
+  import pickle
+
+  arrs = [
+    np.array([1]),
+    np.array([[1]]),
+    np.array([]),
+    np.float32(3.),
+    np.arange(6, dtype='>i4').reshape((2, 3)),
+    np.random.rand(3, 4, 5).astype(np.float32),
+  ]
+  for arr in arrs:
+    b = NumpyArray(arr).get_bytes()
+    for buf in (b, bytearray(b)):
+      # NB: Spark gives us bytearrays
+      decoded = NumpyArray.from_bytes(buf).arr
+      assert decoded.dtype == np.asarray(arr).dtype
+      np.testing.assert_array_equal(decoded, arr)
+  
+  # Decoding writable buffers does not copy; decoded arrays are writable
+  arr = np.random.rand(10, 10)
+  b = NumpyArray(arr).get_bytes()
+  assert not NumpyArray.from_bytes(bytearray(b)).arr.flags.owndata
+  decoded = NumpyArray.from_bytes(b).arr
+  decoded[0, 0] = -1.
+  np.testing.assert_array_equal(NumpyArray.from_bytes(b).arr, arr)
+
+  # Structured arrays keep their fields
+  arr = np.array([(1, 2.)], dtype=[('a', 'i4'), ('b', 'f8')])
+  decoded = NumpyArray.from_bytes(NumpyArray(arr).get_bytes()).arr
+  assert decoded.dtype == arr.dtype
+  np.testing.assert_array_equal(decoded, arr)
+
+  # We can still read pickled arrays
+  arr = np.random.rand(10, 10)
+  np.testing.assert_array_equal(
+    NumpyArray.from_bytes(pickle.dumps(arr)).arr, arr)
+
+  # Quantization is lossy but restores dtype
+  arr = np.random.rand(32, 7, 7).astype(np.float32)
+  for quantize, atol in (('float16', 1e-3), ('int8', 1. / 255)):
+    b = NumpyArray(arr, quantize=quantize).get_bytes()
+    assert len(b) < arr.nbytes
+    decoded = NumpyArray.from_bytes(b).arr
+    assert decoded.dtype == arr.dtype
+    np.testing.assert_allclose(decoded, arr, atol=atol)
+
+def test_numpy_array_encoding_benchmark():
+  import pickle
+  import numpy as np
+  import pyarrow as pa
+  import pyarrow.parquet as pq
+
+  TEST_TEMPDIR = os.path.join(
+                      testconf.TEST_TEMPDIR_ROOT,
+                      'numpy_array_encoding_benchmark')
+  util.cleandir(TEST_TEMPDIR)
+
+  # E.g. Mobilenet embeddings and feature maps
+  arrs = [
+    np.random.rand(1280).astype(np.float32) for _ in range(100)
+  ] + [
+    np.random.rand(7, 7, 320).astype(np.float32) for _ in range(20)
+  ]
+  n_bytes = sum(a.nbytes for a in arrs)
+
+  def encode_pickle(a):
+    return pickle.dumps(a)
+  def decode_pickle(b):
+    return pickle.loads(b)
+  
+  encodings = (
+    ('pickle', encode_pickle, decode_pickle),
+  ) + tuple(
+    (
+      'raw-%s' % quantize,
+      lambda a, q=quantize: NumpyArray(a, quantize=q).get_bytes(),
+      lambda b: NumpyArray.from_bytes(b).arr,
+    )
+    for quantize in (None, 'float16', 'int8'))
+  
+  name_to_size = {}
+  for name, encode, decode in encodings:
+    enc_thruput = util.ThruputObserver(name=name + ' encode')
+    dec_thruput = util.ThruputObserver(name=name + ' decode')
+    
+    enc_thruput.start_block()
+    blobs = [encode(a) for a in arrs]
+    enc_thruput.stop_block(n=len(arrs), num_bytes=n_bytes)
+    
+    dec_thruput.start_block()
+    for b in blobs:
+      decode(b)
+    dec_thruput.stop_block(n=len(arrs), num_bytes=n_bytes)
+
+    path = os.path.join(TEST_TEMPDIR, name + '.parquet')
+    table = pa.Table.from_arrays(
+      [pa.array(blobs, type=pa.binary())], names=['tensor_value'])
+    pq.write_table(table, path, compression='snappy')
+    name_to_size[name] = os.path.getsize(path)
+
+    util.log.info(str(enc_thruput))
+    util.log.info(str(dec_thruput))
+    util.log.info("%s table size: %s bytes" % (name, name_to_size[name]))
+  
+  assert name_to_size['raw-None'] <= name_to_size['pickle']
+  assert name_to_size['raw-float16'] < name_to_size['raw-None']
+  assert name_to_size['raw-int8'] < name_to_size['raw-float16']
+
 @pytest.mark.slow
 def test_spark_numpy_df():
   TEST_TEMPDIR = os.path.join(
@@ -25,6 +25,46 @@ def test_ichunked():
   
   assert list_ichunked('abcde', 4) == [('a', 'b', 'c', 'd'), ('e',)]
 
+def test_bin_pack():
+  assert util.bin_pack([], 2) == [[], []]
+  assert util.bin_pack([1, 2, 3], 1) == [[0, 1, 2]]
+  assert util.bin_pack([5, 1, 1, 1, 1, 1], 2) == [[0], [1, 2, 3, 4, 5]]
+  
+  import random
+  g = random.Random(7)
+  sizes = [g.randint(1, 100) for _ in range(1000)]
+  bins = util.bin_pack(sizes, 10)
+  assert sorted(sum(bins, [])) == range(len(sizes))
+  totals = [sum(sizes[i] for i in b) for b in bins]
+  assert max(totals) - min(totals) <= max(sizes)
+
+def test_iter_prefetched():
+  assert list(util.iter_prefetched([])) == []
+  assert list(util.iter_prefetched(range(100), max_queued=3)) == range(100)
+
+  # The producer stays at most a few items ahead
+  produced = []
+  def gen():
+    for i in range(100):
+      produced.append(i)
+      yield i
+  it = util.iter_prefetched(gen(), max_queued=2)
+  assert next(it) == 0
+  import time
+  time.sleep(0.2)
+  assert len(produced) <= 4
+  it.close()
+
+  # Errors surface in the consumer
+  def bad_gen():
+    yield 1
+    raise ValueError("bad gen")
+  it = util.iter_prefetched(bad_gen())
+  assert next(it) == 1
+  import pytest
+  with pytest.raises(ValueError):
+    next(it)
+
 
 
 class TextProxy(unittest.TestCase):
@@ -78,10 +118,11 @@ def test_sys_info():
   info = util.get_sys_info()
   assert 'au' in info['filepath']
 
-def test_archive_fliyweight_zip():
+def test_archive_fliyweight_zip(monkeypatch):
   TEST_TEMPDIR = os.path.join(
                       testconf.TEST_TEMPDIR_ROOT,
                       'test_archive_flyweight_zip')
+  testconf.use_tempdir(monkeypatch, TEST_TEMPDIR)
   util.cleandir(TEST_TEMPDIR)
   
   # Create the fixture
@@ -99,6 +140,108 @@ def test_archive_fliyweight_zip():
   datas = [fw.data for fw in fws]
   assert sorted(datas) == sorted(ss)
 
+  # We can also stream entries
+  for fw in fws:
+    assert fw.open().read() == fw.data
+
+def test_archive_flyweight_zip_index(monkeypatch):
+  TEST_TEMPDIR = os.path.join(
+                      testconf.TEST_TEMPDIR_ROOT,
+                      'test_archive_flyweight_zip_index')
+  util.cleandir(TEST_TEMPDIR)
+  INDEX_DIR = os.path.join(TEST_TEMPDIR, 'index')
+  monkeypatch.setattr(util._ZipIndex, 'INDEX_DIR', INDEX_DIR)
+
+  # Create the fixture: stored, deflated, empty, and unicode entries
+  import zipfile
+  entries = [
+    ('stored.jpg', os.urandom(10000), zipfile.ZIP_STORED),
+    ('dir/deflated.json', '{"a": 1}' * 1000, zipfile.ZIP_DEFLATED),
+    ('dir/', '', zipfile.ZIP_STORED),
+    (u'caf\xe9.txt', 'cafe', zipfile.ZIP_DEFLATED),
+  ]
+  fixture_path = os.path.join(TEST_TEMPDIR, 'test.zip')
+  with zipfile.ZipFile(fixture_path, mode='w') as z:
+    for name, data, method in entries:
+      z.writestr(zipfile.ZipInfo(name), data, compress_type=method)
+  
+  fws = util.ArchiveFileFlyweight.fws_from(fixture_path)
+  assert [fw.name for fw in fws] == zipfile.ZipFile(fixture_path).namelist()
+  for fw, (name, data, method) in zip(fws, entries):
+    assert fw.data == data
+    assert isinstance(fw.view, memoryview)
+    assert fw.view.tobytes() == data
+  
+  # Stored entries are views of the archive itself
+  import numpy as np
+  view = fws[0].view
+  assert np.asarray(view).base is not None
+  assert not np.asarray(view).flags.writeable
+
+  sizes = util.ArchiveFileFlyweight.sizes_from(fixture_path)
+  assert sizes['stored.jpg'] == (10000, 10000)
+  assert sizes['dir/deflated.json'][0] < sizes['dir/deflated.json'][1] == 8000
+
+  import pytest
+  with pytest.raises(KeyError):
+    fws[0].archive.get('missing')
+
+  # The index is persisted, so a new process just loads it ...
+  assert len(os.listdir(INDEX_DIR)) == 1
+  monkeypatch.setattr(util._ZipIndex, '_cache', {})
+  monkeypatch.setattr(util._ZipIndex, '_build', None)
+  import pickle
+  fw = pickle.loads(pickle.dumps(fws[1], pickle.HIGHEST_PROTOCOL))
+  assert fw.data == entries[1][1]
+
+  # ... unless the archive changes
+  monkeypatch.undo()
+  monkeypatch.setattr(util._ZipIndex, 'INDEX_DIR', INDEX_DIR)
+  import time
+  time.sleep(0.01)
+  old_archive = fws[0].archive
+  assert old_archive.get('stored.jpg') == entries[0][1]
+  with zipfile.ZipFile(fixture_path, mode='w') as z:
+    z.writestr('new', 'new')
+  fws = util.ArchiveFileFlyweight.fws_from(fixture_path)
+  assert [(fw.name, fw.data) for fw in fws] == [('new', 'new')]
+
+  # Readers that already opened the archive see the new version, too
+  assert old_archive.get('new') == 'new'
+  with pytest.raises(KeyError):
+    old_archive.get('stored.jpg')
+
+def test_iter_json_object_items():
+  import json
+  from StringIO import StringIO
+  obj = {
+    'info': {'year': 2017, 'desc': u'caf\xe9'},
+    'images': [{'id': i, 'size': [i * 12345.678, -1e-10]} for i in range(50)],
+    'empty': [],
+    'licenses': [[1, 2], {'a': [3]}, "x", 12345678901234, None, True],
+    'n': 12345678,
+  }
+  expected = []
+  for k, v in obj.iteritems():
+    if isinstance(v, list):
+      expected.extend((k, item) for item in v)
+    else:
+      expected.append((k, v))
+
+  for s in (json.dumps(obj), json.dumps(obj, indent=2)):
+    # Use tiny chunks so that values (and numbers) straddle chunk boundaries
+    for chunk_size in (1, 3, 7, 1000, 2**20):
+      items = list(util.iter_json_object_items(StringIO(s), chunk_size))
+      assert items == expected
+
+  assert list(util.iter_json_object_items(StringIO(' { } '))) == []
+
+  import pytest
+  with pytest.raises(ValueError):
+    list(util.iter_json_object_items(StringIO('{"a": [1, 2'), 2))
+  with pytest.raises(ValueError):
+    list(util.iter_json_object_items(StringIO('[1, 2]')))
+
 def test_ds_store_is_stupid():
   assert util.is_stupid_mac_file('/yay/.DS_Store')
   assert util.is_stupid_mac_file('.DS_Store')
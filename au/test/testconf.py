@@ -12,6 +12,7 @@ def use_tempdir(monkeypatch, test_tempdir):
   monkeypatch.setattr(conf, 'AU_DATA_CACHE', os.path.join(test_tempdir, 'data'))
   monkeypatch.setattr(conf, 'AU_TABLE_CACHE', os.path.join(test_tempdir, 'tables'))
   monkeypatch.setattr(conf, 'AU_MODEL_CACHE', os.path.join(test_tempdir, 'models'))
+  monkeypatch.setattr(conf, 'AU_NORMALIZED_CACHE', os.path.join(test_tempdir, 'normalized'))
   monkeypatch.setattr(conf, 'AU_TENSORBOARD_DIR', os.path.join(test_tempdir, 'tensorboard'))
   
   util.mkdir(test_tempdir)
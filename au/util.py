@@ -40,6 +40,66 @@ def ichunked(seq, n):
     else:
       break
 
+def bin_pack(sizes, n_bins):
+  """Assign items with `sizes` to `n_bins` bins of roughly equal total size
+  and return a list of lists of item indices (in input order).  Uses the
+  greedy longest-processing-time rule: biggest items first, each to the
+  currently lightest bin."""
+  import heapq
+  n_bins = max(1, n_bins)
+  bins = [[] for _ in range(n_bins)]
+  heap = [(0, b) for b in range(n_bins)]
+  by_size = sorted(range(len(sizes)), key=lambda i: sizes[i], reverse=True)
+  for i in by_size:
+    total, b = heapq.heappop(heap)
+    bins[b].append(i)
+    heapq.heappush(heap, (total + sizes[i], b))
+  return [sorted(indices) for indices in bins]
+
+def iter_prefetched(seq, max_queued=2):
+  """Generate the items of `seq` in order, but consume `seq` in a background
+  thread that runs up to `max_queued` items ahead of the caller (e.g. to
+  overlap decoding with compute that releases the GIL).  Exceptions raised
+  by `seq` get re-raised in the caller.
+  """
+  import Queue
+  q = Queue.Queue(maxsize=max(1, max_queued))
+  stop = threading.Event()
+  DONE = object()
+
+  def put(item):
+    # Don't block forever if the caller stops consuming early
+    while not stop.is_set():
+      try:
+        q.put(item, timeout=0.1)
+        return True
+      except Queue.Full:
+        pass
+    return False
+
+  def run():
+    try:
+      for item in seq:
+        if not put((item, None)):
+          return
+      put((DONE, None))
+    except Exception:
+      put((DONE, sys.exc_info()))
+
+  t = threading.Thread(target=run, name='iter_prefetched')
+  t.daemon = True
+  t.start()
+  try:
+    while True:
+      item, exc_info = q.get()
+      if item is DONE:
+        if exc_info is not None:
+          raise exc_info[0], exc_info[1], exc_info[2]
+        break
+      yield item
+  finally:
+    stop.set()
+
 class Proxy(object):
   __slots__ = ('instance',)
   
@@ -263,6 +323,12 @@ class _IArchive(object):
     self.archive_path = path
     self.thread_data = threading.local()
 
+  def __getstate__(self):
+    return self.archive_path
+
+  def __setstate__(self, path):
+    self.__init__(path)
+
   def _setup(self, archive_path):
     pass
 
@@ -270,6 +336,11 @@ class _IArchive(object):
   def list_names(cls, archive_path):
     return []
 
+  @classmethod
+  def list_sizes(cls, archive_path):
+    """Return a map of name -> (stored size, uncompressed size) in bytes"""
+    return {}
+
   def _archive_get(self, name):
     raise KeyError("Interface stores no data")
 
@@ -277,20 +348,219 @@ class _IArchive(object):
     self._setup(self.archive_path)
     return self._archive_get(name)
 
+  def get_view(self, name):
+    """Return the data of entry `name` as a `memoryview` (which may share
+    memory with the archive)"""
+    return memoryview(self.get(name))
+
+  def open(self, name):
+    """Return a file-like object for streaming entry `name`"""
+    raise KeyError("Interface stores no data")
+
+class _ZipIndex(object):
+  """The entry table of a zip archive: parallel arrays of entry `names` and
+  of the `offsets` (of entry data, past local headers), `compress_sizes`,
+  `file_sizes` and compression `methods` of each entry.  We parse the central
+  directory (and local headers) once and persist the table in `INDEX_DIR`
+  keyed by archive path, inode, size and mtime, so that other processes (e.g. Spark
+  workers) and later runs just load a few arrays."""
+
+  INDEX_DIR = None # By default, conf.AU_CACHE_TMP/zip_index
+  ARRAYS = ('names', 'offsets', 'compress_sizes', 'file_sizes', 'methods')
+
+  # Entries we can't read directly (e.g. encrypted ones) get this method
+  METHOD_UNSUPPORTED = -1
+
+  _lock = threading.Lock()
+  _cache = {} # archive path -> (cache key, _ZipIndex)
+
+  def __init__(self, **arrays):
+    for k in self.ARRAYS:
+      setattr(self, k, arrays[k])
+    self._name_to_row = None
+
+  def __len__(self):
+    return len(self.names)
+
+  def list_names(self):
+    def to_name(b):
+      # Match zipfile, which decodes only non-ASCII (i.e. UTF-8) names
+      try:
+        b.decode('ascii')
+        return b
+      except UnicodeDecodeError:
+        return b.decode('utf-8')
+    return [to_name(b) for b in self.names]
+
+  def find(self, name):
+    """Return the row of entry `name`; raise KeyError if there's no such
+    entry (like zipfile)"""
+    if self._name_to_row is None:
+      self._name_to_row = dict(
+        (name, i) for i, name in enumerate(self.list_names()))
+    return self._name_to_row[name]
+
+  @classmethod
+  def get(cls, archive_path):
+    archive_path = os.path.abspath(archive_path)
+    st = os.stat(archive_path)
+    key = (archive_path, st.st_ino, st.st_size, st.st_mtime)
+    with cls._lock:
+      cached = cls._cache.get(archive_path)
+      if cached is None or cached[0] != key:
+        cls._cache[archive_path] = (key, cls._load_or_build(key))
+      return cls._cache[archive_path][1]
+
+  @classmethod
+  def _load_or_build(cls, key):
+    import hashlib
+    import numpy as np
+    if cls.INDEX_DIR:
+      index_dir = cls.INDEX_DIR
+    else:
+      from au import conf
+      index_dir = os.path.join(conf.AU_CACHE_TMP, 'zip_index')
+    dest = os.path.join(
+      index_dir,
+      hashlib.sha1('\0'.join(str(v) for v in key)).hexdigest() + '.npz')
+
+    if os.path.exists(dest):
+      with np.load(dest) as arrays:
+        return cls(**dict((k, arrays[k]) for k in cls.ARRAYS))
+
+    archive_path = key[0]
+    index = cls._build(archive_path)
+    try:
+      mkdir(index_dir)
+      tmp_path = '%s.%s.tmp.npz' % (dest, os.getpid())
+      np.savez(tmp_path, **dict((k, getattr(index, k)) for k in cls.ARRAYS))
+      os.rename(tmp_path, dest)
+    except (IOError, OSError) as e:
+      log.warn("Could not save zip index for %s: %s" % (archive_path, e))
+    return index
+
+  @classmethod
+  def _build(cls, archive_path):
+    import mmap
+    import struct
+    import zipfile
+    import numpy as np
+
+    log.info("Indexing zip entries of %s ..." % archive_path)
+    infos = zipfile.ZipFile(archive_path).infolist()
+    LOCAL_HEADER_SIZE = 30
+    offsets = np.zeros(len(infos), dtype=np.int64)
+    methods = np.zeros(len(infos), dtype=np.int16)
+    with open(archive_path, 'rb') as f:
+      mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      try:
+        for i, info in enumerate(infos):
+          start = info.header_offset
+          if mm[start:start + 4] != zipfile.stringFileHeader:
+            raise zipfile.BadZipfile(
+              "Bad local header for %s in %s" % (info.filename, archive_path))
+          # NB: The local extra field can differ from the central one
+          name_len, extra_len = struct.unpack_from('<HH', mm, start + 26)
+          offsets[i] = start + LOCAL_HEADER_SIZE + name_len + extra_len
+          methods[i] = info.compress_type
+          if info.flag_bits & 0x1 or info.compress_type not in (
+                zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            methods[i] = cls.METHOD_UNSUPPORTED
+      finally:
+        mm.close()
+
+    names = [
+      info.filename.encode('utf-8') if isinstance(info.filename, unicode)
+      else info.filename
+      for info in infos
+    ]
+    log.info("... indexed %s entries." % len(infos))
+    return cls(
+      names=np.array(names, dtype=np.string_),
+      offsets=offsets,
+      compress_sizes=np.array(
+        [info.compress_size for info in infos], dtype=np.int64),
+      file_sizes=np.array([info.file_size for info in infos], dtype=np.int64),
+      methods=methods)
+
 class _ZipArchive(_IArchive):
-  
+  """Reads zip entries directly from a read-only mmap of the archive (shared
+  by all threads of a process) using a persisted `_ZipIndex`, so we parse
+  the central directory at most once and reads need no file offsets or
+  locks.  Stored entries (e.g. JPEGs) can be read without any copies via
+  `get_view()`.  NB: unlike zipfile, we skip CRC checks."""
+
+  _lock = threading.Lock()
+  _mmaps = {} # archive path -> (cache key, mmap)
+
   def _setup(self, archive_path):
-    if not hasattr(self.thread_data, 'zipfile'):
-      import zipfile
-      self.thread_data.zipfile = zipfile.ZipFile(archive_path)
-  
+    # NB: the archive may get rewritten while we're running, so revalidate
+    # (with just a stat()) on every read
+    st = os.stat(archive_path)
+    key = (st.st_ino, st.st_size, st.st_mtime)
+    if getattr(self.thread_data, 'key', None) != key:
+      import mmap
+      self.thread_data.index = _ZipIndex.get(archive_path)
+      self.thread_data.zipfile = None
+      with _ZipArchive._lock:
+        cached = _ZipArchive._mmaps.get(archive_path)
+        if cached is None or cached[0] != key:
+          with open(archive_path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+          _ZipArchive._mmaps[archive_path] = (key, mm)
+        self.thread_data.mmap = _ZipArchive._mmaps[archive_path][1]
+          # NB: we don't close replaced mmaps; views of them may be in use
+      self.thread_data.key = key
+
+  def _read(self, name, zero_copy):
+    import zipfile
+    index = self.thread_data.index
+    i = index.find(name)
+    start = int(index.offsets[i])
+    size = int(index.compress_sizes[i])
+    method = index.methods[i]
+    mm = self.thread_data.mmap
+    if method == zipfile.ZIP_STORED:
+      if zero_copy:
+        import numpy as np
+        # NB: mmap only supports the old buffer protocol, numpy bridges
+        return memoryview(
+          np.frombuffer(mm, dtype=np.uint8, count=size, offset=start))
+      else:
+        return mm[start:start + size]
+    elif method == zipfile.ZIP_DEFLATED:
+      import zlib
+      data = zlib.decompress(buffer(mm, start, size), -zlib.MAX_WBITS)
+      return memoryview(data) if zero_copy else data
+    else:
+      if self.thread_data.zipfile is None:
+        self.thread_data.zipfile = zipfile.ZipFile(self.archive_path)
+      data = self.thread_data.zipfile.read(name)
+      return memoryview(data) if zero_copy else data
+
   def _archive_get(self, name):
-    return self.thread_data.zipfile.read(name)
+    return self._read(name, False)
+
+  def get_view(self, name):
+    self._setup(self.archive_path)
+    return self._read(name, True)
+
+  def open(self, name):
+    import zipfile
+    # NB: Use a distinct handle so that readers needn't share file offsets
+    return zipfile.ZipFile(self.archive_path).open(name)
 
   @classmethod
   def list_names(cls, archive_path):
-    import zipfile
-    return zipfile.ZipFile(archive_path).namelist()
+    return _ZipIndex.get(archive_path).list_names()
+
+  @classmethod
+  def list_sizes(cls, archive_path):
+    index = _ZipIndex.get(archive_path)
+    return dict(
+      (name, (int(c), int(f)))
+      for name, c, f in zip(
+        index.list_names(), index.compress_sizes, index.file_sizes))
 
 class ArchiveFileFlyweight(object):
 
@@ -312,9 +582,29 @@ class ArchiveFileFlyweight(object):
     else:
       raise ValueError("Don't know how to read %s" % archive_path)
 
+  @staticmethod
+  def sizes_from(archive_path):
+    """Return a map of entry name -> (stored size, uncompressed size) for
+    `archive_path` without reading any entries"""
+    if archive_path.endswith('zip'):
+      return _ZipArchive.list_sizes(archive_path)
+    else:
+      raise ValueError("Don't know how to read %s" % archive_path)
+
   @property
   def data(self):
     return self.archive.get(self.name)
+
+  @property
+  def view(self):
+    """The data as a `memoryview`; for uncompressed entries, a view of the
+    (memory-mapped) archive itself"""
+    return self.archive.get_view(self.name)
+
+  def open(self):
+    """Return a file-like object for streaming (rather than reading all of)
+    this file"""
+    return self.archive.open(self.name)
   
 def copy_n_from_zip(src, dest, n):
   log.info("Copying %s of %s -> %s ..." % (n, src, dest))
@@ -333,6 +623,86 @@ def copy_n_from_zip(src, dest, n):
 
 ### I/O
 
+def iter_json_object_items(fileobj, chunk_size=2**20):
+  """Incrementally parse the JSON object `{"k1": v1, "k2": [...], ...}` in
+  file-like `fileobj` and generate (key, value) pairs: one pair for each item
+  of each array value, and one pair for each other value.  We read
+  `chunk_size` bytes at a time, so memory use is bounded by the largest
+  item (rather than the whole file), e.g. for MSCOCO annotations."""
+  import json
+  import re
+  decoder = json.JSONDecoder()
+  whitespace = re.compile(r'[ \t\n\r]*')
+
+  class Buffer(object):
+    def __init__(self):
+      self.buf = ''
+      self.pos = 0
+      self.eof = False
+
+    def fill(self):
+      if self.eof:
+        raise ValueError("Unexpected end of JSON input")
+      if self.pos > chunk_size:
+        # Discard what we've parsed
+        self.buf = self.buf[self.pos:]
+        self.pos = 0
+      data = fileobj.read(chunk_size)
+      self.eof = not data
+      self.buf += data
+
+    def peek(self):
+      while True:
+        self.pos = whitespace.match(self.buf, self.pos).end()
+        if self.pos < len(self.buf):
+          return self.buf[self.pos]
+        self.fill()
+
+    def expect(self, chars):
+      c = self.peek()
+      if c not in chars:
+        raise ValueError(
+          "Expected one of %s at offset %s, got %s" % (chars, self.pos, c))
+      self.pos += 1
+      return c
+
+    def decode(self):
+      self.peek()
+      while True:
+        try:
+          value, end = decoder.raw_decode(self.buf, self.pos)
+          # NB: A number (or literal) at the end of the buffer may continue
+          # in the next chunk
+          if end < len(self.buf) or self.eof:
+            self.pos = end
+            return value
+        except ValueError:
+          if self.eof:
+            raise
+        self.fill()
+
+  b = Buffer()
+  b.expect('{')
+  if b.peek() == '}':
+    return
+  while True:
+    key = b.decode()
+    b.expect(':')
+    if b.peek() == '[':
+      b.expect('[')
+      if b.peek() == ']':
+        b.expect(']')
+      else:
+        while True:
+          yield key, b.decode()
+          if b.expect(',]') == ']':
+            break
+    else:
+      yield key, b.decode()
+    if b.expect(',}') == '}':
+      return
+
+
 try:
   import pathlib
 except ImportError: